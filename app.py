@@ -1,21 +1,33 @@
 import os
 import re
+import codecs
 import csv
+import functools
+import hashlib
 import hmac
+import importlib.util
+import itertools
 import json
 import secrets
 import shutil
 import sqlite3
+import sys
+import threading
+import time
 import unicodedata
 import zipfile
-from io import BytesIO, StringIO
-from datetime import datetime, timedelta
+from io import BytesIO, IOBase, TextIOWrapper
+from datetime import date, datetime, timedelta
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing, contextmanager
 from tempfile import TemporaryDirectory
 
+import click
 from flask import (
     Flask,
+    g,
+    has_request_context,
     jsonify,
     redirect,
     render_template,
@@ -25,30 +37,56 @@ from flask import (
     session,
     url_for,
 )
+from flask.json.provider import DefaultJSONProvider
 from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.security import check_password_hash, generate_password_hash
 
 try:
-    from PIL import Image, ImageOps, UnidentifiedImageError
-except Exception:  # pragma: no cover - entorno sin Pillow
-    Image = None
-    ImageOps = None
-
-    class UnidentifiedImageError(Exception):
-        pass
+    import orjson
+except ImportError:  # pragma: no cover - orjson es opcional
+    orjson = None
 
 
 APP = Flask(__name__, template_folder="templates", static_folder="static")
 APP.config["JSON_SORT_KEYS"] = False
 APP.config["MAX_CONTENT_LENGTH"] = 10 * 1024 * 1024  # 10 MB máximo por request
-APP.secret_key = os.environ.get("TRACKER_SECRET_KEY") or secrets.token_hex(32)
 APP.config["SESSION_COOKIE_HTTPONLY"] = True
 APP.config["SESSION_COOKIE_SAMESITE"] = "Lax"
 
+
+class OrjsonJSONProvider(DefaultJSONProvider):
+    """`jsonify` con orjson: serializa en C y responde bytes sin pasar por str."""
+
+    def _orjson_options(self) -> int:
+        # Fechas por el `default` de Flask (http_date) para no cambiar el formato.
+        options = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        return options
+
+    def dumps(self, obj, **kwargs) -> str:
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self._orjson_options()).decode()
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        if self.compact is False or (self.compact is None and self._app.debug):
+            return super().response(obj)
+        body = orjson.dumps(
+            obj, default=self.default, option=self._orjson_options() | orjson.OPT_APPEND_NEWLINE
+        )
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+if orjson is not None:
+    APP.json = OrjsonJSONProvider(APP)
+
 BASE_DIR = Path(__file__).resolve().parent
 DB_PATH = Path(
     os.environ.get("TRACKER_DB_PATH", str(BASE_DIR / "tracker.db"))
 ).expanduser()
+SECRET_KEY_PATH = BASE_DIR / ".secret_key"
 PLAN_WORKOUT_GUIDED_TEMPLATE_PATH = BASE_DIR / "docs" / "plan_workout_template_guided.csv"
 PLAN_CSV_AI_SYSTEM_PROMPT_PATH = BASE_DIR / "docs" / "PLAN_CSV_AI_SYSTEM_PROMPT.md"
 PLAN_CSV_AI_INSTRUCTIONS_LEGACY_PATH = BASE_DIR / "docs" / "PLAN_CSV_AI_INSTRUCTIONS.md"
@@ -61,16 +99,53 @@ UPLOAD_ROOT = str(
     ).expanduser()
 )
 ALLOWED_EXT = {".jpg", ".jpeg", ".png", ".webp"}
+# Prefijos de rutas de fotos guardadas en DB: actuales "uploads/..." y legacy "static/uploads/...".
+UPLOADS_PREFIX = "uploads/"
+STATIC_UPLOADS_PREFIX = "static/" + UPLOADS_PREFIX
+UPLOAD_PATH_PREFIXES = (STATIC_UPLOADS_PREFIX, UPLOADS_PREFIX)
+UPLOADS_PREFIX_LEN = len(UPLOADS_PREFIX)
+STATIC_UPLOADS_PREFIX_LEN = len(STATIC_UPLOADS_PREFIX)
+STATIC_PREFIX_LEN = STATIC_UPLOADS_PREFIX_LEN - UPLOADS_PREFIX_LEN
 SUMMARY_WINDOW_CHOICES = (7, 15, 30, 60, 90)
 PLAN_ADHERENCE_WINDOW_CHOICES = (7, 15, 30)
 CSRF_SESSION_KEY = "csrf_token"
+# Endpoints con archivos o lotes grandes; el resto se limita a JSON_MAX_CONTENT_LENGTH.
+UPLOAD_ENDPOINTS = frozenset(
+    (
+        "api_diet",
+        "api_diet_import_preview",
+        "api_diet_import_apply",
+        "api_plan_import_diet",
+        "api_plan_import_workout_combined",
+        "api_plan_import_workout_sessions",
+        "api_plan_import_workout_exercises",
+        "restore_backup_zip",
+    )
+)
+JSON_MAX_CONTENT_LENGTH = 1024 * 1024
+# Los CSV subidos se validan y decodifican por bloques, sin el texto entero en memoria.
+CSV_STREAM_CHUNK_SIZE = 64 * 1024
+UTF8_INCREMENTAL_DECODER = codecs.getincrementaldecoder("utf-8")
+# Se incrementa cada vez que cambia el esquema o se añade una migración.
+SCHEMA_VERSION = 1
+ISO_DATE_RE = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2}")
+WHITESPACE_RE = re.compile(r"\s+")
+HEADER_SEPARATOR_RE = re.compile(r"[\s\-/]+")
+HEADER_INVALID_CHARS_RE = re.compile(r"[^a-z0-9_]+")
+# exercise_1_name, ex1_name, exercise1name... (slot + sufijo en una sola pasada).
+EXERCISE_SLOT_HEADER_RE = re.compile(r"^(?:exercise|ex)_?(\d+)_?([a-z0-9_]+)$")
+UNSAFE_FILENAME_CHARS_RE = re.compile(r"[^a-zA-Z0-9._-]+")
+# Un segmento ".." en cualquier posición de una ruta ya normalizada.
+BACKUP_PARENT_SEGMENT_RE = re.compile(r"(?:^|/)\.\.(?:/|$)")
+TRUTHY_VALUES = frozenset(("1", "true", "y", "yes", "on"))
+FALSY_VALUES = frozenset(("0", "false", "n", "no", "off"))
 
 
 def _bool_env(name: str, default: bool = False) -> bool:
     val = os.environ.get(name)
     if val is None:
         return default
-    return str(val).strip().lower() in ("1", "true", "yes", "y", "on")
+    return str(val).strip().lower() in TRUTHY_VALUES
 
 
 def _int_env(name: str, default: int, min_value: int, max_value: int) -> int:
@@ -85,23 +160,86 @@ def _int_env(name: str, default: int, min_value: int, max_value: int) -> int:
 
 
 def _load_auth_hash() -> str:
-    stored = (os.environ.get("TRACKER_AUTH_PASSWORD_HASH") or "").strip()
-    if stored:
-        return stored
-    plain = os.environ.get("TRACKER_AUTH_PASSWORD")
-    if plain:
-        return generate_password_hash(plain)
-    return ""
+    # Con solo TRACKER_AUTH_PASSWORD el hash se calcula en el primer login
+    # (ver auth_password_hash): PBKDF2/scrypt no bloquea el arranque de cada worker.
+    return (os.environ.get("TRACKER_AUTH_PASSWORD_HASH") or "").strip()
+
+
+def _load_secret_key() -> str:
+    env = (os.environ.get("TRACKER_SECRET_KEY") or "").strip()
+    if env:
+        return env
+    # Persistido: todos los workers comparten clave y las sesiones sobreviven reinicios.
+    try:
+        return SECRET_KEY_PATH.read_text(encoding="utf-8").strip()
+    except FileNotFoundError:
+        pass
+    except OSError:
+        return secrets.token_hex(32)
+    value = secrets.token_hex(32)
+    try:
+        fd = os.open(SECRET_KEY_PATH, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # Otro worker la creó a la vez.
+        return SECRET_KEY_PATH.read_text(encoding="utf-8").strip() or value
+    except OSError:
+        return value
+    with os.fdopen(fd, "w", encoding="utf-8") as fh:
+        fh.write(value)
+    return value
 
 
+def _auth_plain_password() -> str:
+    return os.environ.get("TRACKER_AUTH_PASSWORD") or ""
+
+
+APP.secret_key = _load_secret_key()
 AUTH_PASSWORD_HASH = _load_auth_hash()
-AUTH_ENABLED = _bool_env("TRACKER_AUTH_ENABLED", default=bool(AUTH_PASSWORD_HASH))
+AUTH_ENABLED = _bool_env(
+    "TRACKER_AUTH_ENABLED", default=bool(AUTH_PASSWORD_HASH or _auth_plain_password())
+)
 
 PHOTO_COMPRESSION_ENABLED = _bool_env("TRACKER_PHOTO_COMPRESSION_ENABLED", default=True)
 PHOTO_MAX_SIDE = _int_env("TRACKER_PHOTO_MAX_SIDE", default=1600, min_value=640, max_value=4096)
 PHOTO_QUALITY = _int_env("TRACKER_PHOTO_QUALITY", default=82, min_value=50, max_value=95)
-PHOTO_PREFER_WEBP = _bool_env("TRACKER_PHOTO_PREFER_WEBP", default=True)
-PILLOW_AVAILABLE = Image is not None and ImageOps is not None
+PHOTO_MAX_PIXELS = _int_env(
+    "TRACKER_PHOTO_MAX_PIXELS", default=64_000_000, min_value=4_000_000, max_value=200_000_000
+)
+# Un WebP sin EXIF por debajo de este tamaño (y sin exceder PHOTO_MAX_SIDE) no se
+# recomprime.
+PHOTO_SKIP_BELOW_BYTES = 200 * 1024
+# Bloque de copia al guardar el original sin comprimir.
+PHOTO_COPY_CHUNK_SIZE = 1024 * 1024
+# Pillow se importa la primera vez que se procesa una foto (arranque más rápido).
+PILLOW_AVAILABLE = importlib.util.find_spec("PIL") is not None
+_PIL = None
+
+
+def _get_pil():
+    """Devuelve `(Image, ImageOps, UnidentifiedImageError, resample)` o `None`."""
+    global _PIL
+    if _PIL is None:
+        try:
+            from PIL import Image, ImageOps, UnidentifiedImageError
+        except Exception:  # pragma: no cover - Pillow roto o incompleto
+            return None
+        # Acota la descompresión (protección frente a "decompression bombs").
+        Image.MAX_IMAGE_PIXELS = PHOTO_MAX_PIXELS
+        resample = (
+            Image.Resampling.LANCZOS
+            if hasattr(Image, "Resampling")
+            else getattr(Image, "LANCZOS", None)
+        )
+        _PIL = (Image, ImageOps, UnidentifiedImageError, resample)
+    return _PIL
+
+
+STATIC_ASSET_KEYS = {
+    "asset_v_css": "styles.css",
+    "asset_v_app_js": "app.js",
+    "asset_v_login_js": "login.js",
+    "asset_v_cover_css": "cover.css",
+}
 
 
 def static_asset_version(filename: str) -> str:
@@ -111,34 +249,168 @@ def static_asset_version(filename: str) -> str:
         return "1"
 
 
+def _build_asset_versions() -> dict:
+    return {key: static_asset_version(name) for key, name in STATIC_ASSET_KEYS.items()}
+
+
+# Los estáticos no cambian entre despliegues: un stat() por archivo al arrancar.
+ASSET_VERSIONS = _build_asset_versions()
+
+
 @APP.context_processor
 def inject_asset_versions():
-    return {
-        "asset_v_css": static_asset_version("styles.css"),
-        "asset_v_app_js": static_asset_version("app.js"),
-        "asset_v_login_js": static_asset_version("login.js"),
-        "asset_v_cover_css": static_asset_version("cover.css"),
-    }
+    if APP.debug:
+        # En desarrollo se refresca para que el cache-busting siga las ediciones.
+        ASSET_VERSIONS.update(_build_asset_versions())
+    return ASSET_VERSIONS
 
 
 # -----------------------------
 # DB helpers
 # -----------------------------
-@contextmanager
-def _conn():
-    conn = sqlite3.connect(DB_PATH)
+# Una conexión SQLite reutilizable por hilo (se cierra al morir el hilo).
+_DB_LOCAL = threading.local()
+DB_CACHED_STATEMENTS = 256
+_DB_GENERATION = 0
+_TABLE_COLUMNS_CACHE = {}
+# build_state puede repartir sus lecturas en hilos con conexión propia (WAL
+# permite lectores concurrentes). Desactivado por defecto.
+STATE_PARALLEL_ENABLED = _bool_env("TRACKER_PARALLEL_STATE", default=False)
+STATE_PARALLEL_WORKERS = 4
+_STATE_POOL = None
+_STATE_POOL_LOCK = threading.Lock()
+
+
+def _open_conn():
+    # La conexión vive todo el hilo: caché de sentencias preparadas holgada para
+    # que las ~120 consultas distintas de la app no se expulsen entre sí (def. 128).
+    conn = sqlite3.connect(DB_PATH, cached_statements=DB_CACHED_STATEMENTS)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA foreign_keys = ON;")
     conn.execute("PRAGMA busy_timeout = 5000;")
+    # journal_mode=WAL persiste en el archivo (ver ensure_schema); estos son por conexión.
+    conn.execute("PRAGMA synchronous = NORMAL;")
+    conn.execute("PRAGMA temp_store = MEMORY;")
+    conn.execute("PRAGMA cache_size = -20000;")
+    conn.execute("PRAGMA mmap_size = 268435456;")
+    if getattr(_DB_LOCAL, "read_only", False):
+        conn.execute("PRAGMA query_only = ON;")
+    return conn
+
+
+def close_thread_conn():
+    conn = getattr(_DB_LOCAL, "conn", None)
+    _DB_LOCAL.conn = None
+    _DB_LOCAL.plan_day_cache = None
+    if conn is not None:
+        conn.close()
+
+
+def reset_db_connections():
+    # Invalida las conexiones cacheadas de todos los hilos (p.ej. tras restaurar backup).
+    global _DB_GENERATION
+    _DB_GENERATION += 1
+    _TABLE_COLUMNS_CACHE.clear()
+    close_thread_conn()
+
+
+@contextmanager
+def _conn():
+    local = _DB_LOCAL
+    depth = getattr(local, "depth", 0)
+    conn = getattr(local, "conn", None)
+    key = (str(DB_PATH), _DB_GENERATION)
+    if depth == 0 and conn is not None and getattr(local, "key", None) != key:
+        close_thread_conn()
+        conn = None
+    if conn is None:
+        conn = _open_conn()
+        local.conn = conn
+        local.key = key
+    local.depth = depth + 1
     try:
         yield conn
     finally:
-        conn.close()
+        local.depth = depth
+        # Igual que al cerrar: lo no confirmado se descarta antes de reutilizarla.
+        if depth == 0 and conn.in_transaction:
+            conn.rollback()
+
+
+def _mark_read_only_thread():
+    _DB_LOCAL.read_only = True
+
+
+def _state_pool() -> ThreadPoolExecutor:
+    global _STATE_POOL
+    with _STATE_POOL_LOCK:
+        if _STATE_POOL is None:
+            _STATE_POOL = ThreadPoolExecutor(
+                max_workers=STATE_PARALLEL_WORKERS,
+                thread_name_prefix="tracker-state",
+                initializer=_mark_read_only_thread,
+            )
+        return _STATE_POOL
+
+
+def _read_only_call(fn, *args, **kwargs):
+    # Corre en un hilo del pool: su conexión (query_only) es la del propio hilo.
+    with _conn() as conn:
+        return fn(conn, *args, **kwargs)
+
+
+def begin_immediate(conn):
+    """
+    Abre la transacción de escritura tomando ya el lock (BEGIN IMMEDIATE): sin
+    la promoción lector→escritor de un BEGIN diferido, que en WAL falla con
+    SQLITE_BUSY_SNAPSHOT sin esperar a busy_timeout si otro escribió entretanto.
+    """
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE;")
+
+
+def table_columns(conn, table: str) -> set:
+    # Memo por DB y generación: una sola introspección por tabla y arranque.
+    key = (str(DB_PATH), _DB_GENERATION, table)
+    cols = _TABLE_COLUMNS_CACHE.get(key)
+    if cols is None:
+        rows = conn.execute("SELECT name FROM pragma_table_xinfo(?)", (table,)).fetchall()
+        cols = {r["name"] for r in rows}
+        _TABLE_COLUMNS_CACHE[key] = cols
+    return cols
+
+
+def prime_table_columns(conn) -> None:
+    # Columnas de todas las tablas en una sola consulta (forma tabla de PRAGMA).
+    db_key = (str(DB_PATH), _DB_GENERATION)
+    found = {}
+    for tbl, col in conn.execute(
+        """
+        SELECT m.name, p.name
+        FROM sqlite_master AS m
+        JOIN pragma_table_xinfo(m.name) AS p
+        WHERE m.type = 'table'
+        """
+    ).fetchall():
+        found.setdefault(tbl, set()).add(col)
+    for tbl, cols in found.items():
+        _TABLE_COLUMNS_CACHE[(*db_key, tbl)] = cols
 
 
 def has_column(conn, table: str, column: str) -> bool:
-    rows = conn.execute(f"PRAGMA table_info({table});").fetchall()
-    return any(r["name"] == column for r in rows)
+    return column in table_columns(conn, table)
+
+
+def ensure_columns(conn, table: str, columns) -> list:
+    # Solo se hace ALTER de lo que falte; devuelve las columnas añadidas.
+    existing = table_columns(conn, table)
+    added = []
+    for name, decl in columns:
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl};")
+            existing.add(name)
+            added.append(name)
+    return added
 
 
 def table_exists(conn, table: str) -> bool:
@@ -149,518 +421,475 @@ def table_exists(conn, table: str) -> bool:
     return row is not None
 
 
-def ensure_schema():
-    with _conn() as conn:
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS diet_log (
-              log_date TEXT PRIMARY KEY,
-              sleep_hours REAL,
-              sleep_quality INTEGER,
-              steps INTEGER,
-              weight_kg REAL,
-              waist_cm REAL,
-              hip_cm REAL,
-              alcohol_units INTEGER DEFAULT 0,
-              creatine_yn TEXT,
-              photo_yn TEXT
-            );
-            """
-        )
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_diet_log_date ON diet_log(log_date);")
-
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS workout_log (
-              log_date TEXT PRIMARY KEY,
-              session_done_yn TEXT,
-              class_done TEXT,
-              rpe_session INTEGER,
-              hipthrust_topset TEXT,
-              squat_topset TEXT,
-              notes TEXT
-            );
-            """
-        )
-        conn.execute(
-            "CREATE INDEX IF NOT EXISTS idx_workout_log_date ON workout_log(log_date);"
-        )
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS workout_session (
-              session_id INTEGER PRIMARY KEY AUTOINCREMENT,
-              log_date TEXT NOT NULL,
-              session_order INTEGER NOT NULL DEFAULT 1,
-              session_done_yn TEXT,
-              session_type TEXT,
-              class_done TEXT,
-              rpe_session INTEGER,
-              notes TEXT,
-              created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now')),
-              updated_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now')),
-              UNIQUE(log_date, session_order)
-            );
-            """
-        )
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS workout_exercise (
-              exercise_id INTEGER PRIMARY KEY AUTOINCREMENT,
-              session_id INTEGER NOT NULL,
-              exercise_name TEXT NOT NULL,
-              set_order INTEGER NOT NULL DEFAULT 1,
-              weight_kg REAL,
-              reps INTEGER,
-              rpe REAL,
-              topset_text TEXT,
-              FOREIGN KEY(session_id) REFERENCES workout_session(session_id) ON DELETE CASCADE
-            );
-            """
-        )
-        conn.execute(
-            "CREATE INDEX IF NOT EXISTS idx_workout_session_date ON workout_session(log_date);"
-        )
-        conn.execute(
-            "CREATE INDEX IF NOT EXISTS idx_workout_exercise_session ON workout_exercise(session_id, set_order);"
-        )
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS diet_log (
+  log_date TEXT PRIMARY KEY,
+  sleep_hours REAL,
+  sleep_quality INTEGER,
+  steps INTEGER,
+  weight_kg REAL,
+  waist_cm REAL,
+  hip_cm REAL,
+  alcohol_units INTEGER DEFAULT 0,
+  creatine_yn TEXT,
+  photo_yn TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_diet_log_date ON diet_log(log_date);
+
+CREATE TABLE IF NOT EXISTS workout_log (
+  log_date TEXT PRIMARY KEY,
+  session_done_yn TEXT,
+  class_done TEXT,
+  rpe_session INTEGER,
+  hipthrust_topset TEXT,
+  squat_topset TEXT,
+  notes TEXT
+);
+
+CREATE INDEX IF NOT EXISTS idx_workout_log_date ON workout_log(log_date);
+
+CREATE TABLE IF NOT EXISTS workout_session (
+  session_id INTEGER PRIMARY KEY AUTOINCREMENT,
+  log_date TEXT NOT NULL,
+  session_order INTEGER NOT NULL DEFAULT 1,
+  session_done_yn TEXT,
+  session_type TEXT,
+  class_done TEXT,
+  rpe_session INTEGER,
+  notes TEXT,
+  created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now')),
+  updated_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now')),
+  UNIQUE(log_date, session_order)
+);
+
+CREATE TABLE IF NOT EXISTS workout_exercise (
+  exercise_id INTEGER PRIMARY KEY AUTOINCREMENT,
+  session_id INTEGER NOT NULL,
+  exercise_name TEXT NOT NULL,
+  set_order INTEGER NOT NULL DEFAULT 1,
+  weight_kg REAL,
+  reps INTEGER,
+  rpe REAL,
+  topset_text TEXT,
+  FOREIGN KEY(session_id) REFERENCES workout_session(session_id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_workout_session_date ON workout_session(log_date);
+
+CREATE INDEX IF NOT EXISTS idx_workout_exercise_session ON workout_exercise(session_id, set_order);
+
+CREATE TABLE IF NOT EXISTS photo_log (
+  log_date TEXT NOT NULL,
+  kind TEXT NOT NULL,
+  path TEXT NOT NULL,
+  original_name TEXT,
+  created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now')),
+  PRIMARY KEY (log_date, kind)
+);
+
+CREATE INDEX IF NOT EXISTS idx_photo_date ON photo_log(log_date);
+
+CREATE TABLE IF NOT EXISTS supplement_catalog (
+  supplement_id INTEGER PRIMARY KEY AUTOINCREMENT,
+  name TEXT NOT NULL,
+  doses_per_day INTEGER NOT NULL DEFAULT 1,
+  active_yn TEXT NOT NULL DEFAULT 'Y',
+  notes TEXT,
+  created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now')),
+  updated_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now'))
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_supplement_catalog_name_ci ON supplement_catalog(name COLLATE NOCASE);
+
+CREATE TABLE IF NOT EXISTS supplement_daily_log (
+  log_date TEXT NOT NULL,
+  supplement_id INTEGER NOT NULL,
+  doses_taken INTEGER NOT NULL DEFAULT 0,
+  notes TEXT,
+  created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now')),
+  updated_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now')),
+  PRIMARY KEY (log_date, supplement_id),
+  FOREIGN KEY(supplement_id) REFERENCES supplement_catalog(supplement_id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS idx_supplement_daily_date ON supplement_daily_log(log_date);
+
+CREATE TABLE IF NOT EXISTS plan_day_diet (
+  log_date TEXT PRIMARY KEY,
+  calories_target_kcal REAL,
+  protein_target_g REAL,
+  carbs_target_g REAL,
+  fat_target_g REAL,
+  breakfast TEXT,
+  snack_1 TEXT,
+  lunch TEXT,
+  snack_2 TEXT,
+  dinner TEXT,
+  notes TEXT,
+  source_tag TEXT,
+  created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now')),
+  updated_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now'))
+);
+
+CREATE TABLE IF NOT EXISTS plan_day_workout_session (
+  log_date TEXT NOT NULL,
+  plan_session_id TEXT NOT NULL,
+  session_type TEXT NOT NULL DEFAULT 'clase',
+  warmup TEXT,
+  class_sessions TEXT,
+  cardio TEXT,
+  mobility_cooldown TEXT,
+  additional_exercises TEXT,
+  notes TEXT,
+  source_tag TEXT,
+  created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now')),
+  updated_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now')),
+  PRIMARY KEY(log_date, plan_session_id)
+);
+
+CREATE TABLE IF NOT EXISTS plan_day_workout_exercise (
+  log_date TEXT NOT NULL,
+  plan_session_id TEXT NOT NULL,
+  exercise_order INTEGER NOT NULL DEFAULT 1,
+  exercise_name TEXT NOT NULL,
+  target_sets INTEGER,
+  target_reps_min INTEGER,
+  target_reps_max INTEGER,
+  target_weight_kg REAL,
+  target_rpe REAL,
+  intensity_target TEXT,
+  progression_weight_rule TEXT,
+  progression_reps_rule TEXT,
+  created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now')),
+  updated_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now')),
+  PRIMARY KEY(log_date, plan_session_id, exercise_order),
+  FOREIGN KEY(log_date, plan_session_id)
+    REFERENCES plan_day_workout_session(log_date, plan_session_id)
+    ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS plan_day_adherence (
+  log_date TEXT PRIMARY KEY,
+  diet_score REAL,
+  workout_score REAL,
+  notes TEXT,
+  updated_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now'))
+);
+
+CREATE INDEX IF NOT EXISTS idx_plan_diet_date ON plan_day_diet(log_date);
+
+CREATE INDEX IF NOT EXISTS idx_plan_workout_session_date ON plan_day_workout_session(log_date);
+
+CREATE INDEX IF NOT EXISTS idx_plan_workout_exercise_date ON plan_day_workout_exercise(log_date, plan_session_id);
+
+CREATE INDEX IF NOT EXISTS idx_plan_adherence_date ON plan_day_adherence(log_date);
+"""
+# Sentencia a sentencia: executescript() haría COMMIT y rompería la transacción única.
+SCHEMA_STATEMENTS = tuple(stmt.strip() for stmt in SCHEMA_SQL.split(";") if stmt.strip())
 
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS photo_log (
-              log_date TEXT NOT NULL,
-              kind TEXT NOT NULL,
-              path TEXT NOT NULL,
-              original_name TEXT,
-              created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now')),
-              PRIMARY KEY (log_date, kind)
-            );
-            """
-        )
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_photo_date ON photo_log(log_date);")
 
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS supplement_catalog (
-              supplement_id INTEGER PRIMARY KEY AUTOINCREMENT,
-              name TEXT NOT NULL,
-              doses_per_day INTEGER NOT NULL DEFAULT 1,
-              active_yn TEXT NOT NULL DEFAULT 'Y',
-              notes TEXT,
-              created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now')),
-              updated_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now'))
-            );
-            """
-        )
-        conn.execute(
-            "CREATE UNIQUE INDEX IF NOT EXISTS idx_supplement_catalog_name_ci ON supplement_catalog(name COLLATE NOCASE);"
-        )
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS supplement_daily_log (
-              log_date TEXT NOT NULL,
-              supplement_id INTEGER NOT NULL,
-              doses_taken INTEGER NOT NULL DEFAULT 0,
-              notes TEXT,
-              created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now')),
-              updated_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now')),
-              PRIMARY KEY (log_date, supplement_id),
-              FOREIGN KEY(supplement_id) REFERENCES supplement_catalog(supplement_id) ON DELETE CASCADE
-            );
-            """
-        )
-        conn.execute(
-            "CREATE INDEX IF NOT EXISTS idx_supplement_daily_date ON supplement_daily_log(log_date);"
-        )
+def ensure_schema():
+    with _conn() as conn:
+        # WAL: lectores y escritor concurrentes y menos fsync por commit.
+        conn.execute("PRAGMA journal_mode = WAL;")
+        if conn.execute("PRAGMA user_version;").fetchone()[0] >= SCHEMA_VERSION:
+            return
+        # Sin transacciones implícitas del driver: un único BEGIN IMMEDIATE/COMMIT
+        # explícito para todo el DDL y las migraciones (un solo fsync).
+        conn.isolation_level = None
+        try:
+            conn.execute("BEGIN IMMEDIATE;")
+            for stmt in SCHEMA_STATEMENTS:
+                conn.execute(stmt)
+            # Otro proceso pudo migrar mientras esperábamos el lock.
+            if conn.execute("PRAGMA user_version;").fetchone()[0] < SCHEMA_VERSION:
+                _apply_schema_migrations(conn)
+                conn.execute(f"PRAGMA user_version = {int(SCHEMA_VERSION)};")
+            conn.execute("COMMIT;")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK;")
+            # Los ALTER deshechos no deben quedar en el memo de columnas.
+            _TABLE_COLUMNS_CACHE.clear()
+            raise
+        finally:
+            conn.isolation_level = ""
+
+
+def _backfill_update(conn, table: str, added, extra_sets=()) -> None:
+    # Los timestamps solo se rellenan si la columna se acaba de añadir
+    # (evita recorrer la tabla entera cuando ya estaba migrada).
+    sets = list(extra_sets)
+    sets.extend(
+        f"{name} = COALESCE(NULLIF({name}, ''), strftime('%Y-%m-%dT%H:%M:%S', 'now'))"
+        for name in ("created_at", "updated_at")
+        if name in added
+    )
+    if sets:
+        conn.execute(f"UPDATE {table} SET {', '.join(sets)};")
+
+
+def _apply_schema_migrations(conn):
+    # Migración suave para DB existentes
+    prime_table_columns(conn)
+    added = ensure_columns(
+        conn,
+        "photo_log",
+        (
+            ("original_name", "TEXT"),
+            ("created_at", "TEXT"),
+        ),
+    )
+    _backfill_update(conn, "photo_log", added)
+
+    added = ensure_columns(
+        conn,
+        "supplement_catalog",
+        (
+            ("active_yn", "TEXT"),
+            ("notes", "TEXT"),
+            ("created_at", "TEXT"),
+            ("updated_at", "TEXT"),
+        ),
+    )
+    _backfill_update(
+        conn,
+        "supplement_catalog",
+        added,
+        (
+            "doses_per_day = CASE WHEN doses_per_day IS NULL OR doses_per_day < 1 "
+            "THEN 1 ELSE doses_per_day END",
+            "active_yn = CASE WHEN UPPER(COALESCE(active_yn, 'Y')) = 'N' THEN 'N' ELSE 'Y' END",
+        ),
+    )
 
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS plan_day_diet (
-              log_date TEXT PRIMARY KEY,
-              calories_target_kcal REAL,
-              protein_target_g REAL,
-              carbs_target_g REAL,
-              fat_target_g REAL,
-              breakfast TEXT,
-              snack_1 TEXT,
-              lunch TEXT,
-              snack_2 TEXT,
-              dinner TEXT,
-              notes TEXT,
-              source_tag TEXT,
-              created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now')),
-              updated_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now'))
-            );
-            """
-        )
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS plan_day_workout_session (
-              log_date TEXT NOT NULL,
-              plan_session_id TEXT NOT NULL,
-              session_type TEXT NOT NULL DEFAULT 'clase',
-              warmup TEXT,
-              class_sessions TEXT,
-              cardio TEXT,
-              mobility_cooldown TEXT,
-              additional_exercises TEXT,
-              notes TEXT,
-              source_tag TEXT,
-              created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now')),
-              updated_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now')),
-              PRIMARY KEY(log_date, plan_session_id)
-            );
-            """
-        )
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS plan_day_workout_exercise (
-              log_date TEXT NOT NULL,
-              plan_session_id TEXT NOT NULL,
-              exercise_order INTEGER NOT NULL DEFAULT 1,
-              exercise_name TEXT NOT NULL,
-              target_sets INTEGER,
-              target_reps_min INTEGER,
-              target_reps_max INTEGER,
-              target_weight_kg REAL,
-              target_rpe REAL,
-              intensity_target TEXT,
-              progression_weight_rule TEXT,
-              progression_reps_rule TEXT,
-              created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now')),
-              updated_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now')),
-              PRIMARY KEY(log_date, plan_session_id, exercise_order),
-              FOREIGN KEY(log_date, plan_session_id)
-                REFERENCES plan_day_workout_session(log_date, plan_session_id)
-                ON DELETE CASCADE
-            );
-            """
-        )
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS plan_day_adherence (
-              log_date TEXT PRIMARY KEY,
-              diet_score REAL,
-              workout_score REAL,
-              notes TEXT,
-              updated_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now'))
-            );
-            """
-        )
-        conn.execute("CREATE INDEX IF NOT EXISTS idx_plan_diet_date ON plan_day_diet(log_date);")
-        conn.execute(
-            "CREATE INDEX IF NOT EXISTS idx_plan_workout_session_date ON plan_day_workout_session(log_date);"
-        )
-        conn.execute(
-            "CREATE INDEX IF NOT EXISTS idx_plan_workout_exercise_date ON plan_day_workout_exercise(log_date, plan_session_id);"
-        )
-        conn.execute(
-            "CREATE INDEX IF NOT EXISTS idx_plan_adherence_date ON plan_day_adherence(log_date);"
-        )
+    added = ensure_columns(
+        conn,
+        "supplement_daily_log",
+        (
+            ("doses_taken", "INTEGER"),
+            ("notes", "TEXT"),
+            ("created_at", "TEXT"),
+            ("updated_at", "TEXT"),
+        ),
+    )
+    _backfill_update(
+        conn,
+        "supplement_daily_log",
+        added,
+        (
+            "doses_taken = CASE WHEN doses_taken IS NULL OR doses_taken < 0 "
+            "THEN 0 ELSE doses_taken END",
+        ),
+    )
 
-        # Migración suave para DB existentes
-        if not has_column(conn, "photo_log", "original_name"):
-            conn.execute("ALTER TABLE photo_log ADD COLUMN original_name TEXT;")
-        if not has_column(conn, "photo_log", "created_at"):
-            conn.execute("ALTER TABLE photo_log ADD COLUMN created_at TEXT;")
-        conn.execute(
-            "UPDATE photo_log SET created_at = COALESCE(NULLIF(created_at, ''), strftime('%Y-%m-%dT%H:%M:%S', 'now'));"
-        )
+    added = ensure_columns(
+        conn,
+        "plan_day_diet",
+        (
+            ("notes", "TEXT"),
+            ("source_tag", "TEXT"),
+            ("created_at", "TEXT"),
+            ("updated_at", "TEXT"),
+        ),
+    )
+    _backfill_update(conn, "plan_day_diet", added)
+
+    added = ensure_columns(
+        conn,
+        "plan_day_workout_session",
+        (
+            ("class_sessions", "TEXT"),
+            ("additional_exercises", "TEXT"),
+            ("source_tag", "TEXT"),
+            ("created_at", "TEXT"),
+            ("updated_at", "TEXT"),
+        ),
+    )
+    _backfill_update(
+        conn,
+        "plan_day_workout_session",
+        added,
+        (
+            "session_type = CASE "
+            "WHEN LOWER(COALESCE(session_type, '')) = 'mixta' THEN 'pesas' "
+            "WHEN LOWER(COALESCE(session_type, '')) IN ('pesas', 'clase') THEN LOWER(session_type) "
+            "ELSE 'clase' END",
+        ),
+    )
 
-        if not has_column(conn, "supplement_catalog", "active_yn"):
-            conn.execute("ALTER TABLE supplement_catalog ADD COLUMN active_yn TEXT;")
-        if not has_column(conn, "supplement_catalog", "notes"):
-            conn.execute("ALTER TABLE supplement_catalog ADD COLUMN notes TEXT;")
-        if not has_column(conn, "supplement_catalog", "created_at"):
-            conn.execute("ALTER TABLE supplement_catalog ADD COLUMN created_at TEXT;")
-        if not has_column(conn, "supplement_catalog", "updated_at"):
-            conn.execute("ALTER TABLE supplement_catalog ADD COLUMN updated_at TEXT;")
-        conn.execute(
-            """
-            UPDATE supplement_catalog
-            SET
-              doses_per_day = CASE
-                WHEN doses_per_day IS NULL OR doses_per_day < 1 THEN 1
-                ELSE doses_per_day
-              END,
-              active_yn = CASE
-                WHEN UPPER(COALESCE(active_yn, 'Y')) = 'N' THEN 'N'
-                ELSE 'Y'
-              END,
-              created_at = COALESCE(NULLIF(created_at, ''), strftime('%Y-%m-%dT%H:%M:%S', 'now')),
-              updated_at = COALESCE(NULLIF(updated_at, ''), strftime('%Y-%m-%dT%H:%M:%S', 'now'));
-            """
-        )
+    added = ensure_columns(
+        conn,
+        "plan_day_workout_exercise",
+        (
+            ("target_sets", "INTEGER"),
+            ("target_reps_min", "INTEGER"),
+            ("target_reps_max", "INTEGER"),
+            ("target_weight_kg", "REAL"),
+            ("target_rpe", "REAL"),
+            ("intensity_target", "TEXT"),
+            ("progression_weight_rule", "TEXT"),
+            ("progression_reps_rule", "TEXT"),
+            ("created_at", "TEXT"),
+            ("updated_at", "TEXT"),
+        ),
+    )
+    _backfill_update(conn, "plan_day_workout_exercise", added)
+
+    added = ensure_columns(
+        conn,
+        "plan_day_adherence",
+        (
+            ("updated_at", "TEXT"),
+            ("notes", "TEXT"),
+        ),
+    )
+    _backfill_update(conn, "plan_day_adherence", added)
+
+    # Evolucion de workout_log (v0.0.1.0): modo clase/pesas + sets estructurados
+    ensure_columns(
+        conn,
+        "workout_log",
+        (
+            ("session_type", "TEXT"),
+            ("hipthrust_weight_kg", "REAL"),
+            ("hipthrust_reps", "INTEGER"),
+            ("hipthrust_rpe", "REAL"),
+            ("squat_weight_kg", "REAL"),
+            ("squat_reps", "INTEGER"),
+            ("squat_rpe", "REAL"),
+        ),
+    )
+    conn.execute(
+        "UPDATE workout_log SET session_type = COALESCE(NULLIF(session_type, ''), 'clase');"
+    )
+    conn.execute(
+        """
+        UPDATE workout_log
+        SET session_type = CASE
+          WHEN LOWER(COALESCE(session_type, '')) = 'mixta' THEN 'pesas'
+          WHEN LOWER(COALESCE(session_type, '')) IN ('clase', 'pesas') THEN LOWER(session_type)
+          ELSE 'clase'
+        END;
+        """
+    )
+    conn.execute(
+        """
+        UPDATE workout_session
+        SET session_type = CASE
+          WHEN LOWER(COALESCE(session_type, '')) = 'mixta' THEN 'pesas'
+          WHEN LOWER(COALESCE(session_type, '')) IN ('clase', 'pesas') THEN LOWER(session_type)
+          ELSE 'clase'
+        END;
+        """
+    )
 
-        if not has_column(conn, "supplement_daily_log", "doses_taken"):
-            conn.execute("ALTER TABLE supplement_daily_log ADD COLUMN doses_taken INTEGER;")
-        if not has_column(conn, "supplement_daily_log", "notes"):
-            conn.execute("ALTER TABLE supplement_daily_log ADD COLUMN notes TEXT;")
-        if not has_column(conn, "supplement_daily_log", "created_at"):
-            conn.execute("ALTER TABLE supplement_daily_log ADD COLUMN created_at TEXT;")
-        if not has_column(conn, "supplement_daily_log", "updated_at"):
-            conn.execute("ALTER TABLE supplement_daily_log ADD COLUMN updated_at TEXT;")
-        conn.execute(
-            """
-            UPDATE supplement_daily_log
-            SET
-              doses_taken = CASE
-                WHEN doses_taken IS NULL OR doses_taken < 0 THEN 0
-                ELSE doses_taken
-              END,
-              created_at = COALESCE(NULLIF(created_at, ''), strftime('%Y-%m-%dT%H:%M:%S', 'now')),
-              updated_at = COALESCE(NULLIF(updated_at, ''), strftime('%Y-%m-%dT%H:%M:%S', 'now'));
-            """
-        )
+    # Migracion legacy workout_log -> workout_session/workout_exercise
+    # (en bloque y bajo savepoint: si falla, no deja sesiones a medias).
+    conn.execute("SAVEPOINT legacy_workout_migration;")
+    try:
+        current_sessions = conn.execute(
+            "SELECT COUNT(*) AS n FROM workout_session;"
+        ).fetchone()["n"]
+        if table_exists(conn, "workout_log") and current_sessions == 0:
+            def _legacy_topset(weight, reps, rpe):
+                parts = (
+                    f"{weight:g}kg" if weight is not None else None,
+                    f"{reps} reps" if reps is not None else None,
+                    f"RPE {rpe:g}" if rpe is not None else None,
+                )
+                return " · ".join(p for p in parts if p) or None
 
-        if not has_column(conn, "plan_day_diet", "notes"):
-            conn.execute("ALTER TABLE plan_day_diet ADD COLUMN notes TEXT;")
-        if not has_column(conn, "plan_day_diet", "source_tag"):
-            conn.execute("ALTER TABLE plan_day_diet ADD COLUMN source_tag TEXT;")
-        if not has_column(conn, "plan_day_diet", "created_at"):
-            conn.execute("ALTER TABLE plan_day_diet ADD COLUMN created_at TEXT;")
-        if not has_column(conn, "plan_day_diet", "updated_at"):
-            conn.execute("ALTER TABLE plan_day_diet ADD COLUMN updated_at TEXT;")
-        conn.execute(
-            """
-            UPDATE plan_day_diet
-            SET
-              created_at = COALESCE(NULLIF(created_at, ''), strftime('%Y-%m-%dT%H:%M:%S', 'now')),
-              updated_at = COALESCE(NULLIF(updated_at, ''), strftime('%Y-%m-%dT%H:%M:%S', 'now'));
-            """
-        )
+            # Lectura masiva en tuplas: sin el envoltorio sqlite3.Row por fila.
+            legacy_cur = conn.cursor()
+            legacy_cur.row_factory = None
+            legacy_rows = legacy_cur.execute(
+                """
+                SELECT
+                  log_date, session_done_yn, class_done, rpe_session, session_type,
+                  hipthrust_weight_kg, hipthrust_reps, hipthrust_rpe,
+                  squat_weight_kg, squat_reps, squat_rpe,
+                  hipthrust_topset, squat_topset, notes
+                FROM workout_log
+                ORDER BY log_date ASC;
+                """
+            ).fetchall()
+            now_iso = local_now_iso()
+            # Carga masiva: se quitan los índices y se reconstruyen al final
+            # (un solo ordenado en vez de actualizar el B-tree fila a fila).
+            conn.execute("DROP INDEX IF EXISTS idx_workout_session_date;")
+            conn.execute("DROP INDEX IF EXISTS idx_workout_exercise_session;")
+            conn.executemany(
+                """
+                INSERT INTO workout_session (
+                  log_date, session_order, session_done_yn, session_type,
+                  class_done, rpe_session, notes, created_at, updated_at
+                )
+                VALUES (?, 1, ?, ?, ?, ?, ?, ?, ?);
+                """,
+                [
+                    (log_date, done_yn, session_type or "clase", class_done, rpe_session, notes, now_iso, now_iso)
+                    for (log_date, done_yn, class_done, rpe_session, session_type, *_, notes) in legacy_rows
+                ],
+            )
+            # workout_session estaba vacía y log_date es PK en workout_log:
+            # cada fecha identifica una única sesión recién creada.
+            session_id_by_date = {
+                log_date: session_id
+                for session_id, log_date in legacy_cur.execute(
+                    "SELECT session_id, log_date FROM workout_session;"
+                ).fetchall()
+            }
 
-        if not has_column(conn, "plan_day_workout_session", "class_sessions"):
-            conn.execute("ALTER TABLE plan_day_workout_session ADD COLUMN class_sessions TEXT;")
-        if not has_column(conn, "plan_day_workout_session", "additional_exercises"):
-            conn.execute("ALTER TABLE plan_day_workout_session ADD COLUMN additional_exercises TEXT;")
-        if not has_column(conn, "plan_day_workout_session", "source_tag"):
-            conn.execute("ALTER TABLE plan_day_workout_session ADD COLUMN source_tag TEXT;")
-        if not has_column(conn, "plan_day_workout_session", "created_at"):
-            conn.execute("ALTER TABLE plan_day_workout_session ADD COLUMN created_at TEXT;")
-        if not has_column(conn, "plan_day_workout_session", "updated_at"):
-            conn.execute("ALTER TABLE plan_day_workout_session ADD COLUMN updated_at TEXT;")
-        conn.execute(
-            """
-            UPDATE plan_day_workout_session
-            SET
-              session_type = CASE
-                WHEN LOWER(COALESCE(session_type, '')) = 'mixta'
-                  THEN 'pesas'
-                WHEN LOWER(COALESCE(session_type, '')) IN ('pesas', 'clase')
-                  THEN LOWER(session_type)
-                ELSE 'clase'
-              END,
-              created_at = COALESCE(NULLIF(created_at, ''), strftime('%Y-%m-%dT%H:%M:%S', 'now')),
-              updated_at = COALESCE(NULLIF(updated_at, ''), strftime('%Y-%m-%dT%H:%M:%S', 'now'));
-            """
-        )
+            exercise_rows = []
+            for row in legacy_rows:
+                session_id = session_id_by_date.get(row[0])
+                if session_id is None:
+                    continue
+                ht_weight, ht_reps, ht_rpe, sq_weight, sq_reps, sq_rpe, ht_topset, sq_topset = row[5:13]
 
-        if not has_column(conn, "plan_day_workout_exercise", "target_sets"):
-            conn.execute("ALTER TABLE plan_day_workout_exercise ADD COLUMN target_sets INTEGER;")
-        if not has_column(conn, "plan_day_workout_exercise", "target_reps_min"):
-            conn.execute("ALTER TABLE plan_day_workout_exercise ADD COLUMN target_reps_min INTEGER;")
-        if not has_column(conn, "plan_day_workout_exercise", "target_reps_max"):
-            conn.execute("ALTER TABLE plan_day_workout_exercise ADD COLUMN target_reps_max INTEGER;")
-        if not has_column(conn, "plan_day_workout_exercise", "target_weight_kg"):
-            conn.execute("ALTER TABLE plan_day_workout_exercise ADD COLUMN target_weight_kg REAL;")
-        if not has_column(conn, "plan_day_workout_exercise", "target_rpe"):
-            conn.execute("ALTER TABLE plan_day_workout_exercise ADD COLUMN target_rpe REAL;")
-        if not has_column(conn, "plan_day_workout_exercise", "intensity_target"):
-            conn.execute("ALTER TABLE plan_day_workout_exercise ADD COLUMN intensity_target TEXT;")
-        if not has_column(conn, "plan_day_workout_exercise", "progression_weight_rule"):
-            conn.execute("ALTER TABLE plan_day_workout_exercise ADD COLUMN progression_weight_rule TEXT;")
-        if not has_column(conn, "plan_day_workout_exercise", "progression_reps_rule"):
-            conn.execute("ALTER TABLE plan_day_workout_exercise ADD COLUMN progression_reps_rule TEXT;")
-        if not has_column(conn, "plan_day_workout_exercise", "created_at"):
-            conn.execute("ALTER TABLE plan_day_workout_exercise ADD COLUMN created_at TEXT;")
-        if not has_column(conn, "plan_day_workout_exercise", "updated_at"):
-            conn.execute("ALTER TABLE plan_day_workout_exercise ADD COLUMN updated_at TEXT;")
-        conn.execute(
-            """
-            UPDATE plan_day_workout_exercise
-            SET
-              created_at = COALESCE(NULLIF(created_at, ''), strftime('%Y-%m-%dT%H:%M:%S', 'now')),
-              updated_at = COALESCE(NULLIF(updated_at, ''), strftime('%Y-%m-%dT%H:%M:%S', 'now'));
-            """
-        )
+                legacy_exercises = []
+                ht_top = ht_topset or _legacy_topset(ht_weight, ht_reps, ht_rpe)
+                if ht_weight is not None or ht_reps is not None or ht_rpe is not None or ht_top:
+                    legacy_exercises.append(("Hip Thrust", ht_weight, ht_reps, ht_rpe, ht_top))
 
-        if not has_column(conn, "plan_day_adherence", "updated_at"):
-            conn.execute("ALTER TABLE plan_day_adherence ADD COLUMN updated_at TEXT;")
-        if not has_column(conn, "plan_day_adherence", "notes"):
-            conn.execute("ALTER TABLE plan_day_adherence ADD COLUMN notes TEXT;")
-        conn.execute(
-            """
-            UPDATE plan_day_adherence
-            SET
-              updated_at = COALESCE(NULLIF(updated_at, ''), strftime('%Y-%m-%dT%H:%M:%S', 'now'));
-            """
-        )
+                sq_top = sq_topset or _legacy_topset(sq_weight, sq_reps, sq_rpe)
+                if sq_weight is not None or sq_reps is not None or sq_rpe is not None or sq_top:
+                    legacy_exercises.append(("Sentadilla", sq_weight, sq_reps, sq_rpe, sq_top))
 
-        # Evolucion de workout_log (v0.0.1.0): modo clase/pesas + sets estructurados
-        if not has_column(conn, "workout_log", "session_type"):
-            conn.execute("ALTER TABLE workout_log ADD COLUMN session_type TEXT;")
-        if not has_column(conn, "workout_log", "hipthrust_weight_kg"):
-            conn.execute("ALTER TABLE workout_log ADD COLUMN hipthrust_weight_kg REAL;")
-        if not has_column(conn, "workout_log", "hipthrust_reps"):
-            conn.execute("ALTER TABLE workout_log ADD COLUMN hipthrust_reps INTEGER;")
-        if not has_column(conn, "workout_log", "hipthrust_rpe"):
-            conn.execute("ALTER TABLE workout_log ADD COLUMN hipthrust_rpe REAL;")
-        if not has_column(conn, "workout_log", "squat_weight_kg"):
-            conn.execute("ALTER TABLE workout_log ADD COLUMN squat_weight_kg REAL;")
-        if not has_column(conn, "workout_log", "squat_reps"):
-            conn.execute("ALTER TABLE workout_log ADD COLUMN squat_reps INTEGER;")
-        if not has_column(conn, "workout_log", "squat_rpe"):
-            conn.execute("ALTER TABLE workout_log ADD COLUMN squat_rpe REAL;")
-        conn.execute(
-            "UPDATE workout_log SET session_type = COALESCE(NULLIF(session_type, ''), 'clase');"
-        )
-        conn.execute(
-            """
-            UPDATE workout_log
-            SET session_type = CASE
-              WHEN LOWER(COALESCE(session_type, '')) = 'mixta' THEN 'pesas'
-              WHEN LOWER(COALESCE(session_type, '')) IN ('clase', 'pesas') THEN LOWER(session_type)
-              ELSE 'clase'
-            END;
-            """
-        )
-        conn.execute(
-            """
-            UPDATE workout_session
-            SET session_type = CASE
-              WHEN LOWER(COALESCE(session_type, '')) = 'mixta' THEN 'pesas'
-              WHEN LOWER(COALESCE(session_type, '')) IN ('clase', 'pesas') THEN LOWER(session_type)
-              ELSE 'clase'
-            END;
-            """
-        )
+                for idx, ex in enumerate(legacy_exercises, start=1):
+                    exercise_rows.append((session_id, ex[0], idx, ex[1], ex[2], ex[3], ex[4]))
 
-        # Migracion legacy workout_log -> workout_session/workout_exercise
-        try:
-            current_sessions = conn.execute(
-                "SELECT COUNT(*) AS n FROM workout_session;"
-            ).fetchone()["n"]
-            if table_exists(conn, "workout_log") and current_sessions == 0:
-                def _legacy_topset(weight, reps, rpe):
-                    if weight is None and reps is None and rpe is None:
-                        return None
-                    parts = []
-                    if weight is not None:
-                        parts.append(f"{weight:g}kg")
-                    if reps is not None:
-                        parts.append(f"{reps} reps")
-                    if rpe is not None:
-                        parts.append(f"RPE {rpe:g}")
-                    return " · ".join(parts) if parts else None
-
-                legacy_rows = conn.execute(
-                    """
-                    SELECT
-                      log_date, session_done_yn, class_done, rpe_session, session_type,
-                      hipthrust_weight_kg, hipthrust_reps, hipthrust_rpe,
-                      squat_weight_kg, squat_reps, squat_rpe,
-                      hipthrust_topset, squat_topset, notes
-                    FROM workout_log
-                    ORDER BY log_date ASC;
+            if exercise_rows:
+                conn.executemany(
                     """
-                ).fetchall()
-                for row in legacy_rows:
-                    now_iso = datetime.now().replace(microsecond=0).isoformat()
-                    cur = conn.execute(
-                        """
-                        INSERT INTO workout_session (
-                          log_date, session_order, session_done_yn, session_type,
-                          class_done, rpe_session, notes, created_at, updated_at
-                        )
-                        VALUES (?, 1, ?, ?, ?, ?, ?, ?, ?);
-                        """,
-                        (
-                            row["log_date"],
-                            row["session_done_yn"],
-                            row["session_type"] or "clase",
-                            row["class_done"],
-                            row["rpe_session"],
-                            row["notes"],
-                            now_iso,
-                            now_iso,
-                        ),
-                    )
-                    session_id = cur.lastrowid
-
-                    legacy_exercises = []
-                    ht_top = row["hipthrust_topset"] or _legacy_topset(
-                        row["hipthrust_weight_kg"],
-                        row["hipthrust_reps"],
-                        row["hipthrust_rpe"],
-                    )
-                    if (
-                        row["hipthrust_weight_kg"] is not None
-                        or row["hipthrust_reps"] is not None
-                        or row["hipthrust_rpe"] is not None
-                        or ht_top
-                    ):
-                        legacy_exercises.append(
-                            (
-                                "Hip Thrust",
-                                row["hipthrust_weight_kg"],
-                                row["hipthrust_reps"],
-                                row["hipthrust_rpe"],
-                                ht_top,
-                            )
-                        )
-
-                    sq_top = row["squat_topset"] or _legacy_topset(
-                        row["squat_weight_kg"],
-                        row["squat_reps"],
-                        row["squat_rpe"],
+                    INSERT INTO workout_exercise (
+                      session_id, exercise_name, set_order, weight_kg, reps, rpe, topset_text
                     )
-                    if (
-                        row["squat_weight_kg"] is not None
-                        or row["squat_reps"] is not None
-                        or row["squat_rpe"] is not None
-                        or sq_top
-                    ):
-                        legacy_exercises.append(
-                            (
-                                "Sentadilla",
-                                row["squat_weight_kg"],
-                                row["squat_reps"],
-                                row["squat_rpe"],
-                                sq_top,
-                            )
-                        )
-
-                    for idx, ex in enumerate(legacy_exercises, start=1):
-                        conn.execute(
-                            """
-                            INSERT INTO workout_exercise (
-                              session_id, exercise_name, set_order, weight_kg, reps, rpe, topset_text
-                            )
-                            VALUES (?, ?, ?, ?, ?, ?, ?);
-                            """,
-                            (
-                                session_id,
-                                ex[0],
-                                idx,
-                                ex[1],
-                                ex[2],
-                                ex[3],
-                                ex[4],
-                            ),
-                        )
-        except Exception:
-            # No romper arranque por migracion legacy fallida.
-            pass
-
-        conn.commit()
+                    VALUES (?, ?, ?, ?, ?, ?, ?);
+                    """,
+                    exercise_rows,
+                )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_workout_session_date ON workout_session(log_date);"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_workout_exercise_session "
+                "ON workout_exercise(session_id, set_order);"
+            )
+        conn.execute("RELEASE SAVEPOINT legacy_workout_migration;")
+    except Exception:
+        # No romper arranque por migracion legacy fallida.
+        conn.execute("ROLLBACK TO SAVEPOINT legacy_workout_migration;")
+        conn.execute("RELEASE SAVEPOINT legacy_workout_migration;")
 
 
 ensure_schema()
 
 
-@APP.errorhandler(RequestEntityTooLarge)
-def handle_payload_too_large(_e):
-    max_mb = int(APP.config.get("MAX_CONTENT_LENGTH", 0) / (1024 * 1024))
+def payload_too_large_response(max_len):
+    max_mb = max(1, int((max_len or 0) / (1024 * 1024)))
     return (
         jsonify(
             {
@@ -672,12 +901,29 @@ def handle_payload_too_large(_e):
     )
 
 
+@APP.errorhandler(RequestEntityTooLarge)
+def handle_payload_too_large(_e):
+    return payload_too_large_response(APP.config.get("MAX_CONTENT_LENGTH", 0))
+
+
 def valid_iso_date(s: str) -> bool:
+    return parse_iso_date(s) is not None
+
+
+def parse_iso_date(s: str):
+    """`date` de un string AAAA-MM-DD válido; `None` en cualquier otro caso."""
+    return _parse_iso_date_str(s) if isinstance(s, str) else None
+
+
+# Las importaciones repiten las mismas fechas fila a fila (ventanas de semanas).
+@functools.lru_cache(maxsize=2048)
+def _parse_iso_date_str(s: str):
+    if not ISO_DATE_RE.fullmatch(s):
+        return None
     try:
-        datetime.strptime(s, "%Y-%m-%d")
-        return True
-    except Exception:
-        return False
+        return date.fromisoformat(s)
+    except ValueError:
+        return None
 
 
 def safe_float(v):
@@ -698,6 +944,7 @@ def safe_int(v):
         return None
 
 
+@functools.lru_cache(maxsize=256)
 def parse_summary_days(v, default: int = 7) -> int:
     n = safe_int(v)
     if n in SUMMARY_WINDOW_CHOICES:
@@ -707,6 +954,7 @@ def parse_summary_days(v, default: int = 7) -> int:
     return 7
 
 
+@functools.lru_cache(maxsize=256)
 def parse_plan_adherence_days(v, default: int = 15) -> int:
     n = safe_int(v)
     if n in PLAN_ADHERENCE_WINDOW_CHOICES:
@@ -726,22 +974,27 @@ def yn_or_none(v):
 
 
 def truthy(v) -> bool:
-    return str(v or "").strip().lower() in ("1", "true", "y", "yes", "on")
+    return str(v or "").strip().lower() in TRUTHY_VALUES
 
 
 def yes_no(v, default="Y") -> str:
     if isinstance(v, bool):
         return "Y" if v else "N"
     s = str(v or "").strip().lower()
-    if s in ("1", "true", "y", "yes", "on"):
+    if s in TRUTHY_VALUES:
         return "Y"
-    if s in ("0", "false", "n", "no", "off"):
+    if s in FALSY_VALUES:
         return "N"
     return "Y" if str(default).strip().upper() != "N" else "N"
 
 
 def today_iso() -> str:
-    return datetime.now().date().isoformat()
+    return date.today().isoformat()
+
+
+def local_now_iso() -> str:
+    # Hora local a segundos (formato de datetime.isoformat() sin microsegundos).
+    return time.strftime("%Y-%m-%dT%H:%M:%S")
 
 
 def normalize_window_days(limit, default: int = 15, minimum: int = 1, maximum: int = 180) -> int:
@@ -753,22 +1006,42 @@ def normalize_window_days(limit, default: int = 15, minimum: int = 1, maximum: i
     return int(days)
 
 
+# MAX() sobre una columna indexada: SQLite lo resuelve con un único salto al
+# extremo del índice cubriente (idx_*_date), sin recorrer la tabla.
+CALENDAR_MAX_DATE_SQL = {
+    "diet": "SELECT MAX(log_date) AS max_date FROM diet_log;",
+    "workout": "SELECT MAX(log_date) AS max_date FROM workout_session;",
+    "supplements": "SELECT MAX(log_date) AS max_date FROM supplement_daily_log;",
+}
+# Las tres fechas en un solo round-trip (una subconsulta escalar por fuente).
+CALENDAR_MAX_DATES_SQL = "SELECT " + ", ".join(
+    f"({sql.rstrip(';')}) AS {source}" for source, sql in CALENDAR_MAX_DATE_SQL.items()
+) + ";"
+
+
+def calendar_max_dates(conn) -> dict:
+    if not has_request_context():
+        return dict(conn.execute(CALENDAR_MAX_DATES_SQL).fetchone())
+    # Memo por request: build_state pide las tres ventanas seguidas. total_changes
+    # invalida el memo si la propia conexión escribió entre medias.
+    key = (id(conn), conn.total_changes)
+    cached = g.get("_calendar_max_dates")
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    max_dates = dict(conn.execute(CALENDAR_MAX_DATES_SQL).fetchone())
+    g._calendar_max_dates = (key, max_dates)
+    return max_dates
+
+
 def resolve_calendar_window(conn, source: str, limit, fallback_to_today: bool = False):
     days = normalize_window_days(limit, default=15, minimum=1, maximum=180)
     source_key = str(source or "").strip().lower()
-    today_date = datetime.now().date()
-    if source_key == "diet":
-        row = conn.execute("SELECT MAX(log_date) AS max_date FROM diet_log;").fetchone()
-    elif source_key == "workout":
-        row = conn.execute("SELECT MAX(log_date) AS max_date FROM workout_session;").fetchone()
-    elif source_key == "supplements":
-        row = conn.execute("SELECT MAX(log_date) AS max_date FROM supplement_daily_log;").fetchone()
-    else:
-        row = None
+    today_date = date.today()
+    raw_max = calendar_max_dates(conn).get(source_key)
 
     anchor_date = None
-    if row and row["max_date"] and valid_iso_date(str(row["max_date"])):
-        max_date = datetime.strptime(str(row["max_date"]), "%Y-%m-%d").date()
+    max_date = parse_iso_date(str(raw_max)) if raw_max else None
+    if max_date is not None:
         anchor_date = max(max_date, today_date)
     elif fallback_to_today:
         anchor_date = today_date
@@ -780,8 +1053,16 @@ def resolve_calendar_window(conn, source: str, limit, fallback_to_today: bool =
     return days, start_date.isoformat(), anchor_date.isoformat()
 
 
+def collapse_whitespace(text: str) -> str:
+    # Texto imprimible sin dobles espacios: solo hay espacios ASCII sueltos
+    # (\s+ no cambiaría nada) y se evita invocar la regex.
+    if text.isprintable() and "  " not in text:
+        return text
+    return WHITESPACE_RE.sub(" ", text)
+
+
 def normalize_supplement_name(v: str) -> str:
-    text = re.sub(r"\s+", " ", str(v or "").strip())
+    text = collapse_whitespace(str(v or "").strip())
     return text[:80]
 
 
@@ -790,34 +1071,45 @@ def auth_enabled() -> bool:
         return False
     if not AUTH_ENABLED:
         return False
-    return bool(AUTH_PASSWORD_HASH)
+    return bool(AUTH_PASSWORD_HASH or _auth_plain_password())
+
+
+def auth_password_hash() -> str:
+    global AUTH_PASSWORD_HASH
+    if not AUTH_PASSWORD_HASH:
+        plain = _auth_plain_password()
+        if plain:
+            APP.logger.warning(
+                "TRACKER_AUTH_PASSWORD en claro: usa `flask --app app hash-password` "
+                "y define TRACKER_AUTH_PASSWORD_HASH."
+            )
+            AUTH_PASSWORD_HASH = generate_password_hash(plain)
+    return AUTH_PASSWORD_HASH
 
 
 def is_authenticated() -> bool:
     return bool(session.get("auth_ok"))
 
 
+# Rutas que responden 401 JSON en vez de redirigir al login.
+JSON_UNAUTHORIZED_PREFIXES = ("/api/", "/export/", "/backup/", "/uploads/", "/static/uploads/")
+
+
+UNSAFE_NEXT_PREFIXES = ("//", "/login")
+
+
 def safe_next_path(raw_next: str) -> str:
     nxt = str(raw_next or "").strip()
     if not nxt:
         return "/"
-    if nxt.startswith("http://") or nxt.startswith("https://") or nxt.startswith("//"):
-        return "/"
-    if not nxt.startswith("/"):
-        return "/"
-    if nxt.startswith("/login"):
+    # Solo rutas locales: fuera URLs absolutas ("http://", "//host") y el propio login.
+    if not nxt.startswith("/") or nxt.startswith(UNSAFE_NEXT_PREFIXES):
         return "/"
     return nxt
 
 
 def unauthorized_response():
-    if request.path.startswith("/api/"):
-        return jsonify({"ok": False, "error": "No autenticado"}), 401
-    if request.path.startswith("/export/"):
-        return jsonify({"ok": False, "error": "No autenticado"}), 401
-    if request.path.startswith("/backup/"):
-        return jsonify({"ok": False, "error": "No autenticado"}), 401
-    if request.path.startswith("/uploads/") or request.path.startswith("/static/uploads/"):
+    if request.path.startswith(JSON_UNAUTHORIZED_PREFIXES):
         return jsonify({"ok": False, "error": "No autenticado"}), 401
     nxt = request.full_path.rstrip("?") if request.query_string else request.path
     return redirect(url_for("login_page", next=nxt))
@@ -841,7 +1133,7 @@ def normalize_session_type(v: str) -> str:
 
 
 def normalize_exercise_name(v: str) -> str:
-    text = re.sub(r"\s+", " ", str(v or "").strip())
+    text = collapse_whitespace(str(v or "").strip())
     return text[:80]
 
 
@@ -858,15 +1150,20 @@ def build_topset_text(weight, reps, rpe):
     return " · ".join(parts) if parts else None
 
 
+# Formulario legacy de entreno: (nombre del ejercicio, prefijo de campos).
+LEGACY_EXERCISE_PREFIXES = (("Hip Thrust", "hipthrust"), ("Sentadilla", "squat"))
+
+
 def parse_exercises_payload(data: dict):
     parsed = []
 
     def _append_exercise(payload: dict, allow_name_only: bool = True):
-        name = normalize_exercise_name(payload.get("exercise_name") or payload.get("name"))
-        weight = safe_float(payload.get("weight_kg"))
-        reps = safe_int(payload.get("reps"))
-        rpe = safe_float(payload.get("rpe"))
-        topset_text = (payload.get("topset_text") or payload.get("topset") or "").strip()
+        get = payload.get
+        name = normalize_exercise_name(get("exercise_name") or get("name"))
+        weight = safe_float(get("weight_kg"))
+        reps = safe_int(get("reps"))
+        rpe = safe_float(get("rpe"))
+        topset_text = (get("topset_text") or get("topset") or "").strip()
         if not topset_text:
             topset_text = build_topset_text(weight, reps, rpe)
         has_metrics = weight is not None or reps is not None or rpe is not None or bool(topset_text)
@@ -895,7 +1192,7 @@ def parse_exercises_payload(data: dict):
     raw_json = data.get("exercises_json")
     if raw_json and not parsed:
         try:
-            decoded = json.loads(raw_json)
+            decoded = orjson.loads(raw_json) if orjson is not None else json.loads(raw_json)
             if isinstance(decoded, list):
                 for item in decoded:
                     if isinstance(item, dict):
@@ -904,24 +1201,18 @@ def parse_exercises_payload(data: dict):
             pass
 
     if not parsed:
-        legacy = [
-            {
-                "exercise_name": "Hip Thrust",
-                "weight_kg": data.get("hipthrust_weight_kg"),
-                "reps": data.get("hipthrust_reps"),
-                "rpe": data.get("hipthrust_rpe"),
-                "topset_text": data.get("hipthrust_topset"),
-            },
-            {
-                "exercise_name": "Sentadilla",
-                "weight_kg": data.get("squat_weight_kg"),
-                "reps": data.get("squat_reps"),
-                "rpe": data.get("squat_rpe"),
-                "topset_text": data.get("squat_topset"),
-            },
-        ]
-        for item in legacy:
-            _append_exercise(item, allow_name_only=False)
+        get = data.get
+        for name, prefix in LEGACY_EXERCISE_PREFIXES:
+            _append_exercise(
+                {
+                    "exercise_name": name,
+                    "weight_kg": get(f"{prefix}_weight_kg"),
+                    "reps": get(f"{prefix}_reps"),
+                    "rpe": get(f"{prefix}_rpe"),
+                    "topset_text": get(f"{prefix}_topset"),
+                },
+                allow_name_only=False,
+            )
 
     return parsed[:24]
 
@@ -1122,10 +1413,17 @@ PLAN_WORKOUT_COMBINED_EXERCISE_SUFFIXES = (
     "progression_reps_rule",
 )
 
-PLAN_WORKOUT_COMBINED_FIELDS = PLAN_WORKOUT_COMBINED_BASE_FIELDS + tuple(
-    f"exercise_{slot}_{suffix}"
+# slot -> {sufijo: "exercise_<slot>_<sufijo>"}; claves construidas (e internadas) una sola vez.
+PLAN_WORKOUT_COMBINED_SLOT_KEYS = {
+    slot: {
+        suffix: sys.intern(f"exercise_{slot}_{suffix}")
+        for suffix in PLAN_WORKOUT_COMBINED_EXERCISE_SUFFIXES
+    }
     for slot in range(1, PLAN_WORKOUT_COMBINED_EXERCISE_SLOTS + 1)
-    for suffix in PLAN_WORKOUT_COMBINED_EXERCISE_SUFFIXES
+}
+
+PLAN_WORKOUT_COMBINED_FIELDS = PLAN_WORKOUT_COMBINED_BASE_FIELDS + tuple(
+    key for slot_keys in PLAN_WORKOUT_COMBINED_SLOT_KEYS.values() for key in slot_keys.values()
 )
 
 PLAN_WORKOUT_COMBINED_REQUIRED = (
@@ -1170,47 +1468,61 @@ PLAN_WORKOUT_COMBINED_EXERCISE_SUFFIX_ALIASES = {
     "progression_reps": "progression_reps_rule",
 }
 
-PLAN_SCORE_ALLOWED = (0.0, 0.5, 1.0)
+PLAN_SCORE_ALLOWED = frozenset((0.0, 0.5, 1.0))
+# Acentos habituales en cabeceras en español -> ASCII (mismo resultado que NFKD).
+HEADER_ACCENT_TRANS = str.maketrans(
+    "áéíóúüñÁÉÍÓÚÜÑàèìòùÀÈÌÒÙâêîôûÂÊÎÔÛäëïöÄËÏÖçÇ",
+    "aeiouunAEIOUUNaeiouAEIOUaeiouAEIOUaeioAEIOcC",
+)
 
 
+# Los CSV repiten las mismas cabeceras: NFKD + regex solo una vez por nombre.
+@functools.lru_cache(maxsize=2048)
 def normalize_header_name(name: str) -> str:
-    txt = unicodedata.normalize("NFKD", str(name or ""))
-    txt = txt.encode("ascii", "ignore").decode("ascii")
+    txt = str(name or "").translate(HEADER_ACCENT_TRANS)
+    if not txt.isascii():
+        # Caso raro (otros alfabetos/símbolos): vía lenta con NFKD.
+        txt = unicodedata.normalize("NFKD", txt)
+        txt = txt.encode("ascii", "ignore").decode("ascii")
     txt = txt.strip().lower()
-    txt = re.sub(r"[\s\-/]+", "_", txt)
-    txt = re.sub(r"[^a-z0-9_]+", "", txt)
-    return txt
+    txt = HEADER_SEPARATOR_RE.sub("_", txt)
+    txt = HEADER_INVALID_CHARS_RE.sub("", txt)
+    # Internada: las búsquedas en los alias (literales) comparan por puntero.
+    return sys.intern(txt)
 
 
+@functools.lru_cache(maxsize=512)
 def canonical_diet_header(name: str) -> str:
     key = normalize_header_name(name)
     return DIET_IMPORT_HEADER_ALIASES.get(key, key)
 
 
+@functools.lru_cache(maxsize=512)
 def canonical_plan_diet_header(name: str) -> str:
     key = normalize_header_name(name)
     return PLAN_DIET_HEADER_ALIASES.get(key, key)
 
 
+@functools.lru_cache(maxsize=512)
 def canonical_plan_workout_session_header(name: str) -> str:
     key = normalize_header_name(name)
     return PLAN_WORKOUT_SESSION_HEADER_ALIASES.get(key, key)
 
 
+@functools.lru_cache(maxsize=512)
 def canonical_plan_workout_exercise_header(name: str) -> str:
     key = normalize_header_name(name)
     return PLAN_WORKOUT_EXERCISE_HEADER_ALIASES.get(key, key)
 
 
+@functools.lru_cache(maxsize=512)
 def canonical_plan_workout_combined_header(name: str) -> str:
     key = normalize_header_name(name)
     direct = PLAN_WORKOUT_COMBINED_HEADER_ALIASES.get(key)
     if direct:
         return direct
 
-    m = re.match(r"^(?:exercise|ex)_?(\d+)_([a-z0-9_]+)$", key)
-    if not m:
-        m = re.match(r"^(?:exercise|ex)(\d+)_?([a-z0-9_]+)$", key)
+    m = EXERCISE_SLOT_HEADER_RE.match(key)
     if not m:
         return key
 
@@ -1224,67 +1536,104 @@ def canonical_plan_workout_combined_header(name: str) -> str:
         or suffix not in PLAN_WORKOUT_COMBINED_EXERCISE_SUFFIXES
     ):
         return key
-    return f"exercise_{slot}_{suffix}"
+    return PLAN_WORKOUT_COMBINED_SLOT_KEYS[slot][suffix]
 
 
 def parse_plan_csv_rows(
-    text: str,
+    lines,
     *,
     canonical_header_fn,
     required_fields,
 ):
-    reader = _build_csv_reader(text)
+    reader = _build_csv_reader(lines)
     headers_raw = next(reader, None)
     if not headers_raw:
         raise ValueError("CSV vacio o sin encabezados.")
 
-    headers = [canonical_header_fn(h) for h in headers_raw]
-    if len(headers) != len(set(headers)):
+    # str() en la frontera: las funciones canonical_* cachean por cabecera.
+    headers = [canonical_header_fn(str(h or "")) for h in headers_raw]
+    header_set = set(headers)
+    if len(headers) != len(header_set):
         raise ValueError("Hay columnas repetidas en el CSV (tras normalizar encabezados).")
 
-    missing = [f for f in required_fields if f not in headers]
+    missing = [f for f in required_fields if f not in header_set]
     if missing:
         raise ValueError(f"Faltan columnas obligatorias: {', '.join(missing)}")
 
+    header_count = len(headers)
     rows = []
     for line_no, row in enumerate(reader, start=2):
-        trimmed_cells = [str(cell or "").strip() for cell in row]
-        non_empty_cells = [cell for cell in trimmed_cells if cell]
-        if not non_empty_cells:
+        # Primera celda no vacía, sin construir listas intermedias (corta en cuanto la encuentra).
+        first_cell = next(filter(None, map(str.strip, row)), "")
+        if not first_cell:
             continue
         # Permite plantillas guiadas con filas de ayuda tipo #TYPE_HINT / #RULE_HINT.
-        if non_empty_cells[0].startswith("#"):
+        if first_cell.startswith("#"):
             continue
-        mapped = {}
-        for idx, key in enumerate(headers):
-            if not key:
-                continue
-            mapped[key] = row[idx].strip() if idx < len(row) else ""
+        if len(row) < header_count:
+            row += [""] * (header_count - len(row))
+        mapped = {key: cell.strip() for key, cell in zip(headers, row) if key}
         rows.append((line_no, mapped))
     return rows
 
 
 def _clip_text(v, max_len: int):
-    txt = re.sub(r"\s+", " ", str(v or "").strip())
+    txt = collapse_whitespace(str(v or "").strip())
     return txt[:max_len]
 
 
-def parse_plan_diet_row(raw_row: dict):
-    row = raw_row or {}
-    out = {k: None for k in PLAN_DIET_FIELDS}
-    errors = []
+# Piezas comunes de los validadores de filas de plan (dieta, sesiones, ejercicios).
+PLAN_DIET_TARGET_MAXIMUMS = (
+    ("calories_target_kcal", 12000),
+    ("protein_target_g", 800),
+    ("carbs_target_g", 1500),
+    ("fat_target_g", 500),
+)
+PLAN_DIET_MEAL_FIELDS = ("breakfast", "snack_1", "lunch", "snack_2", "dinner")
+PLAN_DIET_TEXT_FIELDS = tuple((field, 600) for field in PLAN_DIET_MEAL_FIELDS + ("notes",))
+PLAN_WORKOUT_SESSION_TEXT_FIELDS = tuple(
+    (field, 700)
+    for field in (
+        "warmup",
+        "class_sessions",
+        "cardio",
+        "mobility_cooldown",
+        "additional_exercises",
+        "notes",
+    )
+)
+
 
+def parse_plan_log_date(row: dict, out: dict, errors: list) -> None:
     log_date = str(row.get("log_date") or "").strip()
     if not valid_iso_date(log_date):
         errors.append("date invalida (formato AAAA-MM-DD)")
     out["log_date"] = log_date
 
-    for field, max_v in (
-        ("calories_target_kcal", 12000),
-        ("protein_target_g", 800),
-        ("carbs_target_g", 1500),
-        ("fat_target_g", 500),
-    ):
+
+def parse_plan_session_type(row: dict, out: dict, errors: list) -> None:
+    raw_type = str(row.get("session_type") or "").strip().lower()
+    if raw_type == "mixta":
+        errors.append("session_type 'mixta' ya no existe: usa 'clase' o 'pesas'")
+    elif raw_type not in ("clase", "pesas"):
+        errors.append("session_type debe ser clase o pesas")
+    out["session_type"] = raw_type if raw_type in ("clase", "pesas") else "clase"
+
+
+def clip_text_fields(row: dict, out: dict, fields) -> None:
+    get = row.get
+    for field, max_len in fields:
+        out[field] = _clip_text(get(field), max_len)
+
+
+def parse_plan_diet_row(raw_row: dict):
+    row = raw_row or {}
+    out = {k: None for k in PLAN_DIET_FIELDS}
+    errors = []
+
+    parse_plan_log_date(row, out, errors)
+
+    for field, max_v in PLAN_DIET_TARGET_MAXIMUMS:
         val, err = parse_csv_float(row.get(field))
         if err or val is None:
             errors.append(f"{field} invalido")
@@ -1294,14 +1643,8 @@ def parse_plan_diet_row(raw_row: dict):
             continue
         out[field] = float(val)
 
-    out["breakfast"] = _clip_text(row.get("breakfast"), 600)
-    out["snack_1"] = _clip_text(row.get("snack_1"), 600)
-    out["lunch"] = _clip_text(row.get("lunch"), 600)
-    out["snack_2"] = _clip_text(row.get("snack_2"), 600)
-    out["dinner"] = _clip_text(row.get("dinner"), 600)
-    out["notes"] = _clip_text(row.get("notes"), 600)
-
-    for meal_field in ("breakfast", "snack_1", "lunch", "snack_2", "dinner"):
+    clip_text_fields(row, out, PLAN_DIET_TEXT_FIELDS)
+    for meal_field in PLAN_DIET_MEAL_FIELDS:
         if not out[meal_field]:
             errors.append(f"{meal_field} no puede estar vacio")
 
@@ -1313,42 +1656,55 @@ def parse_plan_workout_session_row(raw_row: dict):
     out = {k: None for k in PLAN_WORKOUT_SESSION_FIELDS}
     errors = []
 
-    log_date = str(row.get("log_date") or "").strip()
-    if not valid_iso_date(log_date):
-        errors.append("date invalida (formato AAAA-MM-DD)")
-    out["log_date"] = log_date
+    parse_plan_log_date(row, out, errors)
 
     plan_session_id = _clip_text(row.get("plan_session_id"), 48)
     if not plan_session_id:
         errors.append("session_id obligatorio")
     out["plan_session_id"] = plan_session_id
 
-    raw_type = str(row.get("session_type") or "").strip().lower()
-    if raw_type == "mixta":
-        errors.append("session_type 'mixta' ya no existe: usa 'clase' o 'pesas'")
-    elif raw_type not in ("clase", "pesas"):
-        errors.append("session_type debe ser clase o pesas")
-    out["session_type"] = raw_type if raw_type in ("clase", "pesas") else "clase"
-
-    out["warmup"] = _clip_text(row.get("warmup"), 700)
-    out["class_sessions"] = _clip_text(row.get("class_sessions"), 700)
-    out["cardio"] = _clip_text(row.get("cardio"), 700)
-    out["mobility_cooldown"] = _clip_text(row.get("mobility_cooldown"), 700)
-    out["additional_exercises"] = _clip_text(row.get("additional_exercises"), 700)
-    out["notes"] = _clip_text(row.get("notes"), 700)
+    parse_plan_session_type(row, out, errors)
+    clip_text_fields(row, out, PLAN_WORKOUT_SESSION_TEXT_FIELDS)
 
     return out, errors
 
 
+# (campo destino, clave en CSV combinado, entero?, mínimo, máximo, rango en el mensaje)
+PLAN_EXERCISE_TARGET_SPECS = (
+    ("target_sets", "sets", True, 1, 12, " (1-12)"),
+    ("target_reps_min", "reps_min", True, 1, 100, " (1-100)"),
+    ("target_reps_max", "reps_max", True, 1, 100, " (1-100)"),
+    ("target_weight_kg", "weight_kg", False, 0, 1000, ""),
+    ("target_rpe", "rpe", False, 1, 10, " (1-10)"),
+)
+
+
+def parse_plan_exercise_targets(source: dict, *, combined: bool):
+    parse_int, parse_float = parse_csv_int, parse_csv_float
+    targets = {}
+    errors = []
+    for field, combined_key, is_int, lo, hi, range_label in PLAN_EXERCISE_TARGET_SPECS:
+        key = combined_key if combined else field
+        val, err = (parse_int if is_int else parse_float)(source.get(key))
+        if err:
+            errors.append(f"{key} invalido")
+        elif val is not None and (val < lo or val > hi):
+            errors.append(f"{key} fuera de rango{range_label}")
+        targets[field] = val
+        if field == "target_reps_max":
+            reps_min = targets["target_reps_min"]
+            if reps_min is not None and val is not None and reps_min > val:
+                min_key = "reps_min" if combined else "target_reps_min"
+                errors.append(f"{min_key} no puede ser mayor que {key}")
+    return targets, errors
+
+
 def parse_plan_workout_exercise_row(raw_row: dict):
     row = raw_row or {}
     out = {k: None for k in PLAN_WORKOUT_EXERCISE_FIELDS}
     errors = []
 
-    log_date = str(row.get("log_date") or "").strip()
-    if not valid_iso_date(log_date):
-        errors.append("date invalida (formato AAAA-MM-DD)")
-    out["log_date"] = log_date
+    parse_plan_log_date(row, out, errors)
 
     plan_session_id = _clip_text(row.get("plan_session_id"), 48)
     if not plan_session_id:
@@ -1367,47 +1723,9 @@ def parse_plan_workout_exercise_row(raw_row: dict):
         errors.append("exercise_name obligatorio")
     out["exercise_name"] = ex_name
 
-    target_sets, err = parse_csv_int(row.get("target_sets"))
-    if err:
-        errors.append("target_sets invalido")
-    elif target_sets is not None and (target_sets < 1 or target_sets > 12):
-        errors.append("target_sets fuera de rango (1-12)")
-    out["target_sets"] = target_sets
-
-    target_reps_min, err = parse_csv_int(row.get("target_reps_min"))
-    if err:
-        errors.append("target_reps_min invalido")
-    elif target_reps_min is not None and (target_reps_min < 1 or target_reps_min > 100):
-        errors.append("target_reps_min fuera de rango (1-100)")
-    out["target_reps_min"] = target_reps_min
-
-    target_reps_max, err = parse_csv_int(row.get("target_reps_max"))
-    if err:
-        errors.append("target_reps_max invalido")
-    elif target_reps_max is not None and (target_reps_max < 1 or target_reps_max > 100):
-        errors.append("target_reps_max fuera de rango (1-100)")
-    out["target_reps_max"] = target_reps_max
-
-    if (
-        target_reps_min is not None
-        and target_reps_max is not None
-        and target_reps_min > target_reps_max
-    ):
-        errors.append("target_reps_min no puede ser mayor que target_reps_max")
-
-    target_weight_kg, err = parse_csv_float(row.get("target_weight_kg"))
-    if err:
-        errors.append("target_weight_kg invalido")
-    elif target_weight_kg is not None and (target_weight_kg < 0 or target_weight_kg > 1000):
-        errors.append("target_weight_kg fuera de rango")
-    out["target_weight_kg"] = target_weight_kg
-
-    target_rpe, err = parse_csv_float(row.get("target_rpe"))
-    if err:
-        errors.append("target_rpe invalido")
-    elif target_rpe is not None and (target_rpe < 1 or target_rpe > 10):
-        errors.append("target_rpe fuera de rango (1-10)")
-    out["target_rpe"] = target_rpe
+    targets, target_errors = parse_plan_exercise_targets(row, combined=False)
+    out.update(targets)
+    errors.extend(target_errors)
 
     out["intensity_target"] = _clip_text(row.get("intensity_target"), 140)
     out["progression_weight_rule"] = _clip_text(row.get("progression_weight_rule"), 240)
@@ -1423,31 +1741,13 @@ def parse_plan_workout_combined_row(raw_row: dict):
     errors = []
     warnings = []
 
-    log_date = str(row.get("log_date") or "").strip()
-    if not valid_iso_date(log_date):
-        errors.append("date invalida (formato AAAA-MM-DD)")
-    out["log_date"] = log_date
+    parse_plan_log_date(row, out, errors)
 
-    raw_type = str(row.get("session_type") or "").strip().lower()
-    if raw_type == "mixta":
-        errors.append("session_type 'mixta' ya no existe: usa 'clase' o 'pesas'")
-    elif raw_type not in ("clase", "pesas"):
-        errors.append("session_type debe ser clase o pesas")
-    out["session_type"] = raw_type if raw_type in ("clase", "pesas") else "clase"
+    parse_plan_session_type(row, out, errors)
+    clip_text_fields(row, out, PLAN_WORKOUT_SESSION_TEXT_FIELDS)
 
-    out["warmup"] = _clip_text(row.get("warmup"), 700)
-    out["class_sessions"] = _clip_text(row.get("class_sessions"), 700)
-    out["cardio"] = _clip_text(row.get("cardio"), 700)
-    out["mobility_cooldown"] = _clip_text(row.get("mobility_cooldown"), 700)
-    out["additional_exercises"] = _clip_text(row.get("additional_exercises"), 700)
-    out["notes"] = _clip_text(row.get("notes"), 700)
-
-    for slot in range(1, PLAN_WORKOUT_COMBINED_EXERCISE_SLOTS + 1):
-        prefix = f"exercise_{slot}_"
-        raw_slot = {
-            suffix: row.get(f"{prefix}{suffix}")
-            for suffix in PLAN_WORKOUT_COMBINED_EXERCISE_SUFFIXES
-        }
+    for slot, slot_keys in PLAN_WORKOUT_COMBINED_SLOT_KEYS.items():
+        raw_slot = {suffix: row.get(key) for suffix, key in slot_keys.items()}
         if not any(str(v or "").strip() for v in raw_slot.values()):
             continue
 
@@ -1470,47 +1770,9 @@ def parse_plan_workout_combined_row(raw_row: dict):
             slot_errors.append("name obligatorio")
         item["exercise_name"] = ex_name
 
-        target_sets, err = parse_csv_int(raw_slot.get("sets"))
-        if err:
-            slot_errors.append("sets invalido")
-        elif target_sets is not None and (target_sets < 1 or target_sets > 12):
-            slot_errors.append("sets fuera de rango (1-12)")
-        item["target_sets"] = target_sets
-
-        target_reps_min, err = parse_csv_int(raw_slot.get("reps_min"))
-        if err:
-            slot_errors.append("reps_min invalido")
-        elif target_reps_min is not None and (target_reps_min < 1 or target_reps_min > 100):
-            slot_errors.append("reps_min fuera de rango (1-100)")
-        item["target_reps_min"] = target_reps_min
-
-        target_reps_max, err = parse_csv_int(raw_slot.get("reps_max"))
-        if err:
-            slot_errors.append("reps_max invalido")
-        elif target_reps_max is not None and (target_reps_max < 1 or target_reps_max > 100):
-            slot_errors.append("reps_max fuera de rango (1-100)")
-        item["target_reps_max"] = target_reps_max
-
-        if (
-            target_reps_min is not None
-            and target_reps_max is not None
-            and target_reps_min > target_reps_max
-        ):
-            slot_errors.append("reps_min no puede ser mayor que reps_max")
-
-        target_weight_kg, err = parse_csv_float(raw_slot.get("weight_kg"))
-        if err:
-            slot_errors.append("weight_kg invalido")
-        elif target_weight_kg is not None and (target_weight_kg < 0 or target_weight_kg > 1000):
-            slot_errors.append("weight_kg fuera de rango")
-        item["target_weight_kg"] = target_weight_kg
-
-        target_rpe, err = parse_csv_float(raw_slot.get("rpe"))
-        if err:
-            slot_errors.append("rpe invalido")
-        elif target_rpe is not None and (target_rpe < 1 or target_rpe > 10):
-            slot_errors.append("rpe fuera de rango (1-10)")
-        item["target_rpe"] = target_rpe
+        targets, target_errors = parse_plan_exercise_targets(raw_slot, combined=True)
+        item.update(targets)
+        slot_errors.extend(target_errors)
 
         item["intensity_target"] = _clip_text(raw_slot.get("intensity_target"), 140)
         item["progression_weight_rule"] = _clip_text(raw_slot.get("progression_weight_rule"), 240)
@@ -1543,21 +1805,47 @@ def parse_plan_score(v):
     return None
 
 
+# Las celdas numéricas de un CSV de plan se repiten mucho ("4", "8", "7.5"...):
+# el resultado (inmutable) se memoiza por texto de celda, como las fechas.
 def parse_csv_float(v):
-    raw = str(v or "").strip()
+    if isinstance(v, str):
+        return _parse_csv_float_str(v)
+    return _parse_csv_float_str(str(v or ""))
+
+
+def parse_csv_int(v):
+    if isinstance(v, str):
+        return _parse_csv_int_str(v)
+    return _parse_csv_int_str(str(v or ""))
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_csv_float_str(raw: str):
+    raw = raw.strip()
     if not raw:
         return None, None
-    raw = raw.replace(",", ".")
+    if "," in raw:
+        raw = raw.replace(",", ".")
     try:
         return float(raw), None
     except Exception:
         return None, "valor numerico invalido"
 
 
-def parse_csv_int(v):
-    raw = str(v or "").strip()
+CSV_INT_FAST_MAX_DIGITS = 15
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_csv_int_str(raw: str):
+    raw = raw.strip()
     if not raw:
         return None, None
+    # Camino rápido: entero ASCII corto ("12", "-3") sin pasar por float. Hasta
+    # 15 cifras float es exacto, así que el resultado no cambia; las celdas más
+    # largas siguen por float (int() de miles de cifras lanzaría ValueError).
+    digits = raw[1:] if raw[0] == "-" else raw
+    if len(digits) <= CSV_INT_FAST_MAX_DIGITS and digits.isascii() and digits.isdigit():
+        return int(raw), None
     raw = raw.replace(",", ".")
     try:
         num = float(raw)
@@ -1573,9 +1861,9 @@ def normalize_import_photo_path(path_value: str) -> str:
     if not rel:
         return ""
     rel = rel.lstrip("/")
-    if rel.startswith("static/uploads/"):
-        rel = rel[len("static/") :]
-    if not rel.startswith("uploads/"):
+    if rel.startswith(STATIC_UPLOADS_PREFIX):
+        rel = rel[STATIC_PREFIX_LEN:]
+    if not rel.startswith(UPLOADS_PREFIX):
         return ""
     parts = [p for p in rel.split("/") if p]
     if any(p == ".." for p in parts):
@@ -1583,25 +1871,68 @@ def normalize_import_photo_path(path_value: str) -> str:
     return "/".join(parts)
 
 
-def read_text_file_storage(file_storage) -> str:
-    raw = file_storage.read() if file_storage else b""
-    if raw is None:
-        return ""
-    if isinstance(raw, str):
-        return raw
-    for enc in ("utf-8-sig", "utf-8", "latin-1"):
-        try:
-            return raw.decode(enc)
-        except Exception:
-            continue
-    raise ValueError("No se pudo leer el CSV (encoding no soportado).")
+def _csv_upload_encoding(stream) -> tuple:
+    """
+    `(encoding, offset)` del CSV subido: UTF-8 (saltando el BOM) si todo el
+    archivo lo es; si no, latin-1, que acepta cualquier byte. Valida por bloques
+    sin construir el texto completo.
+    """
+    stream.seek(0)
+    offset = 3 if stream.read(3) == b"\xef\xbb\xbf" else 0
+    stream.seek(offset)
+    decoder = UTF8_INCREMENTAL_DECODER()
+    try:
+        for chunk in iter(functools.partial(stream.read, CSV_STREAM_CHUNK_SIZE), b""):
+            # Un bloque ASCII sin bytes pendientes del anterior ya es UTF-8 válido.
+            if chunk.isascii() and not decoder.getstate()[0]:
+                continue
+            decoder.decode(chunk)
+        decoder.decode(b"", final=True)
+        encoding = "utf-8"
+    except UnicodeDecodeError:
+        encoding = "latin-1"
+    stream.seek(offset)
+    return encoding, offset
+
+
+def csv_upload_from_request():
+    """`(file_storage, error)` del campo `file` de los importadores CSV."""
+    file_storage = request.files.get("file")
+    filename = file_storage.filename if file_storage else ""
+    if not filename:
+        return None, "Debes subir un archivo CSV."
+    # Sin lower() del nombre completo: basta con la extensión.
+    if filename[-4:].lower() != ".csv":
+        return None, "El archivo debe tener extension .csv."
+    return file_storage, None
+
+
+@contextmanager
+def open_csv_upload(file_storage):
+    """Líneas del CSV subido decodificadas al vuelo desde el stream de la subida."""
+    stream = file_storage.stream
+    # Antes de Python 3.11 el SpooledTemporaryFile de Werkzeug no es IOBase (sin
+    # seekable() ni apto como buffer de TextIOWrapper): se copia a memoria.
+    if not (isinstance(stream, IOBase) and stream.seekable()):
+        stream = BytesIO(stream.read())
+    encoding, _offset = _csv_upload_encoding(stream)
+    text = TextIOWrapper(stream, encoding=encoding, newline="")
+    try:
+        yield text
+    finally:
+        # Sin cerrar el stream de la subida (Werkzeug lo gestiona).
+        text.detach()
 
 
-def _build_csv_reader(text: str):
-    source = str(text or "")
+def _build_csv_reader(lines):
+    lines = iter(lines)
     delimiter = ","
-    for raw_line in source.splitlines():
-        line = str(raw_line or "").strip()
+    # Consume líneas solo hasta la primera no vacía para detectar el separador;
+    # luego se reinyectan delante del resto.
+    consumed = []
+    for raw_line in lines:
+        consumed.append(raw_line)
+        line = raw_line.strip()
         if not line:
             continue
         counts = {
@@ -1614,30 +1945,32 @@ def _build_csv_reader(text: str):
         if best_count > 0:
             delimiter = best
         break
-    return csv.reader(StringIO(source, newline=""), delimiter=delimiter)
+    return csv.reader(itertools.chain(consumed, lines), delimiter=delimiter)
 
 
-def parse_diet_import_csv(text: str):
-    reader = _build_csv_reader(text)
+def parse_diet_import_csv(lines):
+    reader = _build_csv_reader(lines)
     headers_raw = next(reader, None)
     if not headers_raw:
         raise ValueError("CSV vacio o sin encabezados.")
 
-    headers = [canonical_diet_header(h) for h in headers_raw]
-    if "log_date" not in headers:
+    headers = [canonical_diet_header(str(h or "")) for h in headers_raw]
+    header_set = set(headers)
+    if "log_date" not in header_set:
         raise ValueError("Falta columna obligatoria: log_date (o fecha).")
-    if len(headers) != len(set(headers)):
+    if len(headers) != len(header_set):
         raise ValueError("Hay columnas repetidas en el CSV (tras normalizar encabezados).")
 
+    header_count = len(headers)
     rows = []
     for line_no, row in enumerate(reader, start=2):
-        if not any(str(cell or "").strip() for cell in row):
+        # Un solo strip() por celda: sirve para detectar filas vacías y para el mapeo.
+        cells = list(map(str.strip, row))
+        if not any(cells):
             continue
-        mapped = {}
-        for idx, key in enumerate(headers):
-            if not key:
-                continue
-            mapped[key] = row[idx].strip() if idx < len(row) else ""
+        if len(cells) < header_count:
+            cells += [""] * (header_count - len(cells))
+        mapped = {key: cell for key, cell in zip(headers, cells) if key}
         rows.append((line_no, mapped))
     return rows
 
@@ -1726,7 +2059,11 @@ def parse_diet_import_row(raw_row: dict):
 
 
 def classify_diet_import_rows(rows, existing_dates):
+    # Conjunto para que cada comprobación de conflicto sea O(1) aunque llegue una lista.
+    if not isinstance(existing_dates, (set, frozenset)):
+        existing_dates = frozenset(existing_dates)
     preview = []
+    preview_append = preview.append
     seen_dates = set()
     counts = {"total": 0, "valid": 0, "conflict": 0, "invalid": 0}
 
@@ -1757,7 +2094,7 @@ def classify_diet_import_rows(rows, existing_dates):
             reasons.extend(warnings)
 
         counts[status] += 1
-        preview.append(
+        preview_append(
             {
                 "row_number": line_no,
                 "status": status,
@@ -1772,6 +2109,8 @@ def classify_diet_import_rows(rows, existing_dates):
 # -----------------------------
 # Photos
 # -----------------------------
+# Las rutas se repiten en cada listado de galería/dieta: resultado memoizado.
+@functools.lru_cache(maxsize=4096)
 def photo_url_from_rel(rel_path: str) -> str:
     rel_path = (rel_path or "").lstrip("/")
     if not rel_path:
@@ -1779,16 +2118,14 @@ def photo_url_from_rel(rel_path: str) -> str:
     # Normaliza rutas legacy "static/uploads/..." y actuales "uploads/..."
     # para servirlas por el endpoint explícito /uploads/...
     rel_path = rel_path.replace("\\", "/")
-    if rel_path.startswith("static/uploads/"):
-        rel_path = rel_path[len("static/") :]
-    if rel_path.startswith("uploads/"):
-        return "/" + rel_path
+    if rel_path.startswith(STATIC_UPLOADS_PREFIX):
+        rel_path = rel_path[STATIC_PREFIX_LEN:]
     return "/" + rel_path
 
 
 def sanitize_filename(name: str) -> str:
     base = os.path.basename(name or "")
-    base = re.sub(r"[^a-zA-Z0-9._-]+", "_", base).strip("_")
+    base = UNSAFE_FILENAME_CHARS_RE.sub("_", base).strip("_")
     if not base:
         base = "photo"
     return base
@@ -1800,79 +2137,84 @@ def ensure_upload_dir(log_date: str) -> str:
     return date_dir
 
 
-def _read_upload_bytes(file_storage) -> bytes:
+def _seekable_upload_stream(file_storage):
+    """
+    Devuelve `(stream, tamaño)` con el stream del upload rebobinado, sin copiar
+    sus bytes salvo que no admita `seek()`.
+    """
     stream = getattr(file_storage, "stream", None)
     if stream is None:
-        return b""
-    pos = None
-    try:
-        pos = stream.tell()
-    except Exception:
-        pos = None
+        return BytesIO(), 0
     try:
-        if pos is not None:
-            stream.seek(0)
-        return stream.read() or b""
-    finally:
-        try:
-            if pos is not None:
-                stream.seek(pos)
-            else:
-                stream.seek(0)
-        except Exception:
-            pass
+        size = stream.seek(0, os.SEEK_END)
+        stream.seek(0)
+    except (AttributeError, OSError, ValueError):
+        stream = BytesIO(stream.read() or b"")
+        size = len(stream.getbuffer())
+    return stream, size
 
 
-def _compress_photo_bytes(raw_bytes: bytes, original_ext: str):
+def _compress_photo_bytes(source, original_ext: str, original_size: int):
     """
     Devuelve `(bytes_comprimidos, extension_destino)` o `None` si no se puede
     comprimir (falta Pillow, archivo no decodificable o no mejora el tamaño).
+    `source` es un file-like con `seek()`; `original_size`, su tamaño en bytes.
+
+    Solo usa llamadas estándar de Pillow, así que Pillow-SIMD (ABI compatible,
+    p.ej. `CC="cc -mavx2" pip install pillow-simd`) acelera decode/resize sin
+    cambios de código.
     """
-    if not raw_bytes or not PHOTO_COMPRESSION_ENABLED or not PILLOW_AVAILABLE:
+    if not original_size or not PHOTO_COMPRESSION_ENABLED or not PILLOW_AVAILABLE:
         return None
+    pil = _get_pil()
+    if pil is None:
+        return None
+    Image, ImageOps, UnidentifiedImageError, resample = pil
 
+    max_box = (PHOTO_MAX_SIDE, PHOTO_MAX_SIDE)
     try:
-        with Image.open(BytesIO(raw_bytes)) as img:
+        with Image.open(source) as img:
+            # open() solo lee la cabecera: un WebP ya pequeño en bytes y en lado y
+            # sin EXIF (ni GPS ni orientación pendiente) se guarda tal cual sin
+            # decodificar. El resto pasa por el camino normal.
+            if (
+                original_size < PHOTO_SKIP_BELOW_BYTES
+                and max(img.size) <= PHOTO_MAX_SIDE
+                and img.format == "WEBP"
+                and not img.info.get("exif")
+                and not img.getexif()
+            ):
+                return None
+            if img.format == "JPEG" and max(img.size) > PHOTO_MAX_SIDE:
+                # libjpeg decodifica ya reducido (escalado DCT 1/2, 1/4, 1/8),
+                # nunca por debajo de max_box.
+                img.draft(None, max_box)
             img.load()
-            img = ImageOps.exif_transpose(img)
+            lossless = (
+                img.format == "PNG"
+                or original_ext.lower() == ".png"
+                or "A" in img.getbands()
+                or "transparency" in img.info
+            )
+            # exif_transpose copia la imagen completa; solo si la orientación EXIF
+            # (tag 0x0112) pide girar/voltear.
+            if img.getexif().get(0x0112, 1) != 1:
+                img = ImageOps.exif_transpose(img)
             if max(img.width, img.height) > PHOTO_MAX_SIDE:
-                resampling = getattr(Image, "Resampling", None)
-                lanczos = (
-                    resampling.LANCZOS
-                    if resampling is not None
-                    else getattr(Image, "LANCZOS", None)
-                )
-                if lanczos is not None:
-                    img.thumbnail((PHOTO_MAX_SIDE, PHOTO_MAX_SIDE), resample=lanczos)
+                if resample is not None:
+                    img.thumbnail(max_box, resample=resample)
                 else:
-                    img.thumbnail((PHOTO_MAX_SIDE, PHOTO_MAX_SIDE))
-
-            target_ext = original_ext.lower()
-            save_format = ""
-            save_kwargs = {}
-
-            if PHOTO_PREFER_WEBP:
-                target_ext = ".webp"
-                save_format = "WEBP"
-                save_kwargs = {"quality": PHOTO_QUALITY, "method": 6}
-            elif target_ext in (".jpg", ".jpeg"):
-                target_ext = ".jpg"
-                save_format = "JPEG"
-                save_kwargs = {"quality": PHOTO_QUALITY, "optimize": True, "progressive": True}
-            elif target_ext == ".png":
-                save_format = "PNG"
-                save_kwargs = {"optimize": True, "compress_level": 8}
-            elif target_ext == ".webp":
-                save_format = "WEBP"
-                save_kwargs = {"quality": PHOTO_QUALITY, "method": 6}
-            else:
-                return None
+                    img.thumbnail(max_box)
 
-            if save_format == "JPEG" and img.mode not in ("RGB", "L"):
-                img = img.convert("RGB")
+            # Siempre WebP: sin pérdida si el origen es PNG o tiene transparencia.
+            target_ext = ".webp"
+            if lossless:
+                save_kwargs = {"lossless": True, "method": 6}
+            else:
+                save_kwargs = {"quality": PHOTO_QUALITY, "method": 4}
 
             out = BytesIO()
-            img.save(out, format=save_format, **save_kwargs)
+            img.save(out, format="WEBP", **save_kwargs)
             candidate = out.getvalue()
     except (UnidentifiedImageError, OSError, ValueError):
         return None
@@ -1881,7 +2223,7 @@ def _compress_photo_bytes(raw_bytes: bytes, original_ext: str):
 
     if not candidate:
         return None
-    if len(candidate) >= len(raw_bytes):
+    if len(candidate) >= original_size:
         return None
     return candidate, target_ext
 
@@ -1898,22 +2240,27 @@ def save_progress_photo(file_storage, log_date: str) -> str:
         raise ValueError("Extensión de archivo no permitida")
 
     date_dir = ensure_upload_dir(log_date)
-    raw_bytes = _read_upload_bytes(file_storage)
+    # Pillow lee directamente del stream del upload; sin copia intermedia en bytes.
+    stream, size = _seekable_upload_stream(file_storage)
     final_ext = ext
-    payload_bytes = raw_bytes if raw_bytes else None
-    compressed = _compress_photo_bytes(raw_bytes, ext)
+    payload_bytes = None
+    compressed = _compress_photo_bytes(stream, ext, size)
     if compressed:
         payload_bytes, final_ext = compressed
 
-    stamp = datetime.now().strftime("%H%M%S%f")
+    # Entero en ns: único dentro del proceso y sin pasar por strftime().
+    stamp = time.time_ns()
     safe_name = sanitize_filename(os.path.splitext(original)[0])
     filename = f"{safe_name}_{stamp}{final_ext}"
 
     abs_path = os.path.join(date_dir, filename)
-    if payload_bytes is None:
-        file_storage.save(abs_path)
-    else:
-        with open(abs_path, "wb") as fh:
+    # Fichero con buffer del tamaño del bloque de copia: write() completa siempre
+    # todo el bloque (un FileIO sin buffer puede escribir menos sin avisar).
+    with open(abs_path, "wb", buffering=PHOTO_COPY_CHUNK_SIZE) as fh:
+        if payload_bytes is None:
+            stream.seek(0)
+            shutil.copyfileobj(stream, fh, PHOTO_COPY_CHUNK_SIZE)
+        else:
             fh.write(payload_bytes)
 
     # Guardamos en DB una ruta relativa estable (independiente de static folder).
@@ -1931,10 +2278,10 @@ def get_existing_photo_rel(conn, log_date: str, kind: str) -> str:
 
 def photo_rel_to_abs(rel_path: str) -> str:
     rel_path = (rel_path or "").lstrip("/").replace("\\", "/")
-    if rel_path.startswith("static/uploads/"):
-        suffix = rel_path[len("static/uploads/") :]
-    elif rel_path.startswith("uploads/"):
-        suffix = rel_path[len("uploads/") :]
+    if rel_path.startswith(STATIC_UPLOADS_PREFIX):
+        suffix = rel_path[STATIC_UPLOADS_PREFIX_LEN:]
+    elif rel_path.startswith(UPLOADS_PREFIX):
+        suffix = rel_path[UPLOADS_PREFIX_LEN:]
     else:
         return ""
     return os.path.normpath(os.path.join(UPLOAD_ROOT, suffix))
@@ -1951,7 +2298,7 @@ def safe_delete_uploaded_photo(rel_path: str) -> bool:
     rel_path = rel_path.lstrip("/").replace("\\", "/")
 
     # Aceptamos rutas legacy uploads/... y actuales static/uploads/...
-    if not (rel_path.startswith("static/uploads/") or rel_path.startswith("uploads/")):
+    if not rel_path.startswith(UPLOAD_PATH_PREFIXES):
         return False
 
     abs_candidate = photo_rel_to_abs(rel_path)
@@ -1978,8 +2325,10 @@ def safe_delete_uploaded_photo(rel_path: str) -> bool:
     try:
         d = os.path.dirname(abs_candidate)
         while d and os.path.normpath(d).startswith(abs_root):
-            if os.listdir(d):
-                break
+            # Basta con la primera entrada para saber que no está vacía.
+            with os.scandir(d) as entries:
+                if next(entries, None) is not None:
+                    break
             os.rmdir(d)
             d = os.path.dirname(d)
     except Exception:
@@ -1992,22 +2341,19 @@ def safe_delete_uploaded_photo(rel_path: str) -> bool:
 # -----------------------------
 # Reads
 # -----------------------------
-def _avg(values):
-    vals = [float(v) for v in values if v is not None]
-    if not vals:
-        return None
-    return sum(vals) / len(vals)
-
-
 def _row_whr(row) -> float:
-    try:
-        waist = float(row["waist_cm"])
-        hip = float(row["hip_cm"])
-    except Exception:
+    # Columnas REAL: llegan ya como número o None, sin float() por fila.
+    waist = row["waist_cm"]
+    hip = row["hip_cm"]
+    if waist is None or hip is None:
         return None
-    if hip <= 0:
+    try:
+        if hip <= 0:
+            return None
+        return waist / hip
+    except TypeError:
+        # Texto no numérico colado en la DB (p.ej. restauración manual).
         return None
-    return waist / hip
 
 
 def _first_last(items):
@@ -2016,19 +2362,58 @@ def _first_last(items):
     return items[0], items[-1]
 
 
-def _summary_series(rows):
-    points = []
+def _summary_metric_points(rows, with_series: bool = False):
+    """
+    Una sola pasada por `rows`: puntos `(log_date, valor)` no nulos por métrica
+    (sueño, pasos, peso, WHR) y, si se pide, la serie completa para el gráfico.
+    """
+    sleep_points = []
+    steps_points = []
+    weight_points = []
+    whr_points = []
+    series = []
     for r in rows:
-        points.append(
-            {
-                "log_date": r["log_date"],
-                "sleep_hours": r["sleep_hours"],
-                "steps": r["steps"],
-                "weight_kg": r["weight_kg"],
-                "whr": _row_whr(r),
-            }
-        )
-    return points
+        log_date = r["log_date"]
+        sleep = r["sleep_hours"]
+        steps = r["steps"]
+        weight = r["weight_kg"]
+        whr = _row_whr(r)
+        if sleep is not None:
+            sleep_points.append((log_date, sleep))
+        if steps is not None:
+            steps_points.append((log_date, steps))
+        if weight is not None:
+            weight_points.append((log_date, weight))
+        if whr is not None:
+            whr_points.append((log_date, whr))
+        if with_series:
+            series.append(
+                {
+                    "log_date": log_date,
+                    "sleep_hours": sleep,
+                    "steps": steps,
+                    "weight_kg": weight,
+                    "whr": whr,
+                }
+            )
+    return sleep_points, steps_points, weight_points, whr_points, series
+
+
+TREND_WEIGHT_STABLE_KG = 0.2
+TREND_WHR_STABLE = 0.005
+# Clave: (signo delta peso, signo delta cintura/cadera); (0, 0) = ambos estables.
+TREND_MESSAGES = {
+    (0, 0): ("Todo va estable: casi sin cambios en peso ni cintura/cadera.", "muted"),
+    (-1, -1): ("Buena señal: bajan el peso y la relacion cintura/cadera.", "good"),
+    (1, -1): ("Buena señal: sube algo el peso, pero mejora la cintura/cadera.", "good"),
+    (-1, 1): ("Señal mixta: bajas peso, pero la cintura/cadera empeora un poco.", "warn"),
+    (1, 1): ("Ojo: suben peso y cintura/cadera a la vez.", "warn"),
+    (1, 0): ("Sube el peso, con cintura/cadera bastante estable.", "muted"),
+    (-1, 0): ("Baja el peso, con cintura/cadera bastante estable.", "muted"),
+    (0, -1): ("Peso estable y cintura/cadera mejorando.", "good"),
+    (0, 1): ("Peso estable, pero cintura/cadera empeora: vigila la tendencia.", "warn"),
+}
+TREND_MESSAGE_FALLBACK = ("Tendencia mixta: interpretala junto con entreno, dieta y descanso.", "muted")
 
 
 def _trend_message(weight_delta, whr_delta):
@@ -2040,52 +2425,31 @@ def _trend_message(weight_delta, whr_delta):
 
     wd = float(weight_delta)
     hd = float(whr_delta)
-    weight_stable = abs(wd) <= 0.2
-    whr_stable = abs(hd) <= 0.005
-
-    if weight_stable and whr_stable:
-        return ("Todo va estable: casi sin cambios en peso ni cintura/cadera.", "muted")
-    if wd < 0 and hd < 0:
-        return ("Buena señal: bajan el peso y la relacion cintura/cadera.", "good")
-    if wd > 0 and hd < 0:
-        return (
-            "Buena señal: sube algo el peso, pero mejora la cintura/cadera.",
-            "good",
-        )
-    if wd < 0 and hd > 0:
-        return (
-            "Señal mixta: bajas peso, pero la cintura/cadera empeora un poco.",
-            "warn",
-        )
-    if wd > 0 and hd > 0:
-        return (
-            "Ojo: suben peso y cintura/cadera a la vez.",
-            "warn",
-        )
-    if wd > 0 and whr_stable:
-        return (
-            "Sube el peso, con cintura/cadera bastante estable.",
-            "muted",
-        )
-    if wd < 0 and whr_stable:
-        return (
-            "Baja el peso, con cintura/cadera bastante estable.",
-            "muted",
-        )
-    if weight_stable and hd < 0:
-        return ("Peso estable y cintura/cadera mejorando.", "good")
-    if weight_stable and hd > 0:
-        return ("Peso estable, pero cintura/cadera empeora: vigila la tendencia.", "warn")
-    return ("Tendencia mixta: interpretala junto con entreno, dieta y descanso.", "muted")
+    if abs(wd) <= TREND_WEIGHT_STABLE_KG and abs(hd) <= TREND_WHR_STABLE:
+        key = (0, 0)
+    else:
+        # Con alguna métrica fuera de su margen manda el signo bruto de ambas.
+        key = ((wd > 0) - (wd < 0), (hd > 0) - (hd < 0))
+    return TREND_MESSAGES.get(key, TREND_MESSAGE_FALLBACK)
+
+
+SUMMARY_WINDOW_AVG_SQL = """
+SELECT
+    AVG(sleep_hours),
+    AVG(steps),
+    AVG(weight_kg),
+    AVG(CASE WHEN hip_cm > 0 THEN waist_cm * 1.0 / hip_cm END),
+    COUNT(*)
+FROM diet_log
+WHERE log_date BETWEEN ? AND ?;
+"""
 
 
 def fetch_summary(conn, date_from: str = "", date_to: str = "", rolling_days: int = 7):
     rolling_days = parse_summary_days(rolling_days, default=7)
-    use_range = (
-        valid_iso_date(date_from)
-        and valid_iso_date(date_to)
-        and str(date_from) <= str(date_to)
-    )
+    from_dt = parse_iso_date(date_from)
+    to_dt = parse_iso_date(date_to)
+    use_range = from_dt is not None and to_dt is not None and from_dt <= to_dt
 
     window_from = ""
     window_to = ""
@@ -2105,9 +2469,9 @@ def fetch_summary(conn, date_from: str = "", date_to: str = "", rolling_days: in
         period_label = f"{date_from} -> {date_to}"
         window_from = date_from
         window_to = date_to
-        coverage_target = (datetime.strptime(date_to, "%Y-%m-%d").date() - datetime.strptime(date_from, "%Y-%m-%d").date()).days + 1
+        coverage_target = (to_dt - from_dt).days + 1
     else:
-        today = datetime.now().date()
+        today = date.today()
         rolling_from = today - timedelta(days=max(0, rolling_days - 1))
         rolling_to = today
         rows = conn.execute(
@@ -2126,68 +2490,46 @@ def fetch_summary(conn, date_from: str = "", date_to: str = "", rolling_days: in
         window_to = rolling_to.isoformat()
         coverage_target = rolling_days
 
-    avg_sleep = _avg([r["sleep_hours"] for r in rows])
-    avg_steps = _avg([r["steps"] for r in rows])
-    avg_weight = _avg([r["weight_kg"] for r in rows])
-    avg_whr = _avg([_row_whr(r) for r in rows])
+    sleep_points, steps_points, weight_points, whr_points, series_points = (
+        _summary_metric_points(rows, with_series=True)
+    )
+    # Las medias se reducen en SQLite (C) con la misma consulta que el periodo base.
+    avg_sleep, avg_steps, avg_weight, avg_whr, _count = conn.execute(
+        SUMMARY_WINDOW_AVG_SQL, (window_from, window_to)
+    ).fetchone()
 
     # Comparativa relativa contra periodo anterior equivalente
-    previous_rows = []
     baseline_label = ""
     baseline_coverage_target = 0
     if use_range:
-        from_dt = datetime.strptime(date_from, "%Y-%m-%d").date()
-        to_dt = datetime.strptime(date_to, "%Y-%m-%d").date()
         span_days = (to_dt - from_dt).days + 1
         prev_to = from_dt - timedelta(days=1)
         prev_from = prev_to - timedelta(days=max(0, span_days - 1))
         baseline_label = f"{prev_from.isoformat()} -> {prev_to.isoformat()}"
         baseline_coverage_target = span_days
-        previous_rows = conn.execute(
-            """
-            SELECT log_date, sleep_hours, steps, weight_kg, waist_cm, hip_cm
-            FROM diet_log
-            WHERE log_date BETWEEN ? AND ?
-            ORDER BY log_date ASC;
-            """,
-            (prev_from.isoformat(), prev_to.isoformat()),
-        ).fetchall()
     else:
-        today = datetime.now().date()
+        today = date.today()
         prev_to = today - timedelta(days=rolling_days)
         prev_from = prev_to - timedelta(days=max(0, rolling_days - 1))
         baseline_label = f"{prev_from.isoformat()} -> {prev_to.isoformat()}"
         baseline_coverage_target = rolling_days
-        previous_rows = conn.execute(
-            """
-            SELECT log_date, sleep_hours, steps, weight_kg, waist_cm, hip_cm
-            FROM diet_log
-            WHERE log_date BETWEEN ? AND ?
-            ORDER BY log_date ASC;
-            """
-            ,
-            (prev_from.isoformat(), prev_to.isoformat()),
-        ).fetchall()
 
-    prev_avg_sleep = _avg([r["sleep_hours"] for r in previous_rows])
-    prev_avg_steps = _avg([r["steps"] for r in previous_rows])
-    prev_avg_weight = _avg([r["weight_kg"] for r in previous_rows])
-    prev_avg_whr = _avg([_row_whr(r) for r in previous_rows])
+    # El periodo base solo aporta medias y cobertura: se agregan en SQLite.
+    (
+        prev_avg_sleep,
+        prev_avg_steps,
+        prev_avg_weight,
+        prev_avg_whr,
+        baseline_count,
+    ) = conn.execute(
+        SUMMARY_WINDOW_AVG_SQL, (prev_from.isoformat(), prev_to.isoformat())
+    ).fetchone()
 
     def _diff(curr, prev):
         if curr is None or prev is None:
             return None
         return float(curr) - float(prev)
 
-    weight_points = [(r["log_date"], r["weight_kg"]) for r in rows if r["weight_kg"] is not None]
-    sleep_points = [(r["log_date"], r["sleep_hours"]) for r in rows if r["sleep_hours"] is not None]
-    steps_points = [(r["log_date"], r["steps"]) for r in rows if r["steps"] is not None]
-    whr_points = []
-    for r in rows:
-        whr = _row_whr(r)
-        if whr is not None:
-            whr_points.append((r["log_date"], whr))
-
     w_first, w_last = _first_last(weight_points)
     s_first, s_last = _first_last(sleep_points)
     p_first, p_last = _first_last(steps_points)
@@ -2222,7 +2564,6 @@ def fetch_summary(conn, date_from: str = "", date_to: str = "", rolling_days: in
         trend_to = max(trend_dates)
 
     trend_text, trend_tone = _trend_message(delta_weight, delta_whr)
-    series_points = _summary_series(rows)
 
     return {
         "avg_sleep": avg_sleep,
@@ -2237,7 +2578,7 @@ def fetch_summary(conn, date_from: str = "", date_to: str = "", rolling_days: in
         "coverage": {
             "current_count": len(rows),
             "current_target": coverage_target,
-            "baseline_count": len(previous_rows),
+            "baseline_count": baseline_count,
             "baseline_target": baseline_coverage_target,
         },
         "trend": {
@@ -2251,7 +2592,7 @@ def fetch_summary(conn, date_from: str = "", date_to: str = "", rolling_days: in
             "tone": trend_tone,
         },
         "relative": {
-            "baseline_label": baseline_label if previous_rows else "",
+            "baseline_label": baseline_label if baseline_count else "",
             "sleep_delta": _diff(avg_sleep, prev_avg_sleep),
             "steps_delta": _diff(avg_steps, prev_avg_steps),
             "weight_delta": _diff(avg_weight, prev_avg_weight),
@@ -2270,11 +2611,9 @@ def fetch_photo_gallery(
     date_from: str = "",
     date_to: str = "",
 ):
-    use_range = (
-        valid_iso_date(date_from)
-        and valid_iso_date(date_to)
-        and str(date_from) <= str(date_to)
-    )
+    from_dt = parse_iso_date(date_from)
+    to_dt = parse_iso_date(date_to)
+    use_range = from_dt is not None and to_dt is not None and from_dt <= to_dt
     params = []
     where_parts = ["p.kind = 'progress'"]
     if use_range:
@@ -2357,23 +2696,13 @@ def fetch_diet(conn, limit: int):
         (window_from, window_to, window_days),
     ).fetchall()
 
+    # dict(Row) copia todas las columnas de golpe; solo se retocan las derivadas.
     out = []
     for r in rows:
-        out.append(
-            {
-                "log_date": r["log_date"],
-                "sleep_hours": r["sleep_hours"],
-                "sleep_quality": r["sleep_quality"],
-                "steps": r["steps"],
-                "weight_kg": r["weight_kg"],
-                "waist_cm": r["waist_cm"],
-                "hip_cm": r["hip_cm"],
-                "alcohol_units": r["alcohol_units"] or 0,
-                "creatine_yn": r["creatine_yn"],
-                "photo_yn": r["photo_yn"],
-                "photo_url": photo_url_from_rel(r["photo_path"] or ""),
-            }
-        )
+        item = dict(r)
+        item["alcohol_units"] = item["alcohol_units"] or 0
+        item["photo_url"] = photo_url_from_rel(item.pop("photo_path") or "")
+        out.append(item)
     return out
 
 
@@ -2486,17 +2815,12 @@ def fetch_supplement_catalog(conn, include_inactive: bool = True):
     ).fetchall()
     out = []
     for r in rows:
-        out.append(
-            {
-                "supplement_id": r["supplement_id"],
-                "name": r["name"],
-                "doses_per_day": r["doses_per_day"],
-                "active_yn": r["active_yn"] or "Y",
-                "notes": r["notes"] or "",
-                "created_at": r["created_at"] or "",
-                "updated_at": r["updated_at"] or "",
-            }
-        )
+        item = dict(r)
+        item["active_yn"] = item["active_yn"] or "Y"
+        item["notes"] = item["notes"] or ""
+        item["created_at"] = item["created_at"] or ""
+        item["updated_at"] = item["updated_at"] or ""
+        out.append(item)
     return out
 
 
@@ -2571,57 +2895,55 @@ def fetch_supplement_history(conn, limit: int = 15):
     if not window_from or not window_to:
         return []
 
-    date_rows = conn.execute(
-        """
-        SELECT DISTINCT log_date
-        FROM supplement_daily_log
-        WHERE log_date BETWEEN ? AND ?
-        ORDER BY log_date DESC
-        LIMIT ?;
-        """,
-        (window_from, window_to, lim),
-    ).fetchall()
-    dates = [r["log_date"] for r in date_rows if r["log_date"]]
-    if not dates:
-        return []
-
-    placeholders = ",".join(["?"] * len(dates))
+    # Una sola consulta: las N fechas más recientes y su detalle. El LEFT JOIN
+    # conserva fechas cuyos registros no casan con el catálogo (totales a 0).
     rows = conn.execute(
-        f"""
+        """
+        WITH dates AS (
+          SELECT DISTINCT log_date
+          FROM supplement_daily_log
+          WHERE log_date BETWEEN ? AND ?
+          ORDER BY log_date DESC
+          LIMIT ?
+        )
         SELECT
-          l.log_date,
-          c.name,
+          d.log_date,
+          c.supplement_id AS supplement_id,
+          c.name AS name,
           COALESCE(c.doses_per_day, 0) AS doses_per_day,
           COALESCE(l.doses_taken, 0) AS doses_taken,
           COALESCE(l.notes, '') AS notes
-        FROM supplement_daily_log l
-        JOIN supplement_catalog c ON c.supplement_id = l.supplement_id
-        WHERE l.log_date IN ({placeholders})
-        ORDER BY l.log_date DESC, c.name COLLATE NOCASE ASC;
+        FROM dates d
+        LEFT JOIN (
+          supplement_daily_log l
+          JOIN supplement_catalog c ON c.supplement_id = l.supplement_id
+        ) ON l.log_date = d.log_date
+        ORDER BY d.log_date DESC, c.name COLLATE NOCASE ASC;
         """,
-        tuple(dates),
+        (window_from, window_to, lim),
     ).fetchall()
 
     grouped = {}
-    for date in dates:
-        grouped[date] = {
-            "log_date": date,
-            "target_doses": 0,
-            "taken_doses": 0,
-            "detail_parts": [],
-            "notes_parts": [],
-        }
-
     for r in rows:
         date = r["log_date"]
-        if date not in grouped:
+        if not date:
+            continue
+        item = grouped.get(date)
+        if item is None:
+            item = grouped[date] = {
+                "log_date": date,
+                "target_doses": 0,
+                "taken_doses": 0,
+                "detail_parts": [],
+                "notes_parts": [],
+            }
+        if r["supplement_id"] is None:
             continue
         target = max(safe_int(r["doses_per_day"]) or 0, 0)
         taken = max(safe_int(r["doses_taken"]) or 0, 0)
         name = (r["name"] or "").strip() or "Suplemento"
         notes = (r["notes"] or "").strip()
 
-        item = grouped[date]
         item["target_doses"] += target
         item["taken_doses"] += taken
         item["detail_parts"].append(f"{name} {taken}/{target}")
@@ -2629,8 +2951,7 @@ def fetch_supplement_history(conn, limit: int = 15):
             item["notes_parts"].append(notes)
 
     out = []
-    for date in dates:
-        item = grouped[date]
+    for date, item in grouped.items():
         target = item["target_doses"]
         taken = item["taken_doses"]
 
@@ -2656,10 +2977,7 @@ def fetch_supplement_history(conn, limit: int = 15):
                 status = "bad"
                 adherence_label = f"{adherence_base_pct:.0f}%"
 
-        notes_unique = []
-        for n in item["notes_parts"]:
-            if n not in notes_unique:
-                notes_unique.append(n)
+        notes_unique = dict.fromkeys(item["notes_parts"])
 
         out.append(
             {
@@ -2680,196 +2998,233 @@ def fetch_supplement_history(conn, limit: int = 15):
 
 
 def compute_plan_total_score(diet_score, workout_score):
-    values = [v for v in (diet_score, workout_score) if v is not None]
-    return (sum(values) / len(values)) if values else None
+    # Media de las notas presentes; las columnas son REAL, así que ya llegan float.
+    if diet_score is None:
+        return workout_score
+    if workout_score is None:
+        return diet_score
+    return (diet_score + workout_score) * 0.5
+
+
+# Filas de adherencia del rango unión (historial + semana) con las medias de la
+# semana calculadas en SQLite como agregados de ventana sobre todo el resultado.
+PLAN_ADHERENCE_OVERVIEW_SQL = """
+SELECT
+  log_date, diet_score, workout_score, notes, updated_at,
+  SUM(in_week) OVER () AS week_logged,
+  COUNT(CASE WHEN in_week THEN total_score END) OVER () AS week_scored,
+  AVG(CASE WHEN in_week THEN total_score END) OVER () AS week_avg_total,
+  AVG(CASE WHEN in_week THEN diet_score END) OVER () AS week_avg_diet,
+  AVG(CASE WHEN in_week THEN workout_score END) OVER () AS week_avg_workout
+FROM (
+  SELECT
+    log_date, diet_score, workout_score, notes, updated_at,
+    log_date BETWEEN ? AND ? AS in_week,
+    CASE
+      WHEN diet_score IS NOT NULL AND workout_score IS NOT NULL
+        THEN (diet_score + workout_score) / 2.0
+      ELSE COALESCE(diet_score, workout_score)
+    END AS total_score
+  FROM plan_day_adherence
+  WHERE log_date BETWEEN ? AND ?
+)
+ORDER BY log_date DESC;
+"""
+
+
+PLAN_ADHERENCE_WEEK_KEYS = (
+    "week_logged", "week_scored", "week_avg_total", "week_avg_diet", "week_avg_workout",
+)
 
 
-def fetch_plan_adherence_history(conn, log_date: str, window_days: int = 15):
+def fetch_plan_adherence_overview(conn, log_date: str, window_days: int = 15):
+    """
+    Devuelve `(historial, semana, fila_del_día)`: la ventana de `window_days`
+    días que acaba en `log_date`, el resumen de su semana lunes-domingo y la fila
+    de adherencia del propio día (o `None`), con una sola consulta sobre la unión
+    de ambos rangos.
+    """
     day = log_date if valid_iso_date(log_date) else today_iso()
     days = parse_plan_adherence_days(window_days, default=15)
-    end_date = datetime.strptime(day, "%Y-%m-%d").date()
+    end_date = parse_iso_date(day)
     start_date = end_date - timedelta(days=max(0, days - 1))
+    week_start = end_date - timedelta(days=end_date.weekday())  # lunes
+    week_end = week_start + timedelta(days=6)  # domingo
 
-    rows = conn.execute(
-        """
-        SELECT log_date, diet_score, workout_score, notes, updated_at
-        FROM plan_day_adherence
-        WHERE log_date BETWEEN ? AND ?
-        ORDER BY log_date DESC;
-        """,
-        (start_date.isoformat(), end_date.isoformat()),
+    history_from, history_to = start_date.isoformat(), end_date.isoformat()
+    week_from, week_to = week_start.isoformat(), week_end.isoformat()
+
+    # Tuplas desempaquetadas: sin el envoltorio sqlite3.Row por fila.
+    cur = conn.cursor()
+    cur.row_factory = None
+    rows = cur.execute(
+        PLAN_ADHERENCE_OVERVIEW_SQL,
+        (week_from, week_to, min(history_from, week_from), max(history_to, week_to)),
     ).fetchall()
 
     items = []
-    for row in rows:
-        diet_score = row["diet_score"]
-        workout_score = row["workout_score"]
-        total_score = compute_plan_total_score(diet_score, workout_score)
+    day_row = None
+    for row_date, diet_score, workout_score, notes, updated_at, *_ in rows:
+        if not (history_from <= row_date <= history_to):
+            continue
+        if row_date == day:
+            day_row = {
+                "diet_score": diet_score,
+                "workout_score": workout_score,
+                "notes": notes,
+                "updated_at": updated_at,
+            }
         items.append(
             {
-                "log_date": row["log_date"],
+                "log_date": row_date,
                 "diet_score": diet_score,
                 "workout_score": workout_score,
-                "total_score": total_score,
-                "notes": row["notes"] or "",
-                "updated_at": row["updated_at"] or "",
+                "total_score": compute_plan_total_score(diet_score, workout_score),
+                "notes": notes or "",
+                "updated_at": updated_at or "",
             }
         )
 
-    scored_days = sum(1 for item in items if item["total_score"] is not None)
-    return {
+    # Los agregados de la semana vienen repetidos en cada fila (ventana OVER ()).
+    week_stats = dict(zip(PLAN_ADHERENCE_WEEK_KEYS, rows[0][5:])) if rows else None
+    history = {
         "window_days": days,
-        "from": start_date.isoformat(),
-        "to": end_date.isoformat(),
+        "from": history_from,
+        "to": history_to,
         "total_days": days,
         "logged_days": len(items),
-        "scored_days": scored_days,
+        "scored_days": sum(1 for item in items if item["total_score"] is not None),
         "items": items,
     }
-
-
-def fetch_plan_adherence_week_summary(conn, log_date: str):
-    day = log_date if valid_iso_date(log_date) else today_iso()
-    anchor = datetime.strptime(day, "%Y-%m-%d").date()
-    week_start = anchor - timedelta(days=anchor.weekday())  # lunes
-    week_end = week_start + timedelta(days=6)  # domingo
-
-    rows = conn.execute(
-        """
-        SELECT log_date, diet_score, workout_score, notes, updated_at
-        FROM plan_day_adherence
-        WHERE log_date BETWEEN ? AND ?
-        ORDER BY log_date ASC;
-        """,
-        (week_start.isoformat(), week_end.isoformat()),
-    ).fetchall()
-
-    total_values = []
-    diet_values = []
-    workout_values = []
-    for row in rows:
-        diet_score = row["diet_score"]
-        workout_score = row["workout_score"]
-        total_score = compute_plan_total_score(diet_score, workout_score)
-        if total_score is not None:
-            total_values.append(float(total_score))
-        if diet_score is not None:
-            diet_values.append(float(diet_score))
-        if workout_score is not None:
-            workout_values.append(float(workout_score))
-
-    def avg_or_none(values):
-        return (sum(values) / len(values)) if values else None
-
-    return {
-        "from": week_start.isoformat(),
-        "to": week_end.isoformat(),
+    week = {
+        "from": week_from,
+        "to": week_to,
         "total_days": 7,
-        "logged_days": len(rows),
-        "scored_days": len(total_values),
-        "avg_total": avg_or_none(total_values),
-        "avg_diet": avg_or_none(diet_values),
-        "avg_workout": avg_or_none(workout_values),
+        "logged_days": week_stats["week_logged"] if week_stats else 0,
+        "scored_days": week_stats["week_scored"] if week_stats else 0,
+        "avg_total": week_stats["week_avg_total"] if week_stats else None,
+        "avg_diet": week_stats["week_avg_diet"] if week_stats else None,
+        "avg_workout": week_stats["week_avg_workout"] if week_stats else None,
     }
+    return history, week, day_row
+
+
+PLAN_DAY_DIET_SQL = """
+SELECT
+  log_date, calories_target_kcal, protein_target_g, carbs_target_g, fat_target_g,
+  breakfast, snack_1, lunch, snack_2, dinner, notes, source_tag, updated_at
+FROM plan_day_diet
+WHERE log_date = ?
+LIMIT 1;
+"""
+PLAN_DAY_SESSIONS_SQL = """
+SELECT
+  s.log_date, s.plan_session_id, s.session_type, s.warmup, s.class_sessions,
+  s.cardio, s.mobility_cooldown, s.additional_exercises, s.notes, s.source_tag,
+  e.exercise_order, e.exercise_name, e.target_sets, e.target_reps_min, e.target_reps_max,
+  e.target_weight_kg, e.target_rpe, e.intensity_target, e.progression_weight_rule, e.progression_reps_rule
+FROM plan_day_workout_session s
+LEFT JOIN plan_day_workout_exercise e
+  ON e.log_date = s.log_date
+ AND e.plan_session_id = s.plan_session_id
+WHERE s.log_date = ?
+ORDER BY s.plan_session_id ASC, e.exercise_order ASC;
+"""
+# Registro real del día: dos conteos por índice (PK de diet_log e
+# idx_workout_session_date) en una sola sentencia.
+PLAN_DAY_ACTUALS_SQL = """
+SELECT
+  (SELECT COUNT(*) FROM diet_log WHERE log_date = ?) AS diet_n,
+  (SELECT COUNT(*) FROM workout_session WHERE log_date = ?) AS workout_n;
+"""
 
 
 def fetch_plan_day(conn, log_date: str, adherence_days: int = 15):
     day = log_date if valid_iso_date(log_date) else today_iso()
     adherence_window_days = parse_plan_adherence_days(adherence_days, default=15)
 
-    diet_row = conn.execute(
-        """
-        SELECT
-          log_date, calories_target_kcal, protein_target_g, carbs_target_g, fat_target_g,
-          breakfast, snack_1, lunch, snack_2, dinner, notes, source_tag, updated_at
-        FROM plan_day_diet
-        WHERE log_date = ?
-        LIMIT 1;
-        """,
-        (day,),
-    ).fetchone()
+    diet_row = conn.execute(PLAN_DAY_DIET_SQL, (day,)).fetchone()
 
-    session_rows = conn.execute(
-        """
-        SELECT
-          s.log_date, s.plan_session_id, s.session_type, s.warmup, s.class_sessions,
-          s.cardio, s.mobility_cooldown, s.additional_exercises, s.notes, s.source_tag,
-          e.exercise_order, e.exercise_name, e.target_sets, e.target_reps_min, e.target_reps_max,
-          e.target_weight_kg, e.target_rpe, e.intensity_target, e.progression_weight_rule, e.progression_reps_rule
-        FROM plan_day_workout_session s
-        LEFT JOIN plan_day_workout_exercise e
-          ON e.log_date = s.log_date
-         AND e.plan_session_id = s.plan_session_id
-        WHERE s.log_date = ?
-        ORDER BY s.plan_session_id ASC, e.exercise_order ASC;
-        """,
-        (day,),
-    ).fetchall()
+    # Tuplas desempaquetadas: sin el envoltorio sqlite3.Row ni búsquedas por nombre.
+    session_cur = conn.cursor()
+    session_cur.row_factory = None
+    session_rows = session_cur.execute(PLAN_DAY_SESSIONS_SQL, (day,)).fetchall()
 
     sessions = []
     by_key = {}
-    for r in session_rows:
-        key = str(r["plan_session_id"] or "")
-        if key not in by_key:
+    # Enlaces locales: el bucle recorre sesiones × ejercicios del plan.
+    by_key_get = by_key.get
+    append_session = sessions.append
+    for (
+        s_log_date,
+        plan_session_id,
+        session_type,
+        warmup,
+        class_sessions,
+        cardio,
+        mobility_cooldown,
+        additional_exercises,
+        s_notes,
+        source_tag,
+        exercise_order,
+        exercise_name,
+        target_sets,
+        target_reps_min,
+        target_reps_max,
+        target_weight_kg,
+        target_rpe,
+        intensity_target,
+        progression_weight_rule,
+        progression_reps_rule,
+    ) in session_rows:
+        # La API expone plan_session_id como texto; la clave ya es ese valor.
+        key = str(plan_session_id or "")
+        item = by_key_get(key)
+        if item is None:
             item = {
-                "log_date": r["log_date"],
+                "log_date": s_log_date,
                 "plan_session_id": key,
-                "session_type": r["session_type"] or "clase",
-                "warmup": r["warmup"] or "",
-                "class_sessions": r["class_sessions"] or "",
-                "cardio": r["cardio"] or "",
-                "mobility_cooldown": r["mobility_cooldown"] or "",
-                "additional_exercises": r["additional_exercises"] or "",
-                "notes": r["notes"] or "",
-                "source_tag": r["source_tag"] or "",
+                "session_type": session_type or "clase",
+                "warmup": warmup or "",
+                "class_sessions": class_sessions or "",
+                "cardio": cardio or "",
+                "mobility_cooldown": mobility_cooldown or "",
+                "additional_exercises": additional_exercises or "",
+                "notes": s_notes or "",
+                "source_tag": source_tag or "",
                 "exercises": [],
             }
             by_key[key] = item
-            sessions.append(item)
+            append_session(item)
 
-        if r["exercise_order"] is None:
+        if exercise_order is None:
             continue
-        by_key[key]["exercises"].append(
+        item["exercises"].append(
             {
-                "exercise_order": r["exercise_order"],
-                "exercise_name": r["exercise_name"] or "",
-                "target_sets": r["target_sets"],
-                "target_reps_min": r["target_reps_min"],
-                "target_reps_max": r["target_reps_max"],
-                "target_weight_kg": r["target_weight_kg"],
-                "target_rpe": r["target_rpe"],
-                "intensity_target": r["intensity_target"] or "",
-                "progression_weight_rule": r["progression_weight_rule"] or "",
-                "progression_reps_rule": r["progression_reps_rule"] or "",
+                "exercise_order": exercise_order,
+                "exercise_name": exercise_name or "",
+                "target_sets": target_sets,
+                "target_reps_min": target_reps_min,
+                "target_reps_max": target_reps_max,
+                "target_weight_kg": target_weight_kg,
+                "target_rpe": target_rpe,
+                "intensity_target": intensity_target or "",
+                "progression_weight_rule": progression_weight_rule or "",
+                "progression_reps_rule": progression_reps_rule or "",
             }
         )
 
-    adherence_row = conn.execute(
-        """
-        SELECT log_date, diet_score, workout_score, notes, updated_at
-        FROM plan_day_adherence
-        WHERE log_date = ?
-        LIMIT 1;
-        """,
-        (day,),
-    ).fetchone()
+    actual = conn.execute(PLAN_DAY_ACTUALS_SQL, (day, day)).fetchone()
+    actual_diet = actual["diet_n"] > 0
+    actual_workout_count = actual["workout_n"]
 
-    actual_diet = (
-        conn.execute("SELECT 1 FROM diet_log WHERE log_date = ? LIMIT 1;", (day,)).fetchone()
-        is not None
+    # La fila de adherencia del día sale de la misma consulta que el historial.
+    adherence_history, adherence_week, adherence_row = fetch_plan_adherence_overview(
+        conn, day, window_days=adherence_window_days
     )
-    actual_workout_count = conn.execute(
-        "SELECT COUNT(*) AS n FROM workout_session WHERE log_date = ?;",
-        (day,),
-    ).fetchone()["n"]
-
     diet_score = adherence_row["diet_score"] if adherence_row else None
     workout_score = adherence_row["workout_score"] if adherence_row else None
     total_score = compute_plan_total_score(diet_score, workout_score)
-    adherence_history = fetch_plan_adherence_history(
-        conn, day, window_days=adherence_window_days
-    )
-    adherence_week = fetch_plan_adherence_week_summary(conn, day)
 
     return {
         "log_date": day,
@@ -2913,6 +3268,22 @@ def fetch_plan_day(conn, log_date: str, adherence_days: int = 15):
     }
 
 
+def fetch_plan_day_cached(conn, log_date: str):
+    """
+    `fetch_plan_day` con la ventana por defecto, memoizado por conexión del hilo.
+    La clave incluye `PRAGMA data_version` (commits de otras conexiones) y
+    `total_changes` (escrituras de esta), así que cualquier cambio la invalida.
+    El resultado se comparte: no se debe mutar.
+    """
+    stamp = (log_date, conn.execute("PRAGMA data_version;").fetchone()[0], conn.total_changes)
+    cached = getattr(_DB_LOCAL, "plan_day_cache", None)
+    if cached is not None and cached[0] is conn and cached[1] == stamp:
+        return cached[2]
+    payload = fetch_plan_day(conn, log_date)
+    _DB_LOCAL.plan_day_cache = (conn, stamp, payload)
+    return payload
+
+
 def build_state(
     limit: int,
     date_from: str = "",
@@ -2922,6 +3293,32 @@ def build_state(
     limit = int(limit) if str(limit).isdigit() else 15
     summary_days = parse_summary_days(summary_days, default=7)
     plan_date = today_iso()
+    if STATE_PARALLEL_ENABLED:
+        pool = _state_pool()
+        futures = {
+            "summary": pool.submit(
+                _read_only_call,
+                fetch_summary,
+                date_from=date_from,
+                date_to=date_to,
+                rolling_days=summary_days,
+            ),
+            "diet": pool.submit(_read_only_call, fetch_diet, limit),
+            "workout": pool.submit(_read_only_call, fetch_workout, limit),
+            "photos": pool.submit(
+                _read_only_call,
+                fetch_photo_gallery,
+                limit=max(40, limit * 3),
+                date_from=date_from,
+                date_to=date_to,
+            ),
+        }
+        # plan_today se queda en este hilo: su caché vive en la conexión del hilo.
+        with _conn() as conn:
+            plan_today = fetch_plan_day_cached(conn, plan_date)
+        state = {key: fut.result() for key, fut in futures.items()}
+        state["plan_today"] = plan_today
+        return state
     with _conn() as conn:
         return {
             "summary": fetch_summary(
@@ -2938,7 +3335,7 @@ def build_state(
                 date_from=date_from,
                 date_to=date_to,
             ),
-            "plan_today": fetch_plan_day(conn, plan_date),
+            "plan_today": fetch_plan_day_cached(conn, plan_date),
         }
 
 
@@ -2951,8 +3348,35 @@ def count_upload_files() -> int:
 
 def create_db_snapshot(snapshot_path: Path):
     snapshot_path.parent.mkdir(parents=True, exist_ok=True)
-    with closing(sqlite3.connect(DB_PATH)) as src, closing(sqlite3.connect(snapshot_path)) as dst:
-        src.backup(dst)
+    if sqlite3.sqlite_version_info < (3, 27, 0):
+        with closing(sqlite3.connect(DB_PATH)) as src, closing(sqlite3.connect(snapshot_path)) as dst:
+            src.backup(dst)
+        return
+    # VACUUM INTO: copia consistente y compactada en una sola sentencia (en WAL
+    # no bloquea a los escritores). El destino no puede existir.
+    if snapshot_path.exists():
+        snapshot_path.unlink()
+    with closing(sqlite3.connect(DB_PATH)) as src:
+        src.execute("VACUUM INTO ?;", (str(snapshot_path),))
+
+
+def checkpoint_db(db_path: Path):
+    """
+    Vuelca el WAL al archivo principal para poder copiar/sustituir la DB
+    como un único fichero.
+    """
+    if not db_path.exists():
+        return
+    with closing(sqlite3.connect(db_path)) as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+
+
+def remove_wal_sidecars(db_path: Path):
+    # Un -wal/-shm huérfano se aplicaría sobre la DB restaurada.
+    for suffix in ("-wal", "-shm"):
+        sidecar = db_path.with_name(db_path.name + suffix)
+        if sidecar.exists():
+            sidecar.unlink()
 
 
 def is_safe_backup_member(member_name: str) -> bool:
@@ -2960,11 +3384,7 @@ def is_safe_backup_member(member_name: str) -> bool:
     if not raw or raw.startswith("/") or raw.endswith("/"):
         return False
     norm = os.path.normpath(raw).replace("\\", "/")
-    if norm.startswith("../") or norm == "..":
-        return False
-    if "/../" in f"/{norm}/":
-        return False
-    return True
+    return BACKUP_PARENT_SEGMENT_RE.search(norm) is None
 
 
 @APP.context_processor
@@ -2994,6 +3414,21 @@ def request_csrf_token() -> str:
     return ""
 
 
+@APP.before_request
+def reject_oversized_body():
+    # Corta por Content-Length antes de leer el cuerpo (y antes del CSRF, que
+    # parsearía el formulario). Solo las subidas usan MAX_CONTENT_LENGTH.
+    length = request.content_length
+    if not length:
+        return None
+    max_len = APP.config.get("MAX_CONTENT_LENGTH")
+    if request.endpoint not in UPLOAD_ENDPOINTS:
+        max_len = min(max_len or JSON_MAX_CONTENT_LENGTH, JSON_MAX_CONTENT_LENGTH)
+    if max_len and length > max_len:
+        return payload_too_large_response(max_len)
+    return None
+
+
 @APP.before_request
 def csrf_protect():
     # Keep a per-session token ready for all rendered pages/forms.
@@ -3002,7 +3437,11 @@ def csrf_protect():
         return None
 
     received = request_csrf_token()
-    if received and hmac.compare_digest(expected, received):
+    # En bytes: compare_digest rechaza (TypeError) strings no ASCII y el token
+    # recibido viene del cliente.
+    if received and hmac.compare_digest(
+        expected.encode("ascii"), received.encode("utf-8", "surrogatepass")
+    ):
         return None
     return jsonify({"ok": False, "error": "CSRF token inválido."}), 403
 
@@ -3045,7 +3484,7 @@ def login_submit():
 
     password = request.form.get("password", "")
     next_path = safe_next_path(request.form.get("next") or request.args.get("next"))
-    if password and check_password_hash(AUTH_PASSWORD_HASH, password):
+    if password and check_password_hash(auth_password_hash(), password):
         session.clear()
         session["auth_ok"] = True
         session[CSRF_SESSION_KEY] = secrets.token_hex(32)
@@ -3092,19 +3531,50 @@ def changelog_page():
 # -----------------------------
 # Routes (API)
 # -----------------------------
+# Un commit en WAL toca el -wal (y un checkpoint la DB): su stat sirve de versión
+# de los datos. Con un mtime demasiado reciente no se emite ETag, porque otro
+# commit dentro del mismo tick del FS no lo cambiaría.
+STATE_ETAG_RACY_NS = 2_000_000_000
+
+
+def state_etag(*parts) -> str:
+    db_path = Path(DB_PATH)
+    now_ns = time.time_ns()
+    stamps = []
+    for path in (db_path, db_path.with_name(db_path.name + "-wal")):
+        try:
+            st = os.stat(path)
+        except OSError:
+            stamps.append(None)
+            continue
+        if now_ns - st.st_mtime_ns <= STATE_ETAG_RACY_NS:
+            return ""
+        stamps.append((st.st_ino, st.st_size, st.st_mtime_ns))
+    key = repr((str(db_path), _DB_GENERATION, today_iso(), stamps, parts))
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=12).hexdigest()
+
+
 @APP.get("/api/state")
 def api_state():
     limit = request.args.get("limit", "15")
     date_from = (request.args.get("date_from") or "").strip()
     date_to = (request.args.get("date_to") or "").strip()
     summary_days = parse_summary_days(request.args.get("summary_days"), default=7)
-    state = build_state(
-        limit=limit,
-        date_from=date_from,
-        date_to=date_to,
-        summary_days=summary_days,
-    )
-    return jsonify(state)
+    etag = state_etag(limit, date_from, date_to, summary_days)
+    if etag and request.if_none_match.contains_weak(etag):
+        res = APP.response_class(status=304)
+    else:
+        state = build_state(
+            limit=limit,
+            date_from=date_from,
+            date_to=date_to,
+            summary_days=summary_days,
+        )
+        res = jsonify(state)
+    if etag:
+        res.set_etag(etag, weak=True)
+        res.headers["Cache-Control"] = "no-cache"
+    return res
 
 
 @APP.get("/api/supplements/history")
@@ -3135,7 +3605,7 @@ def api_supplements_config_post():
     doses_per_day = safe_int(data.get("doses_per_day"))
     active_yn = yes_no(data.get("active_yn"), default="Y")
     notes = str(data.get("notes") or "").strip()[:240]
-    now_iso = datetime.now().replace(microsecond=0).isoformat()
+    now_iso = local_now_iso()
 
     if not name:
         return jsonify({"ok": False, "error": "Nombre de suplemento requerido."}), 400
@@ -3272,6 +3742,31 @@ def api_supplements_day_get():
     return jsonify({"ok": True, **day})
 
 
+# Lista de IDs como un único parámetro JSON: texto SQL fijo (cacheable) sea cual
+# sea el número de suplementos enviados.
+SUPPLEMENT_KNOWN_IDS_SQL = """
+SELECT supplement_id
+FROM supplement_catalog
+WHERE supplement_id IN (SELECT value FROM json_each(?));
+"""
+
+SUPPLEMENT_DAY_PRUNE_SQL = """
+DELETE FROM supplement_daily_log
+WHERE log_date = ?
+  AND supplement_id NOT IN (SELECT value FROM json_each(?));
+"""
+SUPPLEMENT_DAY_UPSERT_SQL = """
+INSERT INTO supplement_daily_log (
+  log_date, supplement_id, doses_taken, notes, created_at, updated_at
+)
+VALUES (?, ?, ?, ?, ?, ?5)
+ON CONFLICT(log_date, supplement_id) DO UPDATE SET
+  doses_taken = excluded.doses_taken,
+  notes = excluded.notes,
+  updated_at = excluded.updated_at;
+"""
+
+
 @APP.post("/api/supplements/day")
 def api_supplements_day_post():
     data = request.get_json(silent=True) or {}
@@ -3305,42 +3800,32 @@ def api_supplements_day_post():
         notes = str(item.get("notes") or "").strip()[:240]
         cleaned.append((sid, doses_taken, notes or None))
 
-    now_iso = datetime.now().replace(microsecond=0).isoformat()
+    now_iso = local_now_iso()
     with _conn() as conn:
         known_ids = {
             r["supplement_id"]
             for r in conn.execute(
-                "SELECT supplement_id FROM supplement_catalog WHERE supplement_id IN (%s);"
-                % ",".join(["?"] * len(cleaned)),
-                tuple(item[0] for item in cleaned),
-            ).fetchall()
+                SUPPLEMENT_KNOWN_IDS_SQL, (json.dumps([item[0] for item in cleaned]),)
+            )
         } if cleaned else set()
 
         for sid, _doses_taken, _notes in cleaned:
             if sid not in known_ids:
                 return jsonify({"ok": False, "error": f"Suplemento no encontrado (ID {sid})."}), 404
 
-        conn.execute("DELETE FROM supplement_daily_log WHERE log_date = ?;", (log_date,))
+        # Poda de lo que ya no viene + UPSERT: las filas sin cambios conservan
+        # rowid y created_at en vez de borrarse y reinsertarse.
+        conn.execute(
+            SUPPLEMENT_DAY_PRUNE_SQL,
+            (log_date, json.dumps([item[0] for item in cleaned])),
+        )
         if cleaned:
-            batch_rows = [
-                (
-                    log_date,
-                    sid,
-                    doses_taken,
-                    notes,
-                    now_iso,
-                    now_iso,
-                )
-                for sid, doses_taken, notes in cleaned
-            ]
             conn.executemany(
-                """
-                INSERT INTO supplement_daily_log (
-                  log_date, supplement_id, doses_taken, notes, created_at, updated_at
-                )
-                VALUES (?, ?, ?, ?, ?, ?);
-                """,
-                batch_rows,
+                SUPPLEMENT_DAY_UPSERT_SQL,
+                [
+                    (log_date, sid, doses_taken, notes, now_iso)
+                    for sid, doses_taken, notes in cleaned
+                ],
             )
         conn.commit()
         day = fetch_supplement_day(conn, log_date)
@@ -3415,7 +3900,7 @@ def api_plan_adherence_post():
                     diet_score,
                     workout_score,
                     notes or None,
-                    datetime.now().replace(microsecond=0).isoformat(),
+                    local_now_iso(),
                 ),
             )
         conn.commit()
@@ -3423,24 +3908,139 @@ def api_plan_adherence_post():
     return jsonify({"ok": True, **payload})
 
 
+
+PLAN_DIET_UPSERT_SQL = """
+INSERT INTO plan_day_diet (
+  log_date, calories_target_kcal, protein_target_g, carbs_target_g, fat_target_g,
+  breakfast, snack_1, lunch, snack_2, dinner, notes, source_tag, created_at, updated_at
+)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?13)
+ON CONFLICT(log_date) DO UPDATE SET
+  calories_target_kcal=excluded.calories_target_kcal,
+  protein_target_g=excluded.protein_target_g,
+  carbs_target_g=excluded.carbs_target_g,
+  fat_target_g=excluded.fat_target_g,
+  breakfast=excluded.breakfast,
+  snack_1=excluded.snack_1,
+  lunch=excluded.lunch,
+  snack_2=excluded.snack_2,
+  dinner=excluded.dinner,
+  notes=excluded.notes,
+  source_tag=excluded.source_tag,
+  updated_at=excluded.updated_at;
+"""
+PLAN_WORKOUT_SESSION_UPSERT_SQL = """
+INSERT INTO plan_day_workout_session (
+  log_date, plan_session_id, session_type, warmup, class_sessions, cardio,
+  mobility_cooldown, additional_exercises, notes, source_tag, created_at, updated_at
+)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?11)
+ON CONFLICT(log_date, plan_session_id) DO UPDATE SET
+  session_type=excluded.session_type,
+  warmup=excluded.warmup,
+  class_sessions=excluded.class_sessions,
+  cardio=excluded.cardio,
+  mobility_cooldown=excluded.mobility_cooldown,
+  additional_exercises=excluded.additional_exercises,
+  notes=excluded.notes,
+  source_tag=excluded.source_tag,
+  updated_at=excluded.updated_at;
+"""
+PLAN_WORKOUT_EXERCISE_INSERT_SQL = """
+INSERT INTO plan_day_workout_exercise (
+  log_date, plan_session_id, exercise_order, exercise_name,
+  target_sets, target_reps_min, target_reps_max, target_weight_kg, target_rpe,
+  intensity_target, progression_weight_rule, progression_reps_rule, created_at, updated_at
+)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?13);
+"""
+# Pares (log_date, plan_session_id) como un único array JSON: una sola
+# sentencia fija (cacheable) y sin el límite de variables de un IN expandido.
+PLAN_SESSION_KEYS_JSON_SQL = """
+SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]') FROM json_each(?)
+"""
+PLAN_WORKOUT_EXERCISE_DELETE_SQL = f"""
+DELETE FROM plan_day_workout_exercise
+WHERE (log_date, plan_session_id) IN ({PLAN_SESSION_KEYS_JSON_SQL});
+"""
+PLAN_WORKOUT_SESSION_KNOWN_SQL = f"""
+SELECT log_date, plan_session_id
+FROM plan_day_workout_session
+WHERE (log_date, plan_session_id) IN ({PLAN_SESSION_KEYS_JSON_SQL});
+"""
+
+
+# Los importadores validan fila a fila y acumulan parámetros; la escritura va
+# después en un executemany por sentencia. created_at y updated_at comparten
+# parámetro (?N repetido en el SQL): un valor menos que enlazar por fila.
+def _plan_diet_params(normalized: dict, source_tag: str, now_iso: str) -> tuple:
+    return (
+        normalized["log_date"],
+        normalized["calories_target_kcal"],
+        normalized["protein_target_g"],
+        normalized["carbs_target_g"],
+        normalized["fat_target_g"],
+        normalized["breakfast"],
+        normalized["snack_1"],
+        normalized["lunch"],
+        normalized["snack_2"],
+        normalized["dinner"],
+        normalized["notes"] or None,
+        source_tag or "manual",
+        now_iso,
+    )
+
+
+def _plan_session_params(
+    log_date: str, plan_session_id: str, normalized: dict, source_tag: str, now_iso: str
+) -> tuple:
+    return (
+        log_date,
+        plan_session_id,
+        normalized["session_type"],
+        normalized["warmup"] or None,
+        normalized["class_sessions"] or None,
+        normalized["cardio"] or None,
+        normalized["mobility_cooldown"] or None,
+        normalized["additional_exercises"] or None,
+        normalized["notes"] or None,
+        source_tag or "manual",
+        now_iso,
+    )
+
+
+def _plan_exercise_params(log_date: str, plan_session_id: str, ex: dict, now_iso: str) -> tuple:
+    return (
+        log_date,
+        plan_session_id,
+        ex["exercise_order"],
+        ex["exercise_name"],
+        ex["target_sets"],
+        ex["target_reps_min"],
+        ex["target_reps_max"],
+        ex["target_weight_kg"],
+        ex["target_rpe"],
+        ex["intensity_target"] or None,
+        ex["progression_weight_rule"] or None,
+        ex["progression_reps_rule"] or None,
+        now_iso,
+    )
+
+
 @APP.post("/api/plan/import/diet")
 def api_plan_import_diet():
-    file_storage = request.files.get("file")
-    if not file_storage or not getattr(file_storage, "filename", ""):
-        return jsonify({"ok": False, "error": "Debes subir un archivo CSV."}), 400
-
-    filename = str(file_storage.filename or "").lower()
-    if filename and not filename.endswith(".csv"):
-        return jsonify({"ok": False, "error": "El archivo debe tener extension .csv."}), 400
+    file_storage, err = csv_upload_from_request()
+    if err:
+        return jsonify({"ok": False, "error": err}), 400
 
     source_tag = _clip_text(request.form.get("source_tag") or "manual", 80)
     try:
-        text = read_text_file_storage(file_storage)
-        rows = parse_plan_csv_rows(
-            text,
-            canonical_header_fn=canonical_plan_diet_header,
-            required_fields=PLAN_DIET_REQUIRED,
-        )
+        with open_csv_upload(file_storage) as lines:
+            rows = parse_plan_csv_rows(
+                lines,
+                canonical_header_fn=canonical_plan_diet_header,
+                required_fields=PLAN_DIET_REQUIRED,
+            )
     except ValueError as e:
         return jsonify({"ok": False, "error": str(e)}), 400
     except Exception:
@@ -3449,7 +4049,8 @@ def api_plan_import_diet():
     seen_dates = set()
     summary = {"total": len(rows), "imported": 0, "invalid": 0}
     results = []
-    now_iso = datetime.now().replace(microsecond=0).isoformat()
+    diet_params = []
+    now_iso = local_now_iso()
 
     with _conn() as conn:
         for line_no, row in rows:
@@ -3472,44 +4073,7 @@ def api_plan_import_diet():
                     seen_dates.add(log_date)
                 continue
 
-            conn.execute(
-                """
-                INSERT INTO plan_day_diet (
-                  log_date, calories_target_kcal, protein_target_g, carbs_target_g, fat_target_g,
-                  breakfast, snack_1, lunch, snack_2, dinner, notes, source_tag, created_at, updated_at
-                )
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ON CONFLICT(log_date) DO UPDATE SET
-                  calories_target_kcal=excluded.calories_target_kcal,
-                  protein_target_g=excluded.protein_target_g,
-                  carbs_target_g=excluded.carbs_target_g,
-                  fat_target_g=excluded.fat_target_g,
-                  breakfast=excluded.breakfast,
-                  snack_1=excluded.snack_1,
-                  lunch=excluded.lunch,
-                  snack_2=excluded.snack_2,
-                  dinner=excluded.dinner,
-                  notes=excluded.notes,
-                  source_tag=excluded.source_tag,
-                  updated_at=excluded.updated_at;
-                """,
-                (
-                    normalized["log_date"],
-                    normalized["calories_target_kcal"],
-                    normalized["protein_target_g"],
-                    normalized["carbs_target_g"],
-                    normalized["fat_target_g"],
-                    normalized["breakfast"],
-                    normalized["snack_1"],
-                    normalized["lunch"],
-                    normalized["snack_2"],
-                    normalized["dinner"],
-                    normalized["notes"] or None,
-                    source_tag or "manual",
-                    now_iso,
-                    now_iso,
-                ),
-            )
+            diet_params.append(_plan_diet_params(normalized, source_tag, now_iso))
             seen_dates.add(log_date)
             summary["imported"] += 1
             results.append(
@@ -3520,6 +4084,9 @@ def api_plan_import_diet():
                     "row": normalized,
                 }
             )
+        if diet_params:
+            begin_immediate(conn)
+            conn.executemany(PLAN_DIET_UPSERT_SQL, diet_params)
         conn.commit()
 
     return jsonify(
@@ -3538,22 +4105,18 @@ def _plan_session_id_from_order(order: int) -> str:
 
 @APP.post("/api/plan/import/workout")
 def api_plan_import_workout_combined():
-    file_storage = request.files.get("file")
-    if not file_storage or not getattr(file_storage, "filename", ""):
-        return jsonify({"ok": False, "error": "Debes subir un archivo CSV."}), 400
-
-    filename = str(file_storage.filename or "").lower()
-    if filename and not filename.endswith(".csv"):
-        return jsonify({"ok": False, "error": "El archivo debe tener extension .csv."}), 400
+    file_storage, err = csv_upload_from_request()
+    if err:
+        return jsonify({"ok": False, "error": err}), 400
 
     source_tag = _clip_text(request.form.get("source_tag") or "manual", 80)
     try:
-        text = read_text_file_storage(file_storage)
-        rows = parse_plan_csv_rows(
-            text,
-            canonical_header_fn=canonical_plan_workout_combined_header,
-            required_fields=PLAN_WORKOUT_COMBINED_REQUIRED,
-        )
+        with open_csv_upload(file_storage) as lines:
+            rows = parse_plan_csv_rows(
+                lines,
+                canonical_header_fn=canonical_plan_workout_combined_header,
+                required_fields=PLAN_WORKOUT_COMBINED_REQUIRED,
+            )
     except ValueError as e:
         return jsonify({"ok": False, "error": str(e)}), 400
     except Exception:
@@ -3561,9 +4124,12 @@ def api_plan_import_workout_combined():
 
     summary = {"total": len(rows), "imported": 0, "invalid": 0, "warned": 0}
     results = []
-    now_iso = datetime.now().replace(microsecond=0).isoformat()
+    now_iso = local_now_iso()
     order_by_date = {}
     seen_keys = set()
+    session_params = []
+    session_keys = []
+    exercise_params = []
 
     with _conn() as conn:
         for line_no, row in rows:
@@ -3599,71 +4165,15 @@ def api_plan_import_workout_combined():
                     seen_keys.add(key)
                 continue
 
-            conn.execute(
-                """
-                INSERT INTO plan_day_workout_session (
-                  log_date, plan_session_id, session_type, warmup, class_sessions, cardio,
-                  mobility_cooldown, additional_exercises, notes, source_tag, created_at, updated_at
-                )
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ON CONFLICT(log_date, plan_session_id) DO UPDATE SET
-                  session_type=excluded.session_type,
-                  warmup=excluded.warmup,
-                  class_sessions=excluded.class_sessions,
-                  cardio=excluded.cardio,
-                  mobility_cooldown=excluded.mobility_cooldown,
-                  additional_exercises=excluded.additional_exercises,
-                  notes=excluded.notes,
-                  source_tag=excluded.source_tag,
-                  updated_at=excluded.updated_at;
-                """,
-                (
-                    log_date,
-                    plan_session_id,
-                    normalized["session_type"],
-                    normalized["warmup"] or None,
-                    normalized["class_sessions"] or None,
-                    normalized["cardio"] or None,
-                    normalized["mobility_cooldown"] or None,
-                    normalized["additional_exercises"] or None,
-                    normalized["notes"] or None,
-                    source_tag or "manual",
-                    now_iso,
-                    now_iso,
-                ),
+            session_params.append(
+                _plan_session_params(log_date, plan_session_id, normalized, source_tag, now_iso)
             )
-
-            conn.execute(
-                "DELETE FROM plan_day_workout_exercise WHERE log_date = ? AND plan_session_id = ?;",
-                (log_date, plan_session_id),
+            # Reimportar una sesión sustituye su lista de ejercicios completa.
+            session_keys.append((log_date, plan_session_id))
+            exercise_params.extend(
+                _plan_exercise_params(log_date, plan_session_id, ex, now_iso)
+                for ex in normalized.get("exercises", [])
             )
-            for ex in normalized.get("exercises", []):
-                conn.execute(
-                    """
-                    INSERT INTO plan_day_workout_exercise (
-                      log_date, plan_session_id, exercise_order, exercise_name,
-                      target_sets, target_reps_min, target_reps_max, target_weight_kg, target_rpe,
-                      intensity_target, progression_weight_rule, progression_reps_rule, created_at, updated_at
-                    )
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
-                    """,
-                    (
-                        log_date,
-                        plan_session_id,
-                        ex["exercise_order"],
-                        ex["exercise_name"],
-                        ex["target_sets"],
-                        ex["target_reps_min"],
-                        ex["target_reps_max"],
-                        ex["target_weight_kg"],
-                        ex["target_rpe"],
-                        ex["intensity_target"] or None,
-                        ex["progression_weight_rule"] or None,
-                        ex["progression_reps_rule"] or None,
-                        now_iso,
-                        now_iso,
-                    ),
-                )
 
             summary["imported"] += 1
             if warnings:
@@ -3677,6 +4187,12 @@ def api_plan_import_workout_combined():
                     "row": normalized,
                 }
             )
+        if session_params:
+            begin_immediate(conn)
+            conn.executemany(PLAN_WORKOUT_SESSION_UPSERT_SQL, session_params)
+            conn.execute(PLAN_WORKOUT_EXERCISE_DELETE_SQL, (json.dumps(session_keys),))
+        if exercise_params:
+            conn.executemany(PLAN_WORKOUT_EXERCISE_INSERT_SQL, exercise_params)
         conn.commit()
 
     return jsonify(
@@ -3691,22 +4207,18 @@ def api_plan_import_workout_combined():
 
 @APP.post("/api/plan/import/workout-sessions")
 def api_plan_import_workout_sessions():
-    file_storage = request.files.get("file")
-    if not file_storage or not getattr(file_storage, "filename", ""):
-        return jsonify({"ok": False, "error": "Debes subir un archivo CSV."}), 400
-
-    filename = str(file_storage.filename or "").lower()
-    if filename and not filename.endswith(".csv"):
-        return jsonify({"ok": False, "error": "El archivo debe tener extension .csv."}), 400
+    file_storage, err = csv_upload_from_request()
+    if err:
+        return jsonify({"ok": False, "error": err}), 400
 
     source_tag = _clip_text(request.form.get("source_tag") or "manual", 80)
     try:
-        text = read_text_file_storage(file_storage)
-        rows = parse_plan_csv_rows(
-            text,
-            canonical_header_fn=canonical_plan_workout_session_header,
-            required_fields=PLAN_WORKOUT_SESSION_REQUIRED,
-        )
+        with open_csv_upload(file_storage) as lines:
+            rows = parse_plan_csv_rows(
+                lines,
+                canonical_header_fn=canonical_plan_workout_session_header,
+                required_fields=PLAN_WORKOUT_SESSION_REQUIRED,
+            )
     except ValueError as e:
         return jsonify({"ok": False, "error": str(e)}), 400
     except Exception:
@@ -3715,7 +4227,8 @@ def api_plan_import_workout_sessions():
     summary = {"total": len(rows), "imported": 0, "invalid": 0}
     results = []
     seen_keys = set()
-    now_iso = datetime.now().replace(microsecond=0).isoformat()
+    session_params = []
+    now_iso = local_now_iso()
 
     with _conn() as conn:
         for line_no, row in rows:
@@ -3738,38 +4251,10 @@ def api_plan_import_workout_sessions():
                     seen_keys.add(key)
                 continue
 
-            conn.execute(
-                """
-                INSERT INTO plan_day_workout_session (
-                  log_date, plan_session_id, session_type, warmup, class_sessions, cardio,
-                  mobility_cooldown, additional_exercises, notes, source_tag, created_at, updated_at
+            session_params.append(
+                _plan_session_params(
+                    normalized["log_date"], normalized["plan_session_id"], normalized, source_tag, now_iso
                 )
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ON CONFLICT(log_date, plan_session_id) DO UPDATE SET
-                  session_type=excluded.session_type,
-                  warmup=excluded.warmup,
-                  class_sessions=excluded.class_sessions,
-                  cardio=excluded.cardio,
-                  mobility_cooldown=excluded.mobility_cooldown,
-                  additional_exercises=excluded.additional_exercises,
-                  notes=excluded.notes,
-                  source_tag=excluded.source_tag,
-                  updated_at=excluded.updated_at;
-                """,
-                (
-                    normalized["log_date"],
-                    normalized["plan_session_id"],
-                    normalized["session_type"],
-                    normalized["warmup"] or None,
-                    normalized["class_sessions"] or None,
-                    normalized["cardio"] or None,
-                    normalized["mobility_cooldown"] or None,
-                    normalized["additional_exercises"] or None,
-                    normalized["notes"] or None,
-                    source_tag or "manual",
-                    now_iso,
-                    now_iso,
-                ),
             )
             seen_keys.add(key)
             summary["imported"] += 1
@@ -3781,6 +4266,9 @@ def api_plan_import_workout_sessions():
                     "row": normalized,
                 }
             )
+        if session_params:
+            begin_immediate(conn)
+            conn.executemany(PLAN_WORKOUT_SESSION_UPSERT_SQL, session_params)
         conn.commit()
 
     return jsonify(
@@ -3795,21 +4283,17 @@ def api_plan_import_workout_sessions():
 
 @APP.post("/api/plan/import/workout-exercises")
 def api_plan_import_workout_exercises():
-    file_storage = request.files.get("file")
-    if not file_storage or not getattr(file_storage, "filename", ""):
-        return jsonify({"ok": False, "error": "Debes subir un archivo CSV."}), 400
-
-    filename = str(file_storage.filename or "").lower()
-    if filename and not filename.endswith(".csv"):
-        return jsonify({"ok": False, "error": "El archivo debe tener extension .csv."}), 400
+    file_storage, err = csv_upload_from_request()
+    if err:
+        return jsonify({"ok": False, "error": err}), 400
 
     try:
-        text = read_text_file_storage(file_storage)
-        rows = parse_plan_csv_rows(
-            text,
-            canonical_header_fn=canonical_plan_workout_exercise_header,
-            required_fields=PLAN_WORKOUT_EXERCISE_REQUIRED,
-        )
+        with open_csv_upload(file_storage) as lines:
+            rows = parse_plan_csv_rows(
+                lines,
+                canonical_header_fn=canonical_plan_workout_exercise_header,
+                required_fields=PLAN_WORKOUT_EXERCISE_REQUIRED,
+            )
     except ValueError as e:
         return jsonify({"ok": False, "error": str(e)}), 400
     except Exception:
@@ -3845,8 +4329,10 @@ def api_plan_import_workout_exercises():
         seen_keys.add(key)
         valid_rows.append((line_no, normalized))
 
-    now_iso = datetime.now().replace(microsecond=0).isoformat()
+    now_iso = local_now_iso()
     with _conn() as conn:
+        # La comprobación de sesiones y la escritura, bajo el mismo lock.
+        begin_immediate(conn)
         session_keys = sorted(
             {
                 (row["log_date"], row["plan_session_id"])
@@ -3855,20 +4341,9 @@ def api_plan_import_workout_exercises():
             }
         )
         if session_keys:
-            placeholders = ",".join(["(?, ?)"] * len(session_keys))
-            flat = []
-            for d, sid in session_keys:
-                flat.extend([d, sid])
             known_session_keys = {
                 (r["log_date"], r["plan_session_id"])
-                for r in conn.execute(
-                    f"""
-                    SELECT log_date, plan_session_id
-                    FROM plan_day_workout_session
-                    WHERE (log_date, plan_session_id) IN ({placeholders});
-                    """,
-                    tuple(flat),
-                ).fetchall()
+                for r in conn.execute(PLAN_WORKOUT_SESSION_KNOWN_SQL, (json.dumps(session_keys),))
             }
         else:
             known_session_keys = set()
@@ -3890,39 +4365,17 @@ def api_plan_import_workout_exercises():
 
         final_rows = [x for i, x in enumerate(valid_rows) if i not in missing_idx]
         touched_sessions = sorted({(r["log_date"], r["plan_session_id"]) for _, r in final_rows})
-        for log_date, session_id in touched_sessions:
-            conn.execute(
-                "DELETE FROM plan_day_workout_exercise WHERE log_date = ? AND plan_session_id = ?;",
-                (log_date, session_id),
-            )
+        if touched_sessions:
+            conn.execute(PLAN_WORKOUT_EXERCISE_DELETE_SQL, (json.dumps(touched_sessions),))
+        conn.executemany(
+            PLAN_WORKOUT_EXERCISE_INSERT_SQL,
+            [
+                _plan_exercise_params(row["log_date"], row["plan_session_id"], row, now_iso)
+                for _line_no, row in final_rows
+            ],
+        )
 
         for line_no, row in final_rows:
-            conn.execute(
-                """
-                INSERT INTO plan_day_workout_exercise (
-                  log_date, plan_session_id, exercise_order, exercise_name,
-                  target_sets, target_reps_min, target_reps_max, target_weight_kg, target_rpe,
-                  intensity_target, progression_weight_rule, progression_reps_rule, created_at, updated_at
-                )
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
-                """,
-                (
-                    row["log_date"],
-                    row["plan_session_id"],
-                    row["exercise_order"],
-                    row["exercise_name"],
-                    row["target_sets"],
-                    row["target_reps_min"],
-                    row["target_reps_max"],
-                    row["target_weight_kg"],
-                    row["target_rpe"],
-                    row["intensity_target"] or None,
-                    row["progression_weight_rule"] or None,
-                    row["progression_reps_rule"] or None,
-                    now_iso,
-                    now_iso,
-                ),
-            )
             summary["imported"] += 1
             results.append(
                 {
@@ -4069,19 +4522,6 @@ def api_diet():
     # multipart (foto) o json (sin foto)
     ctype = (request.content_type or "").lower()
     is_multipart = "multipart/form-data" in ctype
-    max_len = APP.config.get("MAX_CONTENT_LENGTH")
-    if max_len and request.content_length and request.content_length > max_len:
-        max_mb = int(max_len / (1024 * 1024))
-        return (
-            jsonify(
-                {
-                    "ok": False,
-                    "error": f"Archivo demasiado grande. Máximo permitido: {max_mb} MB.",
-                }
-            ),
-            413,
-        )
-
     if is_multipart:
         data = dict(request.form or {})
         photo = request.files.get("photo")
@@ -4167,6 +4607,7 @@ def api_diet():
 
     try:
         with _conn() as conn:
+            begin_immediate(conn)
             conn.execute(
                 """
                 INSERT INTO diet_log (
@@ -4217,7 +4658,7 @@ def api_diet():
                         log_date,
                         saved_photo_rel,
                         photo_original_name or None,
-                        datetime.now().replace(microsecond=0).isoformat(),
+                        local_now_iso(),
                     ),
                 )
 
@@ -4238,17 +4679,13 @@ def api_diet():
 
 @APP.post("/api/diet/import/preview")
 def api_diet_import_preview():
-    file_storage = request.files.get("file")
-    if not file_storage or not getattr(file_storage, "filename", ""):
-        return jsonify({"ok": False, "error": "Debes subir un archivo CSV."}), 400
-
-    filename = str(file_storage.filename or "").lower()
-    if filename and not filename.endswith(".csv"):
-        return jsonify({"ok": False, "error": "El archivo debe tener extension .csv."}), 400
+    file_storage, err = csv_upload_from_request()
+    if err:
+        return jsonify({"ok": False, "error": err}), 400
 
     try:
-        text = read_text_file_storage(file_storage)
-        rows = parse_diet_import_csv(text)
+        with open_csv_upload(file_storage) as lines:
+            rows = parse_diet_import_csv(lines)
     except ValueError as e:
         return jsonify({"ok": False, "error": str(e)}), 400
     except Exception:
@@ -4256,7 +4693,7 @@ def api_diet_import_preview():
 
     with _conn() as conn:
         existing_dates = {
-            r["log_date"] for r in conn.execute("SELECT log_date FROM diet_log;").fetchall()
+            r["log_date"] for r in conn.execute("SELECT log_date FROM diet_log;")
         }
 
     out = classify_diet_import_rows(rows, existing_dates)
@@ -4270,6 +4707,46 @@ def api_diet_import_preview():
     )
 
 
+DIET_IMPORT_COLUMNS = (
+    "log_date",
+    "sleep_hours",
+    "sleep_quality",
+    "steps",
+    "weight_kg",
+    "waist_cm",
+    "hip_cm",
+    "alcohol_units",
+    "creatine_yn",
+    "photo_yn",
+)
+DIET_IMPORT_INSERT_SQL = (
+    f"INSERT INTO diet_log ({', '.join(DIET_IMPORT_COLUMNS)}) "
+    f"VALUES ({', '.join('?' * len(DIET_IMPORT_COLUMNS))});"
+)
+PHOTO_IMPORT_UPSERT_SQL = """
+INSERT INTO photo_log (log_date, kind, path, original_name, created_at)
+VALUES (?, 'progress', ?, ?, ?)
+ON CONFLICT(log_date, kind) DO UPDATE SET
+  path=excluded.path,
+  original_name=excluded.original_name,
+  created_at=excluded.created_at;
+"""
+
+
+def _diet_import_params(normalized: dict) -> tuple:
+    return tuple(normalized[col] for col in DIET_IMPORT_COLUMNS)
+
+
+def _photo_import_params(normalized: dict, created_at: str) -> tuple:
+    photo_path = normalized["photo_path"]
+    return (
+        normalized["log_date"],
+        photo_path,
+        sanitize_filename(os.path.basename(photo_path)),
+        created_at,
+    )
+
+
 @APP.post("/api/diet/import/apply")
 def api_diet_import_apply():
     data = request.get_json(silent=True) or {}
@@ -4286,12 +4763,15 @@ def api_diet_import_apply():
         prepared.append((line_no, base_row))
 
     summary = {"total": len(prepared), "imported": 0, "conflict": 0, "invalid": 0}
-    results = []
+    entries = []
+    pending = []
     seen_dates = set()
 
     with _conn() as conn:
+        # Las fechas existentes se leen ya con el lock de escritura tomado.
+        begin_immediate(conn)
         existing_dates = {
-            r["log_date"] for r in conn.execute("SELECT log_date FROM diet_log;").fetchall()
+            r["log_date"] for r in conn.execute("SELECT log_date FROM diet_log;")
         }
 
         for line_no, raw in prepared:
@@ -4315,57 +4795,7 @@ def api_diet_import_apply():
                 reasons.append("la fecha ya existe y no se sobrescribe")
 
             if status == "imported":
-                try:
-                    conn.execute(
-                        """
-                        INSERT INTO diet_log (
-                          log_date, sleep_hours, sleep_quality, steps, weight_kg,
-                          waist_cm, hip_cm, alcohol_units, creatine_yn, photo_yn
-                        )
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
-                        """,
-                        (
-                            normalized["log_date"],
-                            normalized["sleep_hours"],
-                            normalized["sleep_quality"],
-                            normalized["steps"],
-                            normalized["weight_kg"],
-                            normalized["waist_cm"],
-                            normalized["hip_cm"],
-                            normalized["alcohol_units"],
-                            normalized["creatine_yn"],
-                            normalized["photo_yn"],
-                        ),
-                    )
-
-                    if normalized["photo_path"]:
-                        conn.execute(
-                            """
-                            INSERT INTO photo_log (log_date, kind, path, original_name, created_at)
-                            VALUES (?, 'progress', ?, ?, ?)
-                            ON CONFLICT(log_date, kind) DO UPDATE SET
-                              path=excluded.path,
-                              original_name=excluded.original_name,
-                              created_at=excluded.created_at;
-                            """,
-                            (
-                                normalized["log_date"],
-                                normalized["photo_path"],
-                                sanitize_filename(os.path.basename(normalized["photo_path"])),
-                                datetime.now().replace(microsecond=0).isoformat(),
-                            ),
-                        )
-
-                    existing_dates.add(log_date)
-                    summary["imported"] += 1
-                except sqlite3.IntegrityError:
-                    status = "conflict"
-                    reasons.append("la fecha ya existe y no se sobrescribe")
-                    summary["conflict"] += 1
-                except Exception as e:
-                    status = "invalid"
-                    reasons.append(f"error DB: {str(e)}")
-                    summary["invalid"] += 1
+                pending.append(len(entries))
             elif status == "conflict":
                 summary["conflict"] += 1
             else:
@@ -4373,20 +4803,57 @@ def api_diet_import_apply():
 
             if log_date:
                 seen_dates.add(log_date)
-            if warnings:
-                reasons.extend(warnings)
-
-            results.append(
-                {
-                    "row_number": line_no,
-                    "status": status,
-                    "reason": "; ".join(reasons),
-                    "row": normalized,
-                }
-            )
+            entries.append([line_no, status, reasons, warnings, normalized])
+
+        if pending:
+            created_at = local_now_iso()
+            rows = [entries[i][4] for i in pending]
+            # Todo el bloque con executemany. Con el lock tomado ninguna otra
+            # conexión puede insertar fechas; si algo falla es una fila concreta
+            # (CHECK/NOT NULL, valor no enlazable, upsert de foto): se deshace y
+            # se repite fila a fila para marcar solo esa como inválida.
+            conn.execute("SAVEPOINT diet_import_batch;")
+            try:
+                conn.executemany(DIET_IMPORT_INSERT_SQL, map(_diet_import_params, rows))
+                conn.executemany(
+                    PHOTO_IMPORT_UPSERT_SQL,
+                    [_photo_import_params(row, created_at) for row in rows if row["photo_path"]],
+                )
+                conn.execute("RELEASE SAVEPOINT diet_import_batch;")
+                summary["imported"] += len(pending)
+            except Exception:
+                conn.execute("ROLLBACK TO SAVEPOINT diet_import_batch;")
+                conn.execute("RELEASE SAVEPOINT diet_import_batch;")
+                for i in pending:
+                    entry = entries[i]
+                    normalized = entry[4]
+                    try:
+                        conn.execute(DIET_IMPORT_INSERT_SQL, _diet_import_params(normalized))
+                        if normalized["photo_path"]:
+                            conn.execute(
+                                PHOTO_IMPORT_UPSERT_SQL, _photo_import_params(normalized, created_at)
+                            )
+                        summary["imported"] += 1
+                    except sqlite3.IntegrityError:
+                        entry[1] = "conflict"
+                        entry[2].append("la fecha ya existe y no se sobrescribe")
+                        summary["conflict"] += 1
+                    except Exception as e:
+                        entry[1] = "invalid"
+                        entry[2].append(f"error DB: {str(e)}")
+                        summary["invalid"] += 1
 
         conn.commit()
 
+    results = [
+        {
+            "row_number": line_no,
+            "status": status,
+            "reason": "; ".join(reasons + warnings),
+            "row": normalized,
+        }
+        for line_no, status, reasons, warnings, normalized in entries
+    ]
     return jsonify({"ok": True, "summary": summary, "results": results})
 
 
@@ -4455,7 +4922,7 @@ def api_workout():
                         target_session_id = existing_by_date["session_id"]
 
             if target_session_id is None:
-                now_iso = datetime.now().replace(microsecond=0).isoformat()
+                now_iso = local_now_iso()
                 # Alta concurrente: recalcular session_order y reintentar si choca el UNIQUE(log_date, session_order).
                 for _ in range(20):
                     next_order = conn.execute(
@@ -4539,7 +5006,7 @@ def api_workout():
                         class_done,
                         rpe_session,
                         notes,
-                        datetime.now().replace(microsecond=0).isoformat(),
+                        local_now_iso(),
                         target_session_id,
                     ),
                 )
@@ -4675,14 +5142,24 @@ def _send_text_download(filename: str, text: str, mimetype: str):
     )
 
 
+def _csv_bytes_writer():
+    # El CSV se codifica directamente a bytes (sin copia str + encode() final).
+    buf = TextIOWrapper(BytesIO(), encoding="utf-8", newline="", write_through=True)
+    return buf, csv.writer(buf)
+
+
+def _csv_bytes(buf) -> BytesIO:
+    buf.flush()
+    raw = buf.detach()
+    raw.seek(0)
+    return raw
+
+
 def _send_csv_download(filename: str, rows):
-    buf = StringIO()
-    writer = csv.writer(buf)
-    for row in rows:
-        writer.writerow(list(row))
-    csv_bytes = buf.getvalue().encode("utf-8")
+    buf, writer = _csv_bytes_writer()
+    writer.writerows(rows)
     return send_file(
-        BytesIO(csv_bytes),
+        _csv_bytes(buf),
         mimetype="text/csv; charset=utf-8",
         as_attachment=True,
         download_name=filename,
@@ -4752,12 +5229,10 @@ def export_plan_workout_template_csv():
         for key, value in (base or {}).items():
             if key in row:
                 row[key] = value
-        for idx, ex in enumerate(exercises or [], start=1):
-            if idx > PLAN_WORKOUT_COMBINED_EXERCISE_SLOTS:
-                break
-            for suffix in PLAN_WORKOUT_COMBINED_EXERCISE_SUFFIXES:
+        for slot_keys, ex in zip(PLAN_WORKOUT_COMBINED_SLOT_KEYS.values(), exercises or []):
+            for suffix, key in slot_keys.items():
                 val = ex.get(suffix, "")
-                row[f"exercise_{idx}_{suffix}"] = str(val) if val is not None else ""
+                row[key] = str(val) if val is not None else ""
         return [row[k] for k in fields]
 
     return _send_csv_download(
@@ -4954,8 +5429,7 @@ def export_checkins_csv():
             """
         ).fetchall()
 
-    buf = StringIO()
-    writer = csv.writer(buf)
+    buf, writer = _csv_bytes_writer()
     writer.writerow(
         [
             "log_date",
@@ -4995,9 +5469,8 @@ def export_checkins_csv():
             ]
         )
 
-    csv_bytes = buf.getvalue().encode("utf-8")
     out_path = BASE_DIR / "check-ins.csv"
-    out_path.write_bytes(csv_bytes)
+    out_path.write_bytes(_csv_bytes(buf).getbuffer())
     return send_file(out_path, as_attachment=True, download_name="check-ins.csv")
 
 
@@ -5016,8 +5489,7 @@ def export_workout_csv():
             """
         ).fetchall()
 
-    buf = StringIO()
-    writer = csv.writer(buf)
+    buf, writer = _csv_bytes_writer()
     writer.writerow(
         [
             "log_date",
@@ -5055,9 +5527,8 @@ def export_workout_csv():
             ]
         )
 
-    csv_bytes = buf.getvalue().encode("utf-8")
     out_path = BASE_DIR / "workout.csv"
-    out_path.write_bytes(csv_bytes)
+    out_path.write_bytes(_csv_bytes(buf).getbuffer())
     return send_file(out_path, as_attachment=True, download_name="workout.csv")
 
 
@@ -5081,8 +5552,7 @@ def export_supplements_csv():
             """
         ).fetchall()
 
-    buf = StringIO()
-    writer = csv.writer(buf)
+    buf, writer = _csv_bytes_writer()
     writer.writerow(
         [
             "supplement_id",
@@ -5110,9 +5580,8 @@ def export_supplements_csv():
             ]
         )
 
-    csv_bytes = buf.getvalue().encode("utf-8")
     out_path = BASE_DIR / "supplements.csv"
-    out_path.write_bytes(csv_bytes)
+    out_path.write_bytes(_csv_bytes(buf).getbuffer())
     return send_file(out_path, as_attachment=True, download_name="supplements.csv")
 
 
@@ -5129,10 +5598,13 @@ def export_backup_zip():
             return jsonify({"ok": False, "error": f"No se pudo crear snapshot DB: {str(e)}"}), 500
 
         mem = BytesIO()
-        with zipfile.ZipFile(mem, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
+        # Nivel 1: la DB y las fotos (ya comprimidas) apenas ganan con niveles altos.
+        with zipfile.ZipFile(
+            mem, mode="w", compression=zipfile.ZIP_DEFLATED, compresslevel=1
+        ) as zf:
             meta = {
                 "app": "tracker-local",
-                "created_at": datetime.now().replace(microsecond=0).isoformat(),
+                "created_at": local_now_iso(),
                 "version_hint": "v0.0.1.0",
                 "db_file": "tracker.db",
                 "upload_root": "uploads/",
@@ -5237,8 +5709,10 @@ def restore_backup_zip():
         zip_obj.close()
 
         upload_root_path = Path(UPLOAD_ROOT)
+        reset_db_connections()
         try:
             if DB_PATH.exists():
+                checkpoint_db(DB_PATH)
                 rollback_db.parent.mkdir(parents=True, exist_ok=True)
                 shutil.copy2(DB_PATH, rollback_db)
             if upload_root_path.exists():
@@ -5248,6 +5722,7 @@ def restore_backup_zip():
 
         try:
             DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+            remove_wal_sidecars(DB_PATH)
             shutil.copy2(staged_db, DB_PATH)
 
             if upload_root_path.exists():
@@ -5257,12 +5732,15 @@ def restore_backup_zip():
             else:
                 upload_root_path.mkdir(parents=True, exist_ok=True)
 
+            reset_db_connections()
             ensure_schema()
         except Exception as e:
             # Rollback best effort
             try:
                 if rollback_db.exists():
                     DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+                    reset_db_connections()
+                    remove_wal_sidecars(DB_PATH)
                     shutil.copy2(rollback_db, DB_PATH)
                 if upload_root_path.exists():
                     shutil.rmtree(upload_root_path)
@@ -5308,6 +5786,13 @@ def serve_uploads_legacy(filename):
     return send_from_directory(UPLOAD_ROOT, filename)
 
 
+@APP.cli.command("hash-password")
+@click.password_option()
+def hash_password_command(password):
+    """Imprime el hash para TRACKER_AUTH_PASSWORD_HASH."""
+    click.echo(generate_password_hash(password))
+
+
 if __name__ == "__main__":
     host = os.environ.get("TRACKER_HOST", "127.0.0.1")
     try:
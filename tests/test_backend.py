@@ -1,12 +1,14 @@
 import csv
 import io
 import json
+import os
 import sqlite3
 import tempfile
 import unittest
 import zipfile
 from contextlib import contextmanager
 from pathlib import Path
+from unittest import mock
 
 import app as tracker
 from werkzeug.datastructures import FileStorage
@@ -26,7 +28,6 @@ class TrackerBackendTests(unittest.TestCase):
         self.orig_photo_compression_enabled = tracker.PHOTO_COMPRESSION_ENABLED
         self.orig_photo_max_side = tracker.PHOTO_MAX_SIDE
         self.orig_photo_quality = tracker.PHOTO_QUALITY
-        self.orig_photo_prefer_webp = tracker.PHOTO_PREFER_WEBP
 
         tracker.DB_PATH = self.tmp_path / "tracker_test.db"
         tracker.UPLOAD_ROOT = str(self.tmp_path / "uploads")
@@ -66,7 +67,6 @@ class TrackerBackendTests(unittest.TestCase):
         tracker.PHOTO_COMPRESSION_ENABLED = self.orig_photo_compression_enabled
         tracker.PHOTO_MAX_SIDE = self.orig_photo_max_side
         tracker.PHOTO_QUALITY = self.orig_photo_quality
-        tracker.PHOTO_PREFER_WEBP = self.orig_photo_prefer_webp
         if getattr(self, "_client_ctx", None) is not None:
             self._client_ctx.__exit__(None, None, None)
         self.tmp.cleanup()
@@ -83,6 +83,9 @@ class TrackerBackendTests(unittest.TestCase):
     def test_helper_functions(self):
         self.assertTrue(tracker.valid_iso_date("2026-02-15"))
         self.assertFalse(tracker.valid_iso_date("15-02-2026"))
+        self.assertFalse(tracker.valid_iso_date("2026-02-30"))
+        self.assertFalse(tracker.valid_iso_date("20260215"))
+        self.assertFalse(tracker.valid_iso_date(None))
         self.assertEqual(tracker.safe_int("12"), 12)
         self.assertIsNone(tracker.safe_int("x"))
         self.assertEqual(tracker.safe_float("7.5"), 7.5)
@@ -92,6 +95,11 @@ class TrackerBackendTests(unittest.TestCase):
         self.assertIsNone(tracker.yn_or_none("maybe"))
         self.assertTrue(tracker.truthy("yes"))
         self.assertFalse(tracker.truthy("no"))
+        self.assertEqual(tracker.yes_no(" On "), "Y")
+        self.assertEqual(tracker.yes_no("off"), "N")
+        self.assertEqual(tracker.yes_no("???", default="N"), "N")
+        self.assertEqual(tracker.parse_summary_days("30"), 30)
+        self.assertEqual(tracker.parse_summary_days("31"), 7)
         self.assertEqual(
             tracker.photo_url_from_rel("static/uploads/2026-02-15/a.jpg"),
             "/uploads/2026-02-15/a.jpg",
@@ -100,6 +108,174 @@ class TrackerBackendTests(unittest.TestCase):
             tracker.photo_url_from_rel("uploads/2026-02-15/a.jpg"),
             "/uploads/2026-02-15/a.jpg",
         )
+        self.assertEqual(tracker.normalize_header_name(" Fecha Año/Sesión "), "fecha_ano_sesion")
+        self.assertEqual(tracker.normalize_header_name("Peso ≥ kg"), "peso_kg")
+
+    def test_ensure_schema_migrates_legacy_db_and_records_version(self):
+        legacy_db = self.tmp_path / "legacy.db"
+        with sqlite3.connect(legacy_db) as conn:
+            conn.execute(
+                "CREATE TABLE photo_log (log_date TEXT NOT NULL, kind TEXT NOT NULL, path TEXT NOT NULL, PRIMARY KEY (log_date, kind));"
+            )
+            conn.execute(
+                "INSERT INTO photo_log (log_date, kind, path) VALUES ('2026-02-01', 'progress', 'uploads/a.jpg');"
+            )
+        tracker.DB_PATH = legacy_db
+        tracker.ensure_schema()
+
+        with self._db() as conn:
+            self.assertEqual(conn.execute("PRAGMA user_version;").fetchone()[0], tracker.SCHEMA_VERSION)
+            self.assertEqual(conn.execute("PRAGMA journal_mode;").fetchone()[0], "wal")
+            cols = {r["name"] for r in conn.execute("PRAGMA table_info(photo_log);").fetchall()}
+            self.assertIn("original_name", cols)
+            self.assertIn("created_at", cols)
+            self.assertTrue(tracker.has_column(conn, "photo_log", "original_name"))
+            self.assertFalse(tracker.has_column(conn, "photo_log", "missing_col"))
+            row = conn.execute("SELECT created_at FROM photo_log;").fetchone()
+            self.assertTrue(row["created_at"])
+            conn.execute("UPDATE photo_log SET created_at = NULL;")
+            conn.commit()
+
+        # Con la versión al día, un segundo arranque no vuelve a ejecutar migraciones.
+        tracker.ensure_schema()
+        with self._db() as conn:
+            self.assertIsNone(conn.execute("SELECT created_at FROM photo_log;").fetchone()["created_at"])
+
+    def test_ensure_schema_migrates_legacy_workout_log_to_sessions(self):
+        legacy_db = self.tmp_path / "legacy_workout.db"
+        with sqlite3.connect(legacy_db) as conn:
+            conn.execute(
+                """
+                CREATE TABLE workout_log (
+                  log_date TEXT PRIMARY KEY,
+                  session_done_yn TEXT,
+                  class_done TEXT,
+                  rpe_session INTEGER,
+                  hipthrust_topset TEXT,
+                  squat_topset TEXT,
+                  notes TEXT
+                );
+                """
+            )
+            conn.executemany(
+                "INSERT INTO workout_log (log_date, session_done_yn, hipthrust_topset, squat_topset, notes) VALUES (?, ?, ?, ?, ?);",
+                [
+                    ("2026-01-10", "Y", "100kg x 8", None, "dia A"),
+                    ("2026-01-12", "Y", None, None, "solo clase"),
+                    ("2026-01-14", "N", "105kg x 6", "70kg x 5", ""),
+                ],
+            )
+        tracker.DB_PATH = legacy_db
+        tracker.ensure_schema()
+
+        with self._db() as conn:
+            sessions = conn.execute(
+                "SELECT session_id, log_date, session_type, notes FROM workout_session ORDER BY log_date;"
+            ).fetchall()
+            self.assertEqual([r["log_date"] for r in sessions], ["2026-01-10", "2026-01-12", "2026-01-14"])
+            self.assertTrue(all(r["session_type"] == "clase" for r in sessions))
+            exercises = conn.execute(
+                """
+                SELECT s.log_date, e.exercise_name, e.set_order, e.topset_text
+                FROM workout_exercise e
+                JOIN workout_session s ON s.session_id = e.session_id
+                ORDER BY s.log_date, e.set_order;
+                """
+            ).fetchall()
+            self.assertEqual(
+                [(r["log_date"], r["exercise_name"], r["set_order"], r["topset_text"]) for r in exercises],
+                [
+                    ("2026-01-10", "Hip Thrust", 1, "100kg x 8"),
+                    ("2026-01-14", "Hip Thrust", 1, "105kg x 6"),
+                    ("2026-01-14", "Sentadilla", 2, "70kg x 5"),
+                ],
+            )
+            index_names = {
+                r["name"]
+                for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index';").fetchall()
+            }
+            self.assertIn("idx_workout_session_date", index_names)
+            self.assertIn("idx_workout_exercise_session", index_names)
+
+    def test_calendar_max_date_queries_use_covering_index_seek(self):
+        with self._db() as conn:
+            for sql in tracker.CALENDAR_MAX_DATE_SQL.values():
+                plan = " ".join(r["detail"] for r in conn.execute("EXPLAIN QUERY PLAN " + sql).fetchall())
+                self.assertIn("SEARCH", plan)
+                self.assertIn("COVERING INDEX", plan)
+
+    def test_plan_day_queries_search_by_index_without_sorting(self):
+        def plan_for(sql, params):
+            with self._db() as conn:
+                return [r["detail"] for r in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+
+        sessions_plan = plan_for(tracker.PLAN_DAY_SESSIONS_SQL, ("2026-03-01",))
+        self.assertTrue(all(step.startswith("SEARCH") for step in sessions_plan), sessions_plan)
+
+        overview_plan = plan_for(tracker.PLAN_ADHERENCE_OVERVIEW_SQL, ("2026-02-23",) * 4)
+        self.assertTrue(
+            any(step.startswith("SEARCH plan_day_adherence") for step in overview_plan), overview_plan
+        )
+        self.assertFalse(any(step.startswith("SCAN plan_day_adherence") for step in overview_plan))
+
+    def test_plan_day_cache_is_invalidated_by_writes(self):
+        with tracker._conn() as conn:
+            first = tracker.fetch_plan_day_cached(conn, "2026-03-01")
+            self.assertIs(tracker.fetch_plan_day_cached(conn, "2026-03-01"), first)
+
+        with self._db() as other:
+            other.execute(
+                "INSERT INTO plan_day_adherence (log_date, diet_score) VALUES ('2026-03-01', 1.0);"
+            )
+            other.commit()
+
+        with tracker._conn() as conn:
+            second = tracker.fetch_plan_day_cached(conn, "2026-03-01")
+            self.assertIsNot(second, first)
+            self.assertEqual(second["adherence"]["diet_score"], 1.0)
+
+            conn.execute("DELETE FROM plan_day_adherence WHERE log_date = '2026-03-01';")
+            conn.commit()
+            third = tracker.fetch_plan_day_cached(conn, "2026-03-01")
+            self.assertIsNone(third["adherence"]["diet_score"])
+
+    def test_parallel_build_state_matches_sequential_and_is_read_only(self):
+        with self._db() as conn:
+            conn.execute(
+                "INSERT INTO diet_log (log_date, sleep_hours, steps, weight_kg) "
+                "VALUES ('2026-03-01', 7.5, 9000, 80.0);"
+            )
+            conn.commit()
+
+        sequential = tracker.build_state(15)
+        with mock.patch.object(tracker, "STATE_PARALLEL_ENABLED", True):
+            parallel = tracker.build_state(15)
+        self.assertEqual(parallel, sequential)
+
+        worker = tracker._state_pool().submit(
+            tracker._read_only_call,
+            lambda conn: conn.execute("DELETE FROM diet_log;"),
+        )
+        with self.assertRaises(sqlite3.OperationalError):
+            worker.result()
+
+    def test_state_etag_returns_not_modified_until_data_changes(self):
+        with mock.patch.object(tracker, "STATE_ETAG_RACY_NS", -1):
+            first = self.client.get("/api/state?limit=1")
+            etag = first.headers.get("ETag")
+            self.assertTrue(etag)
+
+            cached = self.client.get("/api/state?limit=1", headers={"If-None-Match": etag})
+            self.assertEqual(cached.status_code, 304)
+            other_args = self.client.get("/api/state?limit=2", headers={"If-None-Match": etag})
+            self.assertEqual(other_args.status_code, 200)
+
+            with self._db() as conn:
+                conn.execute("INSERT INTO diet_log (log_date, steps) VALUES ('2026-03-01', 1000);")
+                conn.commit()
+            changed = self.client.get("/api/state?limit=1", headers={"If-None-Match": etag})
+            self.assertEqual(changed.status_code, 200)
+            self.assertNotEqual(changed.headers.get("ETag"), etag)
 
     def test_ensure_upload_dir_creates_date_folder_and_is_idempotent(self):
         log_date = "2026-03-01"
@@ -143,6 +319,35 @@ class TrackerBackendTests(unittest.TestCase):
         self.assertIn('id="coverLoginBtn"', html)
         self.assertIn('id="coverEnterBtn"', html)
 
+    def test_secret_key_is_persisted_when_env_missing(self):
+        key_path = self.tmp_path / ".secret_key"
+        with mock.patch.object(tracker, "SECRET_KEY_PATH", key_path), mock.patch.dict(
+            os.environ, {"TRACKER_SECRET_KEY": ""}
+        ):
+            first = tracker._load_secret_key()
+            self.assertEqual(len(first), 64)
+            self.assertEqual(key_path.stat().st_mode & 0o777, 0o600)
+            self.assertEqual(tracker._load_secret_key(), first)
+            with mock.patch.dict(os.environ, {"TRACKER_SECRET_KEY": "desde-env"}):
+                self.assertEqual(tracker._load_secret_key(), "desde-env")
+
+    def test_auth_password_hash_is_computed_lazily_from_plain_env(self):
+        tracker.AUTH_PASSWORD_HASH = ""
+        with mock.patch.dict(os.environ, {"TRACKER_AUTH_PASSWORD": "clave-plana"}):
+            self.assertEqual(tracker._load_auth_hash(), "")
+            hashed = tracker.auth_password_hash()
+            self.assertTrue(tracker.check_password_hash(hashed, "clave-plana"))
+            self.assertIs(tracker.auth_password_hash(), hashed)
+
+    def test_csrf_rejects_wrong_and_non_ascii_tokens(self):
+        for token in ("x" * 32, "tökén-inválido"):
+            res = self.client.post(
+                "/api/supplements/day",
+                json={"log_date": "2026-03-01", "entries": [], "csrf_token": token},
+                headers={"X-CSRF-Token": ""},
+            )
+            self.assertEqual(res.status_code, 403, token)
+
     def test_local_auth_password_flow(self):
         tracker.AUTH_ENABLED = True
         tracker.AUTH_PASSWORD_HASH = tracker.generate_password_hash("clave-secreta")
@@ -625,6 +830,35 @@ class TrackerBackendTests(unittest.TestCase):
         self.assertAlmostEqual(ex["delta_weight"], 5.0)
         self.assertEqual(ex["delta_reps"], 1)
 
+    def test_workout_deltas_group_accented_names_case_insensitively(self):
+        today = tracker.datetime.now().date()
+        d1 = (today - tracker.timedelta(days=1)).isoformat()
+        d2 = today.isoformat()
+        for log_date, name, weight, reps in (
+            (d1, "ELEVACIÓN LATERAL", 8, 12),
+            (d2, "Elevación lateral", 10, 10),
+        ):
+            res = self.client.post(
+                "/api/workout",
+                json={
+                    "log_date": log_date,
+                    "session_type": "pesas",
+                    "session_done_yn": "Y",
+                    "exercises_json": json.dumps(
+                        [{"exercise_name": name, "weight_kg": weight, "reps": reps}]
+                    ),
+                },
+            )
+            self.assertEqual(res.status_code, 200)
+
+        with tracker._conn() as conn:
+            rows = tracker.fetch_workout(conn, 14)
+        row = next((r for r in rows if r["log_date"] == d2), None)
+        self.assertIsNotNone(row)
+        ex = row["exercises"][0]
+        self.assertAlmostEqual(ex["delta_weight"], 2.0)
+        self.assertEqual(ex["delta_reps"], -2)
+
     def test_workout_strength_create_with_empty_exercises_persists_zero(self):
         created = self.client.post(
             "/api/workout",
@@ -814,6 +1048,39 @@ class TrackerBackendTests(unittest.TestCase):
         self.assertEqual(rows[1][0], "2026-02-11")
         self.assertAlmostEqual(float(rows[1][whr_idx]), 0.75, places=6)
 
+    def test_diet_import_preview_rejects_oversized_integer_cell(self):
+        csv_text = "log_date,steps\n2026-03-05," + "9" * 5000 + "\n"
+        res = self.client.post(
+            "/api/diet/import/preview",
+            data={"file": (io.BytesIO(csv_text.encode("utf-8")), "diet.csv")},
+            content_type="multipart/form-data",
+        )
+        self.assertEqual(res.status_code, 200, res.get_data(as_text=True))
+        item = res.get_json()["preview"][0]
+        self.assertEqual(item["status"], "invalid")
+        self.assertIn("steps debe ser entero", item["reason"])
+
+    def test_open_csv_upload_accepts_stream_without_iobase_interface(self):
+        class LegacySpooledFile:
+            # Como SpooledTemporaryFile antes de Python 3.11: sin seekable()/readable().
+            def __init__(self, data):
+                self._file = io.BytesIO(data)
+
+            def read(self, *args):
+                return self._file.read(*args)
+
+            def seek(self, *args):
+                return self._file.seek(*args)
+
+            def tell(self):
+                return self._file.tell()
+
+        data = "\ufefflog_date;steps\n2026-03-05;1200\n".encode("utf-8")
+        storage = FileStorage(stream=LegacySpooledFile(data), filename="diet.csv")
+        with tracker.open_csv_upload(storage) as lines:
+            rows = list(tracker._build_csv_reader(lines))
+        self.assertEqual(rows, [["log_date", "steps"], ["2026-03-05", "1200"]])
+
     def test_diet_import_preview_classifies_valid_conflict_and_invalid_rows(self):
         self.client.post(
             "/api/diet",
@@ -1067,9 +1334,10 @@ bad-date,7,9000,70,78,97,Y,0
         try:
             tracker.PHOTO_COMPRESSION_ENABLED = True
 
-            def fake_compressor(raw_bytes, ext):
-                self.assertEqual(raw_bytes, b"raw-photo")
+            def fake_compressor(source, ext, size):
+                self.assertEqual(source.read(), b"raw-photo")
                 self.assertEqual(ext, ".png")
+                self.assertEqual(size, len(b"raw-photo"))
                 return (b"compressed-photo", ".webp")
 
             tracker._compress_photo_bytes = fake_compressor
@@ -1098,6 +1366,65 @@ bad-date,7,9000,70,78,97,Y,0
         finally:
             tracker._compress_photo_bytes = original_compressor
 
+    def _small_photo_bytes(self, fmt, size=(64, 32), exif=None):
+        Image = tracker._get_pil()[0]
+        img = Image.new("RGB", size)
+        img.putdata([((x * 4) % 256, (y * 8) % 256, 128) for y in range(size[1]) for x in range(size[0])])
+        out = io.BytesIO()
+        kwargs = {"quality": 95} if fmt == "JPEG" else {}
+        if exif is not None:
+            kwargs["exif"] = exif
+        img.save(out, format=fmt, **kwargs)
+        return out.getvalue()
+
+    @unittest.skipUnless(tracker.PILLOW_AVAILABLE, "requiere Pillow")
+    def test_small_jpeg_with_gps_exif_is_recompressed_without_exif(self):
+        Image = tracker._get_pil()[0]
+        exif = Image.Exif()
+        exif[0x010F] = "Fabricante" * 20
+        exif[0x8825] = {1: "N", 2: (43.0, 15.0, 30.0)}
+        data = self._small_photo_bytes("JPEG", exif=exif)
+        self.assertLess(len(data), tracker.PHOTO_SKIP_BELOW_BYTES)
+
+        tracker.PHOTO_COMPRESSION_ENABLED = True
+        result = tracker._compress_photo_bytes(io.BytesIO(data), ".jpg", len(data))
+
+        self.assertIsNotNone(result)
+        payload, ext = result
+        self.assertEqual(ext, ".webp")
+        with Image.open(io.BytesIO(payload)) as img:
+            self.assertEqual(img.format, "WEBP")
+            self.assertFalse(img.info.get("exif"))
+            self.assertEqual(len(img.getexif()), 0)
+
+    @unittest.skipUnless(tracker.PILLOW_AVAILABLE, "requiere Pillow")
+    def test_small_jpeg_with_orientation_is_transposed(self):
+        Image = tracker._get_pil()[0]
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        data = self._small_photo_bytes("JPEG", size=(64, 32), exif=exif)
+
+        tracker.PHOTO_COMPRESSION_ENABLED = True
+        result = tracker._compress_photo_bytes(io.BytesIO(data), ".jpg", len(data))
+
+        self.assertIsNotNone(result)
+        payload, ext = result
+        self.assertEqual(ext, ".webp")
+        with Image.open(io.BytesIO(payload)) as img:
+            self.assertEqual(img.size, (32, 64))
+
+    @unittest.skipUnless(tracker.PILLOW_AVAILABLE, "requiere Pillow")
+    def test_small_webp_without_exif_is_stored_as_uploaded(self):
+        data = self._small_photo_bytes("WEBP")
+        tracker.PHOTO_COMPRESSION_ENABLED = True
+        self.assertIsNone(tracker._compress_photo_bytes(io.BytesIO(data), ".webp", len(data)))
+
+        storage = FileStorage(stream=io.BytesIO(data), filename="avance.webp")
+        rel = tracker.save_progress_photo(storage, "2026-02-19")
+
+        self.assertTrue(rel.endswith(".webp"), rel)
+        self.assertEqual(Path(tracker.photo_rel_to_abs(rel)).read_bytes(), data)
+
     def test_invalid_photo_extension_returns_400(self):
         res = self.client.post(
             "/api/diet",
@@ -1126,6 +1453,12 @@ bad-date,7,9000,70,78,97,Y,0
         payload = res.get_json()
         self.assertIn("Máximo permitido", payload.get("error", ""))
 
+    def test_json_endpoint_rejects_body_over_json_cap(self):
+        filler = "x" * (tracker.JSON_MAX_CONTENT_LENGTH + 1)
+        res = self.client.post("/api/workout", json={"log_date": "2026-02-14", "notes": filler})
+        self.assertEqual(res.status_code, 413)
+        self.assertIn("Máximo permitido: 1 MB", res.get_json().get("error", ""))
+
     def test_photo_flag_y_without_photo_file_does_not_persist_as_y(self):
         res = self.client.post(
             "/api/diet",
@@ -1254,6 +1587,25 @@ bad-date,7,9000,70,78,97,Y,0
         self.assertEqual(day["diet"]["breakfast"], "Huevos")
         self.assertFalse(day["coverage"]["has_workout_plan"])
 
+    def test_plan_import_diet_decodes_bom_and_latin1_uploads(self):
+        filler = "".join(f"2026-06-{d:02d};2000;150;220;80;Avena;Fruta;Pollo;Yogur;Pescado;\n" for d in range(1, 29))
+        filler *= 1 + tracker.CSV_STREAM_CHUNK_SIZE // len(filler)
+        header = "date;calories_target_kcal;protein_target_g;carbs_target_g;fat_target_g;breakfast;snack_1;lunch;snack_2;dinner;notes\n"
+        cases = [
+            (b"\xef\xbb\xbf" + (header + "2026-09-01;2100;150;220;80;Piña;Fruta;Pollo;Yogur;Pescado;\n").encode("utf-8"), "2026-09-01"),
+            # El byte no UTF-8 aparece pasado el primer bloque: todo el archivo va como latin-1.
+            ((header + filler + "2026-09-02;2100;150;220;80;Piña;Fruta;Pollo;Yogur;Pescado;\n").encode("latin-1"), "2026-09-02"),
+        ]
+        for raw, log_date in cases:
+            res = self.client.post(
+                "/api/plan/import/diet",
+                data={"file": (io.BytesIO(raw), "plan_diet.csv")},
+                content_type="multipart/form-data",
+            )
+            self.assertEqual(res.status_code, 200, res.get_data(as_text=True))
+            day = self.client.get(f"/api/plan/day?log_date={log_date}").get_json()
+            self.assertEqual(day["diet"]["breakfast"], "Piña")
+
     def test_plan_import_workout_and_adherence(self):
         sessions_csv = """date,session_id,session_type,warmup,class_sessions,cardio,mobility_cooldown,additional_exercises,notes
 2026-08-03,A,pesas,Bici 10 min,,Caminata 20,Estirar 8,Abducciones,Dia fuerte